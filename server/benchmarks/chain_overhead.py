@@ -0,0 +1,111 @@
+"""
+CPU time per request of the LangChain chain vs. its fast path (completion/fast.py).
+
+Both paths run the same simulated model (model_specs.simulated.yaml) with its latency
+model switched off, so what is left is the CPU time of everything around the engine, and
+every request has a different prompt, so none is served from the completion cache.
+
+    cd server && python -m benchmarks.chain_overhead --requests 2000
+"""
+
+import argparse
+import asyncio
+import time
+from types import SimpleNamespace
+
+import yaml
+from langchain_core.runnables import (
+    RunnableLambda,
+    RunnableParallel,
+    RunnablePassthrough,
+)
+
+from completion import handle_outputs, output_handler, parse_input
+from completion.cache import CompletionCache
+from completion.fanout import DeadlineFanOut
+from completion.registry import ModelRegistry, ModelSpec
+
+SPECS = "completion/model_specs.simulated.yaml"
+
+# a typical request: a few hundred lines of context around the cursor
+PREFIX = (
+    "import numpy as np\n\n\ndef mean(items):\n    total = 0\n    for item in items:\n        total += item\n"
+    * 40
+)
+SUFFIX = "\n\nprint(mean([1, 2, 3]))\n" * 20
+
+
+def build(requests: int):
+    with open(SPECS, encoding="utf-8") as f:
+        specs = [ModelSpec(**spec) for spec in yaml.safe_load(f)]
+    for spec in specs:
+        spec.engine.update(
+            prefill_ms_per_token=0, decode_ms_per_token=0, max_batch_wait_ms=0
+        )
+    registry = ModelRegistry(specs, CompletionCache(max_entries=requests))
+    registry.warm_up()
+    fan_out = DeadlineFanOut(registry.models, deadline_seconds=60)
+    chain = (
+        RunnableLambda(parse_input)
+        | RunnableParallel(inputs=RunnablePassthrough(), generations=fan_out)
+        | output_handler
+    )
+
+    async def fast(gen_req):
+        inputs = parse_input(gen_req)
+        return handle_outputs(inputs, await fan_out.ainvoke_fast(inputs))
+
+    return chain.ainvoke, fast, len(registry.models)
+
+
+def gen_reqs(requests: int, offset: int):
+    return [
+        SimpleNamespace(
+            prefix=f"{PREFIX}x_{offset + i} = ",
+            suffix=SUFFIX,
+            session_id="benchmark",
+            language="python",
+            trigger="auto",
+            file_path=None,
+            context_files=[],
+            candidates=1,
+        )
+        for i in range(requests)
+    ]
+
+
+async def measure(complete, gen_reqs) -> tuple[float, float]:
+    """(CPU ms, wall ms) per request, the requests being sent one after the other."""
+    cpu, wall = time.process_time(), time.perf_counter()
+    for gen_req in gen_reqs:
+        await complete(gen_req)
+    return (
+        1000 * (time.process_time() - cpu) / len(gen_reqs),
+        1000 * (time.perf_counter() - wall) / len(gen_reqs),
+    )
+
+
+async def main(requests: int, warm_up: int):
+    chain, fast, models = build(2 * (requests + warm_up))
+    results = {}
+    for i, (name, complete) in enumerate([("chain", chain), ("fast path", fast)]):
+        await measure(complete, gen_reqs(warm_up, offset=-warm_up * (i + 1)))
+        results[name] = await measure(complete, gen_reqs(requests, offset=i * requests))
+
+    print(f"{requests} requests, {models} model(s):")
+    for name, (cpu, wall) in results.items():
+        print(f"  {name:<10} {cpu:7.3f} ms CPU, {wall:7.3f} ms wall per request")
+    saved = results["chain"][0] - results["fast path"][0]
+    print(
+        f'  the fast path saves {saved:.3f} ms CPU per request ({saved / results["chain"][0]:.0%})'
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--warm-up", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.warm_up))
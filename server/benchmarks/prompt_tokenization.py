@@ -0,0 +1,115 @@
+"""
+CPU time per request of tokenizing the prompt: all of it, as the engine does with a text prompt,
+vs. incrementally per session (completion/prompt_tokens.py).
+
+A session types code into the middle of a file, one request per keystroke, with now and then
+a backspace or a jump of the cursor. Every request's window around the cursor is trimmed by the
+model's context budget, like the server does. The tokens of both ways are compared, so the
+benchmark also checks that the incremental ones are right.
+
+By default the simulated model's tokenizer is used; with `transformers` installed, any
+HuggingFace tokenizer can be, e.g. the one of the served model:
+
+    cd server && python -m benchmarks.prompt_tokenization --keystrokes 2000
+    cd server && python -m benchmarks.prompt_tokenization --tokenizer deepseek-ai/deepseek-coder-1.3b-base
+"""
+
+import argparse
+import random
+import time
+
+import yaml
+
+from completion.budget import ContextBudget
+from completion.fast import format_prompt
+from completion.prompt_tokens import PromptTokenizer, TokenizedPrompt
+from completion.simulated import SimulatedTokenizer
+
+SPECS = "completion/model_specs.simulated.yaml"
+
+FILE = (
+    "import numpy as np\n\n\ndef mean(items):\n    total = 0\n    for item in items:\n        total += item\n"
+    * 200
+)
+TYPED = (
+    "\n\ndef variance(items):\n    m = mean(items)\n"
+    "    return sum((item - m) ** 2 for item in items) / len(items)\n"
+)
+
+
+def load_tokenizer(name: str | None):
+    if name is None:
+        return SimulatedTokenizer()
+    from transformers import AutoTokenizer  # only for real tokenizers
+
+    return AutoTokenizer.from_pretrained(name, trust_remote_code=True)
+
+
+def keystrokes(n: int, seed: int = 0):
+    """(prefix, suffix) after each of `n` keystrokes."""
+    rng = random.Random(seed)
+    text, cursor, typed = FILE, len(FILE) // 2, 0
+    for _ in range(n):
+        r = rng.random()
+        if r < 0.85:
+            text = text[:cursor] + TYPED[typed % len(TYPED)] + text[cursor:]
+            cursor, typed = cursor + 1, typed + 1
+        elif r < 0.97:
+            text, cursor = text[: cursor - 1] + text[cursor:], cursor - 1
+        else:
+            cursor = rng.randrange(len(text))
+        yield text[:cursor], text[cursor:]
+
+
+def main(keystroke_count: int, tokenizer_name: str | None):
+    with open(SPECS, encoding="utf-8") as f:
+        spec = yaml.safe_load(f)[0]
+    tokenizer = load_tokenizer(tokenizer_name)
+    budget = ContextBudget(
+        lambda text: len(tokenizer.encode(text, add_special_tokens=False)),
+        **spec["context"],
+    )
+    prompt_tokenizer = PromptTokenizer(spec["template"], lambda: tokenizer)
+
+    full_cpu, incremental_cpu, mismatches = 0.0, 0.0, 0
+    for prefix, suffix in keystrokes(keystroke_count):
+        inputs = budget({"prefix": prefix, "suffix": suffix, "session_id": "benchmark"})
+
+        cpu = time.process_time()
+        full = tokenizer.encode(
+            format_prompt(spec["template"], inputs), add_special_tokens=True
+        )
+        full_cpu += time.process_time() - cpu
+
+        cpu = time.process_time()
+        prompt = prompt_tokenizer(inputs)
+        incremental_cpu += time.process_time() - cpu
+        mismatches += (
+            not isinstance(prompt, TokenizedPrompt) or prompt.token_ids != full
+        )
+
+    stats = prompt_tokenizer.stats()
+    chars = stats["prompt_chars"] / max(stats["prompts"], 1)
+    print(f"{keystroke_count} keystrokes, {chars:.0f} characters per prompt:")
+    print(f"  full         {1000 * full_cpu / keystroke_count:7.3f} ms CPU per request")
+    print(
+        f"  incremental  {1000 * incremental_cpu / keystroke_count:7.3f} ms CPU per request"
+        f' ({stats["tokenized_chars"] / max(stats["prompt_chars"], 1):.1%} of the characters tokenized)'
+    )
+    print(
+        f'  {mismatches} prompts tokenized differently, {stats["resync_failures"]} splices fell back to full'
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--keystrokes", type=int, default=1000)
+    parser.add_argument(
+        "--tokenizer",
+        default=None,
+        help="a HuggingFace tokenizer, instead of the simulated one",
+    )
+    args = parser.parse_args()
+    main(args.keystrokes, args.tokenizer)
@@ -0,0 +1,107 @@
+"""
+CPU time of encoding a GenerateResponse: as FastAPI does for a route's response model
+(validate and convert it to a dict, then the stdlib's json), as the websocket did
+(json.dumps(model_dump())), with orjson on the dict, and with models/Encoding.py, which
+serializes the model straight to bytes (and to msgpack, if it is installed).
+
+Responses of three models: with one completion each, and with 8 ranked candidates each.
+
+    cd server && python -m benchmarks.response_encoding --iterations 20000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import orjson
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from models import CompletionCandidate, GenerateResponse, ModelTiming
+from models.Encoding import MSGPACK, MSGPACK_AVAILABLE, encode
+
+COMPLETION = "total = sum(items)\n    return total / len(items)"
+
+
+def response(candidates: int) -> GenerateResponse:
+    models = [f"model_{i}" for i in range(3)]
+    return GenerateResponse(
+        time=0.142,
+        completions={model: COMPLETION for model in models},
+        timing={
+            model: ModelTiming(
+                decoded_tokens=24,
+                returned_tokens=17,
+                wall_ms=131.5,
+                queue_ms=2.1,
+                prefill_ms=40.3,
+                decode_ms=88.9,
+                prompt_tokens=1843,
+                cached_tokens=1792,
+            )
+            for model in models
+        },
+        candidates=(
+            {
+                model: [
+                    CompletionCandidate(text=f"{COMPLETION}  # {i}", score=-0.1 * i)
+                    for i in range(candidates)
+                ]
+                for model in models
+            }
+            if candidates > 1
+            else {}
+        ),
+    )
+
+
+async def fastapi_encode(field, content: GenerateResponse, iterations: int) -> float:
+    """What a route with a response model did: validate, convert to a dict, render with json."""
+    cpu = time.process_time()
+    for _ in range(iterations):
+        dumped = await serialize_response(
+            field=field, response_content=content, is_coroutine=True
+        )
+        JSONResponse(dumped).body
+    return 1e6 * (time.process_time() - cpu) / iterations
+
+
+def measure(encode_once, iterations: int) -> float:
+    cpu = time.process_time()
+    for _ in range(iterations):
+        encode_once()
+    return 1e6 * (time.process_time() - cpu) / iterations
+
+
+def main(iterations: int):
+    field = create_response_field(name="response", type_=GenerateResponse)
+    for candidates in (1, 8):
+        content = response(candidates)
+        ways = {
+            "json.dumps(dict)": lambda: json.dumps(content.model_dump()).encode(),
+            "orjson(dict)": lambda: orjson.dumps(content.model_dump()),
+            "encode": lambda: encode(content),
+        }
+        if MSGPACK_AVAILABLE:
+            ways["encode msgpack"] = lambda: encode(content, MSGPACK)
+        print(
+            f"{candidates} candidate(s) per model, {len(encode(content))} bytes of JSON:"
+        )
+        print(
+            f'  {"fastapi":18} {asyncio.run(fastapi_encode(field, content, iterations)):7.1f} µs CPU per response'
+        )
+        for name, encode_once in ways.items():
+            print(
+                f"  {name:18} {measure(encode_once, iterations):7.1f} µs CPU per response"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--iterations", type=int, default=10000)
+    args = parser.parse_args()
+    main(args.iterations)
@@ -1,33 +1,204 @@
 '''
 Constructs the whole LLM chain. 
 Takes GenerateRequest as input, and returns a dict consisting 
-of each model's completion to be used in GenerateReponse.
+of each model's Generation (completion + metadata, e.g. whether 
+it was served from the cache) to be used in GenerateReponse. 
+Models that miss the deadline come back with status 'timed_out'. 
+Completions are post-processed before they are returned: the text they repeat 
+from the suffix is trimmed and empty ones are dropped (see postprocess.py). 
+Use `chain.ainvoke` from async code; the models are awaited without 
+blocking the event loop. `astream` yields each model's completion 
+piece by piece as it is decoded. 
+The models are declared in model_specs.yaml and only built on first use 
+(or by `warm_up`), so importing this package is cheap. 
+`fast_chain` does the same as `chain` (and `astream`) without the runnables 
+and their callbacks (see fast.py); the API uses it, `chain` is for experiments. 
+`route` picks the models worth running for a request (see routing.py); pass 
+them as `models` to only fan out to those. 
 '''
 
-from langchain_core.runnables import RunnableLambda
-from langchain_core.outputs import Generation
+import asyncio
+import os
+from contextlib import aclosing
+from typing import AsyncIterator, Optional, Tuple
 
-from .deepseek_base import llm_chain as deepseek
-# from .starcoder_2
+from langchain_core.runnables import RunnableLambda, RunnableParallel, RunnablePassthrough
+from langchain_core.outputs import Generation, GenerationChunk
 
-# models is a dict coerced to a RunnableParallel
-models = {
-    'deepseek-1.3b': deepseek.invoke
-}
+from .cache import CompletionCache
+from .fanout import TIMED_OUT, DeadlineFanOut
+from .postprocess import PostProcessor
+from .registry import DEFAULT_SPECS, ModelNotReady, ModelRegistry
+from .routing import DEFAULT_ROUTING, RoutingTable
 
-input_parser = RunnableLambda(
-    lambda x: {'prefix': x.prefix, 'suffix': x.suffix}
+# greedy completions are reused for identical prompt windows (see cache.py)
+completion_cache = CompletionCache(
+    max_entries=4096,   # ~ a few MB of completions + metadata
+    ttl_seconds=300,    # long enough for undo / cursor jitter, short enough to stay fresh
 )
 
-def output_handler(generations: dict[str, Generation]) -> dict[str, str]:
+# MODEL_SPECS=completion/model_specs.simulated.yaml runs the whole stack without a GPU
+model_registry = ModelRegistry.from_file(os.environ.get('MODEL_SPECS', DEFAULT_SPECS), completion_cache)
+# {name: LazyModel}, each being `context budget | prompt + stopping criteria | cached LLM` (see registry.py)
+models = model_registry.models
+
+# which models each language (or project, IDE, plugin version) is sent to, all of them by default
+model_routing = RoutingTable.from_file(os.environ.get('MODEL_ROUTING', DEFAULT_ROUTING), models)
+
+def route(
+    language: str, project_language: Optional[str] = None, ide: Optional[str] = None,
+    plugin_version: Optional[str] = None,
+) -> Optional[list[str]]:
+    ''' The models worth running for a request, None for all of them, [] for none (see routing.py). '''
+    return model_routing.route(language, project_language, ide, plugin_version)
+
+# session_id is only used to cache the tokenization of each session's file (see budget.py),
+# language and trigger pick the stopping criteria (see stopping.py), candidates is how many completions to sample, 
+# models limits the fan-out to the routed models (None for all of them), 
+# file_path and context_files (with their contents resolved) feed the repository context (see repo_context.py)
+def parse_input(x, models: Optional[list[str]] = None) -> dict:
+    return {
+        'prefix': x.prefix, 'suffix': x.suffix, 'session_id': x.session_id,
+        'language': x.language, 'trigger': x.trigger, 'models': models, 'candidates': x.candidates,
+        'file_path': x.file_path,
+        'context_files': [
+            {'path': f.path, 'content': f.content, 'hash': f.hash}
+            for f in x.context_files if f.content is not None
+        ],
+    }
+
+input_parser = RunnableLambda(parse_input)
+
+# all models share one latency budget, late or failing models don't hold up the rest (see fanout.py)
+fan_out = DeadlineFanOut(
+    models,
+    deadline_seconds=2.0,   # the plugin discards completions that arrive much later anyway
+    # manual requests are waited for, the others are dropped by the plugin once the user typed on
+    # (the server sets them from COMPLETION_DEADLINES, see set_deadlines)
+    trigger_deadlines={'man': 4.0, 'auto': 2.0, 'idle': 1.5},
+    failure_threshold=3,    # consecutive timeouts / errors before a model is taken out of the fan-out
+    cooldown_seconds=30,    # how long it stays out before a trial request
+)
+
+# trims what completions repeat from the suffix, drops the empty ones (see postprocess.py)
+post_processor = PostProcessor(
+    max_overlap=256,        # characters of the suffix an overlap may span
+)
+
+def handle_outputs(inputs: dict, generations: dict[str, Generation]) -> dict[str, Generation]:
     ''' 
-    Convert Generation into a string, and TODO: save each Generation to the database. 
+    Post-process each model's Generation and pass it on, so that its metadata reaches the response. 
+    TODO: save each Generation to the database. 
     NOTE: The pre-defined CRUD functions are nice and all, but doesn't it make 
     more sense to write them in parallel instead of serially? 
     (i.e. what's the overhead on calling db.commit()? )
     '''
-    return {model: generation.text for model, generation in generations.items()}
+    return post_processor(inputs, generations)
+
+output_handler = RunnableLambda(lambda outputs: handle_outputs(outputs['inputs'], outputs['generations']))
+
+# the post-processing needs the suffix, so the parsed input is passed along the fan-out
+chain = input_parser | RunnableParallel(inputs=RunnablePassthrough(), generations=fan_out) | output_handler
+
+
+async def astream(
+    gen_req, fast: bool = False, models: Optional[list[str]] = None
+) -> AsyncIterator[Tuple[str, GenerationChunk]]:
+    '''
+    Stream the completions of all models at once, yielding (model, chunk) pairs 
+    in the order the chunks are decoded. Concatenating a model's chunks gives its 
+    completion; its last chunk carries the generation metadata. Models that miss the 
+    deadline end with an empty chunk with status 'timed_out', like in the fan-out. 
+    With `fast`, through each model's fast path (see fast.py). 
+    '''
+    inputs = parse_input(gen_req, models)
+    async with aclosing(_astream_models(inputs, fast)) as chunks, \
+            aclosing(post_processor.astream(inputs, chunks)) as processed:
+        async for model, chunk in processed:
+            yield model, chunk
+
+
+async def _astream_models(inputs: dict, fast: bool) -> AsyncIterator[Tuple[str, GenerationChunk]]:
+    ''' The (model, chunk) pairs of `astream`, as decoded. '''
+    queue = asyncio.Queue()
+    deadline = fan_out.deadline(inputs)
+
+    async def pump(model: str, runnable):
+        breaker = fan_out.breaker(model)
+
+        async def forward():
+            async for chunk in (runnable.astream_fast(inputs) if fast else runnable.astream(inputs)):
+                await queue.put((model, chunk))
+
+        try:
+            await asyncio.wait_for(forward(), deadline)
+            breaker.record_success()
+        except asyncio.TimeoutError:
+            breaker.record_failure()
+            await queue.put((model, GenerationChunk(text='', generation_info={'status': TIMED_OUT})))
+        except ModelNotReady:
+            breaker.record_abandoned()  # left out of this stream, like in the fan-out
+        except asyncio.CancelledError:
+            breaker.record_abandoned()  # the stream was closed early, e.g. superseded
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+        finally:
+            await queue.put((model, None))
+
+    tasks = [
+        asyncio.create_task(pump(model, runnable))
+        for model, runnable in fan_out.selected(inputs).items()
+        if fan_out.breaker(model).allow()
+    ]
+    try:
+        running = len(tasks)
+        while running:
+            model, chunk = await queue.get()
+            if chunk is None:
+                running -= 1
+                continue
+            yield model, chunk
+        for task in tasks:
+            task.result()  # surface a model's failure to the caller
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class FastChain:
+    '''
+    `chain.ainvoke` and `astream` without the runnables and their callbacks (see fast.py). 
+    Same models, cache, circuit breakers and stats. 
+    '''
+
+    async def ainvoke(self, gen_req, models: Optional[list[str]] = None) -> dict[str, Generation]:
+        inputs = parse_input(gen_req, models)
+        return handle_outputs(inputs, await fan_out.ainvoke_fast(inputs))
+
+    def astream(self, gen_req, models: Optional[list[str]] = None) -> AsyncIterator[Tuple[str, GenerationChunk]]:
+        return astream(gen_req, fast=True, models=models)
+
+fast_chain = FastChain()
+
+
+def stats() -> dict[str, dict]:
+    ''' Counters of the completion pipeline, served by /api/v3/metrics. '''
+    return {
+        'completion_cache': completion_cache.stats(),
+        'models': model_registry.stats(),
+        'circuit_breakers': fan_out.stats(),
+        'routing': model_routing.stats(),
+        'post_processing': post_processor.stats(),
+    }
+
+
+def set_deadlines(deadlines: dict[str, float]):
+    ''' The fan-out's latency budget per trigger type, in seconds (see fanout.py). '''
+    fan_out.trigger_deadlines = dict(deadlines)
 
-output_handler = RunnableLambda(output_handler)
 
-chain = input_parser | models | output_handler
+def warm_up():
+    ''' Build all models ahead of their first request. Blocking, so run it in a thread. '''
+    model_registry.warm_up()
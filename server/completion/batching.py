@@ -0,0 +1,120 @@
+"""
+Cross-request micro-batching in front of a blocking engine.
+
+`vllm.LLM.generate` takes a list of prompts and decodes them together, but every
+HTTP request only brings one. The scheduler holds prompts from concurrent callers
+for a short window, submits them to the engine as one batch and hands each caller
+its own output. The engine is only ever called from the scheduler's worker thread,
+which also keeps the (not thread-safe) `vllm.LLM` away from concurrent callers.
+
+Cancelling a caller's future only drops its prompt while it waits for the window to
+close: `vllm.LLM.generate` cannot be interrupted, so a batch that started runs to the end.
+
+NOTE: this is only needed for the blocking engine. `AsyncLLMEngine`
+(`use_async_engine=True` in VLLM_M) already batches continuously across requests.
+"""
+
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, List, NamedTuple
+
+
+class PendingPrompt(NamedTuple):
+    prompt: str
+    sampling_params: Any
+    key: Hashable  # prompts are only batched with prompts that share sampling params
+    future: Future
+
+
+class MicroBatchScheduler:
+    """
+    Collects prompts for up to `max_wait_ms` (or until `max_batch_size` are pending)
+    and runs them through `generate_fn(prompts, sampling_params)` in a single call.
+    `generate_fn` must return one output per prompt, in order.
+    """
+
+    def __init__(
+        self,
+        generate_fn: Callable[[List[str], Any], List[Any]],
+        max_wait_ms: float = 5.0,
+        max_batch_size: int = 16,
+    ):
+        self.__generate_fn = generate_fn
+        self.__max_wait = max_wait_ms / 1000
+        self.__max_batch_size = max_batch_size
+        self.__pending: List[PendingPrompt] = []
+        self.__condition = threading.Condition()
+        self.__batch_count = 0
+        self.__prompt_count = 0
+        self.__largest_batch = 0
+        self.__worker = threading.Thread(
+            target=self.__run, name="micro-batch-scheduler", daemon=True
+        )
+        self.__worker.start()
+
+    def submit(self, prompt: str, sampling_params: Any, key: Hashable) -> Future:
+        """
+        Queue a prompt for the next batch. The returned future resolves to the engine's
+        output for this prompt; cancelling it before the batch starts drops the prompt.
+        """
+        future = Future()
+        with self.__condition:
+            self.__pending.append(PendingPrompt(prompt, sampling_params, key, future))
+            self.__condition.notify()
+        return future
+
+    def stats(self) -> dict:
+        with self.__condition:
+            return {
+                "batches": self.__batch_count,
+                "prompts": self.__prompt_count,
+                "mean_batch_size": self.__prompt_count / max(self.__batch_count, 1),
+                "largest_batch": self.__largest_batch,
+                "pending": len(self.__pending),
+            }
+
+    def __next_batch(self) -> List[PendingPrompt]:
+        """Block until a batch is ready: the window has elapsed or the batch is full."""
+        with self.__condition:
+            while not self.__pending:
+                self.__condition.wait()
+            deadline = time.monotonic() + self.__max_wait
+            while len(self.__pending) < self.__max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.__condition.wait(remaining)
+            batch = self.__pending[: self.__max_batch_size]
+            del self.__pending[: self.__max_batch_size]
+            return batch
+
+    def __run(self):
+        while True:
+            batch = self.__next_batch()
+
+            groups: dict[Hashable, List[PendingPrompt]] = {}
+            for item in batch:
+                # skip callers that gave up while waiting for the window to close
+                if item.future.set_running_or_notify_cancel():
+                    groups.setdefault(item.key, []).append(item)
+
+            for items in groups.values():
+                self.__run_group(items)
+
+    def __run_group(self, items: List[PendingPrompt]):
+        try:
+            outputs = self.__generate_fn(
+                [item.prompt for item in items], items[0].sampling_params
+            )
+        except Exception as e:
+            for item in items:
+                item.future.set_exception(e)
+            return
+
+        with self.__condition:
+            self.__batch_count += 1
+            self.__prompt_count += len(items)
+            self.__largest_batch = max(self.__largest_batch, len(items))
+        for item, output in zip(items, outputs):
+            item.future.set_result(output)
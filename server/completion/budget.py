@@ -0,0 +1,131 @@
+"""
+Tokenizer-aware context budgeting.
+
+The plugin sends the whole file around the cursor, which can exceed the model's
+`max_model_len` and in any case spends prefill compute on code far away from the
+cursor. `ContextBudget` keeps the `max_tokens` tokens nearest the cursor, split
+between prefix and suffix by `prefix_ratio`, and cuts at line boundaries so the
+model never sees half a line at the edge of its context.
+
+Token counts are kept per line and per session: as the user types, only the lines
+that changed (usually just the cursor line) are tokenized again.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class ContextBudget:
+    """
+    Trims the `prefix`/`suffix` of the chain's input dict to a token budget. Use it as
+    a chain stage (RunnableLambda) in front of the prompt template.
+    Whatever the suffix does not use of its share is given to the prefix.
+    """
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        max_tokens: int = 4096,
+        prefix_ratio: float = 0.75,
+        max_sessions: int = 512,
+        max_lines_per_session: int = 50_000,
+    ):
+        assert (
+            0 <= prefix_ratio <= 1
+        ), "prefix_ratio is the share of the budget for the prefix"
+        self.__count_tokens = count_tokens
+        self.__max_tokens = max_tokens
+        self.__prefix_ratio = prefix_ratio
+        self.__max_sessions = max_sessions
+        self.__max_lines_per_session = max_lines_per_session
+        self.__sessions: OrderedDict[Optional[str], Dict[str, int]] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__tokenized_lines = 0
+        self.__reused_lines = 0
+        self.__trimmed_requests = 0
+
+    def __call__(self, inputs: dict) -> dict:
+        counts = self.__line_counts(inputs.get("session_id"))
+        suffix_budget = self.__max_tokens - round(
+            self.__max_tokens * self.__prefix_ratio
+        )
+        suffix, suffix_tokens = self.__take(
+            inputs["suffix"], suffix_budget, counts, keep_end=False
+        )
+        prefix, _ = self.__take(
+            inputs["prefix"], self.__max_tokens - suffix_tokens, counts, keep_end=True
+        )
+
+        if len(prefix) < len(inputs["prefix"]) or len(suffix) < len(inputs["suffix"]):
+            with self.__lock:
+                self.__trimmed_requests += 1
+        return {**inputs, "prefix": prefix, "suffix": suffix}
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "sessions": len(self.__sessions),
+                "tokenized_lines": self.__tokenized_lines,
+                "reused_lines": self.__reused_lines,
+                "trimmed_requests": self.__trimmed_requests,
+            }
+
+    def __line_counts(self, session_id: Optional[str]) -> Dict[str, int]:
+        """The token count cache of this session (least recently used sessions are dropped)."""
+        with self.__lock:
+            counts = self.__sessions.pop(session_id, None)
+            if counts is None or len(counts) > self.__max_lines_per_session:
+                counts = {}
+            self.__sessions[session_id] = counts
+            while len(self.__sessions) > self.__max_sessions:
+                self.__sessions.popitem(last=False)
+            return counts
+
+    def __count(self, line: str, counts: Dict[str, int]) -> int:
+        n = counts.get(line)
+        if n is None:
+            n = counts[line] = self.__count_tokens(line)
+            with self.__lock:
+                self.__tokenized_lines += 1
+        else:
+            with self.__lock:
+                self.__reused_lines += 1
+        return n
+
+    def __take(
+        self, text: str, budget: int, counts: Dict[str, int], keep_end: bool
+    ) -> Tuple[str, int]:
+        """
+        Take whole lines starting from the cursor (the end of the prefix, the start of the suffix)
+        until the next one would exceed the budget. Returns the kept text and its token count.
+        """
+        if not text or budget <= 0:
+            return "", 0
+        lines = text.splitlines(keepends=True)
+        if keep_end:
+            lines.reverse()
+
+        # the line the cursor is on is always kept, cut by characters only if it alone is over budget
+        cursor_line = lines[0]
+        used = self.__count(cursor_line, counts)
+        if used > budget:
+            n_chars = len(cursor_line) * budget // used
+            cursor_line = (
+                cursor_line[len(cursor_line) - n_chars :]
+                if keep_end
+                else cursor_line[:n_chars]
+            )
+            used = budget
+
+        kept: List[str] = [cursor_line]
+        for line in lines[1:]:
+            n = self.__count(line, counts)
+            if used + n > budget:
+                break
+            kept.append(line)
+            used += n
+
+        if keep_end:
+            kept.reverse()
+        return "".join(kept), used
@@ -0,0 +1,205 @@
+"""
+Deterministic completion cache.
+
+With greedy decoding (temperature=0) the same prompt and sampling parameters
+always produce the same completion, yet cursor jitter, undo and plugin retries
+keep sending identical prompts. `CachedModel` sits between the prompt template and
+the LLM, so the key is exactly the prompt window the engine would see, and answers
+repeats from a bounded in-memory LRU cache with a TTL.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+from langchain_core.language_models.llms import BaseLLM
+from langchain_core.outputs import Generation, GenerationChunk
+from langchain_core.runnables import Runnable, RunnableConfig
+
+
+class CompletionCache:
+    """
+    Thread-safe LRU cache of Generations with a time-to-live per entry.
+    """
+
+    def __init__(self, max_entries: int = 4096, ttl_seconds: float = 300.0):
+        self.__max_entries = max_entries
+        self.__ttl = ttl_seconds
+        self.__entries: OrderedDict[str, tuple[float, Generation]] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__expirations = 0
+
+    @staticmethod
+    def key(model: str, prompt: str, params: Dict[str, Any]) -> str:
+        """Hash of everything that determines a greedy completion."""
+        payload = json.dumps([model, prompt, params], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Generation]:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.__ttl:
+                del self.__entries[key]
+                self.__expirations += 1
+                entry = None
+            if entry is None:
+                self.__misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.__hits += 1
+            return entry[1]
+
+    def put(self, key: str, generation: Generation):
+        with self.__lock:
+            self.__entries[key] = (time.monotonic(), generation)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+                self.__evictions += 1
+
+    def stats(self) -> dict:
+        with self.__lock:
+            lookups = self.__hits + self.__misses
+            return {
+                "size": len(self.__entries),
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "hit_rate": self.__hits / lookups if lookups else 0.0,
+                "evictions": self.__evictions,
+                "expirations": self.__expirations,
+            }
+
+
+class CachedModel(Runnable):
+    """
+    Wraps an LLM (VLLM_M) so that repeated prompts are served from `cache` without
+    touching the engine. Hits come back with `generation_info['cached'] = True`.
+    Only greedy models are cached, as sampled completions are not reproducible.
+    `params` are sampling parameters passed on every call, overriding the LLM's defaults
+    (so that several models can share one engine); per-call keyword arguments (e.g. the
+    stopping criteria of a request) override those in turn and are part of the key.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        llm: BaseLLM,
+        cache: CompletionCache,
+        params: Optional[Dict[str, Any]] = None,
+    ):
+        self.name = name
+        self.llm = llm
+        self.cache = cache
+        self.params = params or {}
+
+    def _prompt(self, input: Any) -> str:
+        return (
+            input
+            if isinstance(input, str)
+            else self.llm._convert_input(input).to_string()
+        )
+
+    def _key(self, prompt: str, kwargs: Dict[str, Any]) -> Optional[str]:
+        params = {**self.llm._default_params, **self.params, **kwargs}
+        if params.get("temperature") != 0:
+            return None
+        return self.cache.key(self.name, prompt, params)
+
+    def _lookup(self, key: Optional[str]) -> Optional[Generation]:
+        hit = self.cache.get(key) if key is not None else None
+        if hit is None:
+            return None
+        return Generation(
+            text=hit.text,
+            generation_info={**(hit.generation_info or {}), "cached": True},
+        )
+
+    def _direct_params(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        # what BaseLLM.agenerate_prompt would pass to `_agenerate`, minus the run manager
+        params = {**self.params, **kwargs}
+        params.setdefault("stop", None)
+        return params
+
+    def invoke(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> Generation:
+        key = self._key(self._prompt(input), kwargs)
+        if (hit := self._lookup(key)) is not None:
+            return hit
+        generation = self.llm.invoke(input, config, **{**self.params, **kwargs})
+        if key is not None:
+            self.cache.put(key, generation)
+        return generation
+
+    async def ainvoke(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> Generation:
+        key = self._key(self._prompt(input), kwargs)
+        if (hit := self._lookup(key)) is not None:
+            return hit
+        generation = await self.llm.ainvoke(input, config, **{**self.params, **kwargs})
+        if key is not None:
+            self.cache.put(key, generation)
+        return generation
+
+    async def agenerate(self, prompt: str, **kwargs: Any) -> Generation:
+        """
+        `ainvoke` of a formatted prompt that calls the LLM's `_agenerate` directly, i.e. without
+        LangChain's callback managers and run tracing (see fast.py). Same cache, same keys.
+        """
+        key = self._key(prompt, kwargs)
+        if (hit := self._lookup(key)) is not None:
+            return hit
+        generation = (
+            await self.llm._agenerate([prompt], **self._direct_params(kwargs))
+        ).generations[0][0]
+        if key is not None:
+            self.cache.put(key, generation)
+        return generation
+
+    async def astream(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AsyncIterator[GenerationChunk]:
+        async for chunk in self.__astream(
+            self._prompt(input),
+            kwargs,
+            lambda: self.llm.astream(input, config, **{**self.params, **kwargs}),
+        ):
+            yield chunk
+
+    async def astream_prompt(
+        self, prompt: str, **kwargs: Any
+    ) -> AsyncIterator[GenerationChunk]:
+        """`astream` of a formatted prompt through the LLM's `_astream`, see `agenerate`."""
+        async for chunk in self.__astream(
+            prompt,
+            kwargs,
+            lambda: self.llm._astream(prompt, **self._direct_params(kwargs)),
+        ):
+            yield chunk
+
+    async def __astream(
+        self,
+        prompt: str,
+        kwargs: Dict[str, Any],
+        stream: Callable[[], AsyncIterator[GenerationChunk]],
+    ) -> AsyncIterator[GenerationChunk]:
+        key = self._key(prompt, kwargs)
+        if (hit := self._lookup(key)) is not None:
+            yield GenerationChunk(text=hit.text, generation_info=hit.generation_info)
+            return
+
+        text, generation_info = "", None
+        async for chunk in stream():
+            text += chunk.text
+            generation_info = chunk.generation_info or generation_info
+            yield chunk
+        # only reached if the stream ran to the end, so aborted generations are never cached
+        if key is not None:
+            self.cache.put(key, Generation(text=text, generation_info=generation_info))
@@ -0,0 +1,43 @@
+"""
+Log probabilities and confidence of a completion.
+
+vLLM returns, for every generated token, a dict of the top candidates' Logprob objects.
+Only the logprob of the token that was actually chosen is stored, so `chosen_logprobs`
+reduces them to one packed float32 array as soon as the generation is done, instead of
+carrying the dicts through the chain, the cache and the session.
+Requests for several candidates (the engine's `n`) rank them by `candidate`'s score.
+"""
+
+import math
+from array import array
+from typing import Any, Dict, Optional, Sequence
+
+
+def chosen_logprobs(
+    token_ids: Sequence[int], logprobs: Optional[Sequence[Dict[int, Any]]]
+) -> Optional[array]:
+    """The logprob of every generated token as array('f'), or None if the model returned no logprobs."""
+    if logprobs is None:
+        return None
+    return array(
+        "f", [step[token_id].logprob for token_id, step in zip(token_ids, logprobs)]
+    )
+
+
+def confidence(logprobs: Optional[array]) -> Optional[float]:
+    """The geometric mean of the token probabilities, i.e. exp(mean logprob), or None if unknown."""
+    if not logprobs:
+        return None
+    return math.exp(sum(logprobs) / len(logprobs))
+
+
+def candidate(
+    text: str, token_ids: Sequence[int], cumulative_logprob: Optional[float]
+) -> Dict[str, Any]:
+    """One of the sequences of a request, scored by its mean logprob (comparable across lengths, unlike the sum)."""
+    score = (
+        cumulative_logprob / len(token_ids)
+        if token_ids and cumulative_logprob is not None
+        else None
+    )
+    return {"text": text, "score": score}
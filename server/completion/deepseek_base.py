@@ -34,10 +34,6 @@ in a MoE model, so I leave that for later. The V1-6.7B model seems ideal in term
 To best leverage FIM, we should use a Base model (as opposed to Instruct). 
 '''
 
-from langchain_core.prompts import PromptTemplate
-from .vllm_modified import VLLM_M 
-# TODO: consider changing relative import to absolute by importing server as package
-
 '''
 TEMPLATES. DeepSeek-Coder (v1) base models are finetuned on two 
 (disjoint) types of completion. 
@@ -45,14 +41,11 @@ TEMPLATES. DeepSeek-Coder (v1) base models are finetuned on two
 1. Code Insertion (FIM)
 2. Repo-level Code Completion 
 
-# TODO: Repo-level code completion is useful with RAG. 
-# I'm sticking to FIM for now. 
+Both are combined in model_specs.yaml: the other files of the project that the plugin 
+sends along (each after a `# path` comment, as in repo-level completion) go in front of 
+the FIM prefix, packed within a token budget by repo_context.py. 
 '''
 
-# not the actual | characters, but U+ff5c
-template = '''<｜fim▁begin｜>{prefix}<｜fim▁hole｜>{suffix}<｜fim▁end｜>'''
-prompt = PromptTemplate.from_template(template)
-
 ''' 
 VLLM Engine. Supported features: 
 1. Tensor parallelism (multi-GPU inference)
@@ -60,26 +53,7 @@ VLLM Engine. Supported features:
     see https://github.com/mit-han-lab/llm-awq)
 3. Automatic Prefix Caching (APC) for long-document queries 
     and multi-round conversation. 
-'''
-
-llm = VLLM_M(
-    model='deepseek-ai/deepseek-coder-1.3b-base',
-    trust_remote_code=True, 
 
-    logprobs=1, # TODO: this variable is not used at all...
-
-    # HYPERPARAMETERS (FOR AB STUDYYYYY)
-    vllm_kwargs=dict(
-        max_model_len= 10_000,          # default 65536 at 0.9 utilisation
-        quantization = None,            # awq, gptq, squeezellm, and fp8
-        gpu_memory_utilization = 0.9,   # default
-        swap_space = 4,                 # swap space in GiB to use when 'best_of' sampling > 1
-        enforce_eager = False,          # use CUDA Graphs to reduce CPU-GPU communication: https://pytorch.org/blog/accelerating-pytorch-with-cuda-graphs/
-        max_seq_len_to_capture = 8192,  # Max seq length covered by CUDA graph. Larger falls back to eager mode.
-    ),           
-    temperature=0,          # default 1.0. how random the generations are 
-    top_p=0.25,             # what percentage of tokens to consider 
-    presence_penalty=1.0    # penalise new tokens based on their frequency in the generated text so far
-)
-
-llm_chain = prompt | llm 
+The template, engine and hyperparameters of deepseek-1.3b are declared in 
+model_specs.yaml, and the engine is built by the registry (registry.py) on first use. 
+'''
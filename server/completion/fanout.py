@@ -0,0 +1,227 @@
+"""
+Deadline-aware fan-out over the models.
+
+A plain RunnableParallel waits for the slowest model, and a single failing model
+fails the whole request. `DeadlineFanOut` gives all models one shared latency
+budget: whatever finished by then is returned, the rest are cancelled (which
+aborts them in the engine) and reported as timed out. The budget depends on the
+request's trigger: a user who asked for a completion waits longer for it than for
+one that pops up while typing.
+
+Models that keep timing out or failing are taken out of the fan-out for a while
+by their `CircuitBreaker`, so they stop costing every request the full deadline.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from langchain_core.outputs import Generation
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from .registry import ModelNotReady
+
+logger = logging.getLogger(__name__)
+
+TIMED_OUT = "timed_out"
+
+
+class CircuitBreaker:
+    """
+    closed -> the model is used.
+    open -> the model failed `failure_threshold` times in a row and is skipped for `cooldown_seconds`.
+    half-open -> the cool-down is over; one trial request decides whether to close or open again.
+    """
+
+    def __init__(self, failure_threshold: int = 3, cooldown_seconds: float = 30.0):
+        self.__failure_threshold = failure_threshold
+        self.__cooldown = cooldown_seconds
+        self.__lock = threading.Lock()
+        self.__state = "closed"
+        self.__consecutive_failures = 0
+        self.__opened_at = 0.0
+        self.__trips = 0
+        self.__rejected = 0
+
+    def allow(self) -> bool:
+        with self.__lock:
+            if (
+                self.__state == "open"
+                and time.monotonic() - self.__opened_at >= self.__cooldown
+            ):
+                self.__state = "half-open"
+                return True  # the trial request
+            if self.__state == "closed":
+                return True
+            self.__rejected += 1
+            return False
+
+    def record_success(self):
+        with self.__lock:
+            self.__state = "closed"
+            self.__consecutive_failures = 0
+
+    def record_abandoned(self):
+        """The call ended without telling whether the model works (cancelled, still loading)."""
+        with self.__lock:
+            # if it was the trial, the next request is the trial instead
+            if self.__state == "half-open":
+                self.__state = "open"
+                self.__opened_at = time.monotonic() - self.__cooldown
+
+    def record_failure(self):
+        with self.__lock:
+            self.__consecutive_failures += 1
+            if (
+                self.__state == "half-open"
+                or self.__consecutive_failures >= self.__failure_threshold
+            ):
+                if self.__state != "open":
+                    self.__trips += 1
+                self.__state = "open"
+                self.__opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "state": self.__state,
+                "consecutive_failures": self.__consecutive_failures,
+                "trips": self.__trips,
+                "rejected": self.__rejected,
+            }
+
+
+class DeadlineFanOut(Runnable):
+    """
+    Runs the same input through every model (of `input['models']` if given, and whose breaker allows it)
+    concurrently and returns {model: Generation} after at most the deadline of `input['trigger']` in
+    `trigger_deadlines`, `deadline_seconds` for other triggers. Models that did not finish in time are
+    returned as an empty Generation with `generation_info['status'] == 'timed_out'`; models that
+    failed, are still loading or were skipped by their breaker are left out.
+    """
+
+    def __init__(
+        self,
+        models: Dict[str, Runnable],
+        deadline_seconds: float,
+        trigger_deadlines: Optional[Dict[str, float]] = None,
+        failure_threshold: int = 3,
+        cooldown_seconds: float = 30.0,
+    ):
+        self.models = models  # not copied, models can be added later
+        self.deadline_seconds = deadline_seconds
+        self.trigger_deadlines = dict(trigger_deadlines or {})
+        self.__failure_threshold = failure_threshold
+        self.__cooldown = cooldown_seconds
+        self.__breakers: Dict[str, CircuitBreaker] = {}
+        self.__lock = threading.Lock()
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        with self.__lock:
+            if model not in self.__breakers:
+                self.__breakers[model] = CircuitBreaker(
+                    self.__failure_threshold, self.__cooldown
+                )
+            return self.__breakers[model]
+
+    def selected(self, input: Any) -> Dict[str, Runnable]:
+        """The models the input is routed to (see routing.py), all of them unless it names some."""
+        names = input.get("models") if isinstance(input, dict) else None
+        if names is None:
+            return self.models
+        return {
+            model: runnable for model, runnable in self.models.items() if model in names
+        }
+
+    def deadline(self, input: Any) -> float:
+        """The latency budget of the input's trigger, in seconds."""
+        trigger = input.get("trigger") if isinstance(input, dict) else None
+        return self.trigger_deadlines.get(trigger, self.deadline_seconds)
+
+    def invoke(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> Dict[str, Generation]:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.ainvoke(input, config, **kwargs))
+        # called from async code, whose loop cannot run another one: fan out on a loop of its own
+        with ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="fan-out"
+        ) as executor:
+            return executor.submit(
+                asyncio.run, self.ainvoke(input, config, **kwargs)
+            ).result()
+
+    async def ainvoke(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> Dict[str, Generation]:
+        return await self.__fan_out(
+            input, lambda runnable: runnable.ainvoke(input, config, **kwargs)
+        )
+
+    async def ainvoke_fast(self, input: Any) -> Dict[str, Generation]:
+        """`ainvoke` through the models' fast paths (LazyModel.ainvoke_fast, see fast.py)."""
+        return await self.__fan_out(
+            input, lambda runnable: runnable.ainvoke_fast(input)
+        )
+
+    async def __fan_out(
+        self, input: Any, call: Callable[[Runnable], Awaitable[Generation]]
+    ) -> Dict[str, Generation]:
+        selected = self.selected(input)
+        deadline = self.deadline(input)
+        tasks = {
+            asyncio.ensure_future(call(runnable)): model
+            for model, runnable in selected.items()
+            if self.breaker(model).allow()
+        }
+        if not tasks:
+            if selected:
+                logger.warning("All models are cut off by their circuit breaker.")
+            return {}
+
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=deadline)
+        except asyncio.CancelledError:
+            # e.g. superseded: a breaker's trial must not be left hanging in half-open
+            for model in tasks.values():
+                self.breaker(model).record_abandoned()
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()  # no-op for finished ones; aborts the generation of late ones
+
+        generations, errors = {}, []
+        for task, model in tasks.items():
+            if task in pending:
+                self.breaker(model).record_failure()
+                logger.warning(f"{model} missed the {deadline}s deadline.")
+                generations[model] = Generation(
+                    text="", generation_info={"status": TIMED_OUT}
+                )
+            elif task.cancelled() or isinstance(task.exception(), ModelNotReady):
+                logger.info(f"{model} is still loading or was cancelled.")
+                # not the model's fault, so the breaker only lets the next request try
+                self.breaker(model).record_abandoned()
+                if not task.cancelled():
+                    errors.append(task.exception())
+            elif task.exception() is not None:
+                self.breaker(model).record_failure()
+                logger.error(f"{model} failed: {task.exception()}")
+                errors.append(task.exception())
+            else:
+                self.breaker(model).record_success()
+                generations[model] = task.result()
+
+        if errors and len(errors) == len(tasks):
+            raise errors[0]  # nothing to return at all
+        return generations
+
+    def stats(self) -> dict:
+        with self.__lock:
+            breakers = dict(self.__breakers)
+        return {model: breaker.stats() for model, breaker in breakers.items()}
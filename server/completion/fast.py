@@ -0,0 +1,67 @@
+"""
+LangChain-free fast path.
+
+Through the chain, every request goes RunnableLambda -> DeadlineFanOut -> RunnableSequence
+(budget | StoppingModel) -> PromptTemplate -> BaseLLM.agenerate_prompt, each step setting up
+callback managers and run tracing, all to format one FIM template and call the engine.
+`FastModel` runs the same steps of a model as plain calls, sharing the budget, stopping
+criteria, cache and engine with the model's chain:
+
+    ContextBudget -> RepoContext -> StoppingModel.params -> PromptTokenizer -> CachedModel.agenerate -> StoppingModel.finish
+
+so both paths give the same completions (and cache keys), but only the fast path hands the
+engine prompts it tokenized already, incrementally per session (see prompt_tokens.py). The API
+uses the fast path (`completion.fast_chain`); the chain stays for experiments, e.g. tracing or
+composing it with other runnables. benchmarks/chain_overhead.py measures the CPU time per
+request of both.
+"""
+
+from typing import Any, AsyncIterator, Callable, Dict
+
+from langchain_core.outputs import Generation, GenerationChunk
+
+from .cache import CachedModel
+from .stopping import StoppingModel
+
+
+def format_prompt(template: str, inputs: Dict[str, Any]) -> str:
+    """What PromptTemplate.from_template(template) formats, for the variables of a FIM template."""
+    return template.format(
+        prefix=inputs["prefix"],
+        suffix=inputs["suffix"],
+        context=inputs.get("context", ""),
+        file_header=inputs.get("file_header", ""),
+    )
+
+
+class FastModel:
+    """
+    The pipeline of a LazyModel (context budget and repository context | prompt + stopping criteria |
+    cached LLM) as plain calls. `prepare` runs the stages in front of the prompt on the input dict,
+    `prompt` formats it (e.g. a PromptTokenizer).
+    """
+
+    def __init__(
+        self,
+        prepare: Callable[[Dict[str, Any]], Dict[str, Any]],
+        prompt: Callable[[Dict[str, Any]], str],
+        stopping: StoppingModel,
+        model: CachedModel,
+    ):
+        self.prepare = prepare
+        self.prompt = prompt
+        self.stopping = stopping
+        self.model = model
+
+    async def ainvoke(self, input: Dict[str, Any]) -> Generation:
+        inputs = self.prepare(input)
+        params = self.stopping.params(inputs)
+        generation = await self.model.agenerate(self.prompt(inputs), **params)
+        return self.stopping.finish(inputs, generation.text, generation.generation_info)
+
+    async def astream(self, input: Dict[str, Any]) -> AsyncIterator[GenerationChunk]:
+        inputs = self.prepare(input)
+        params = self.stopping.params(inputs)
+        chunks = self.model.astream_prompt(self.prompt(inputs), **params)
+        async for chunk in self.stopping.trim_stream(inputs, chunks):
+            yield chunk
@@ -0,0 +1,249 @@
+"""
+Post-processing of the completions, before they are returned or stored.
+
+FIM models often generate text that is already right after the cursor: the closing paren,
+the rest of the line, the next statement. Shown as is, the plugin would duplicate that code.
+`PostProcessor` trims the longest overlap between the end of a completion and the start of the
+suffix, found in linear time with the KMP failure function of the suffix's head, and drops
+completions that are empty or only whitespace (after trimming), so that they are neither sent
+nor stored.
+
+An overlap is only trimmed if it does not start in the middle of a word of the completion or
+end in the middle of a word of the suffix: `item` + suffix `s = []` is a new identifier, not a
+repeated `s`. The next longest overlap is tried instead.
+
+Streams are trimmed as they go: while a model decodes, only the longest end of its text that
+could still be the start of an overlap is held back, everything before it is passed on (once
+it is more than whitespace).
+
+The candidates of a request for several (`generation_info['candidates']`) are trimmed the same
+way, then the empty and duplicate ones are dropped and the rest is ranked by score. As they are
+sampled, the engine's first sequence is not the best one: the completion is the top-ranked
+candidate, so a stream for several candidates is held back until all of them are decoded.
+"""
+
+import threading
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from langchain_core.outputs import Generation, GenerationChunk
+
+DEFAULT_MAX_OVERLAP = (
+    256  # characters of the suffix to match, overlaps are rarely more than a few lines
+)
+
+
+def failure_function(pattern: str) -> List[int]:
+    """For every prefix of `pattern`, the length of its longest proper prefix that is also its suffix."""
+    failure = [0] * len(pattern)
+    k = 0
+    for i in range(1, len(pattern)):
+        while k and pattern[i] != pattern[k]:
+            k = failure[k - 1]
+        if pattern[i] == pattern[k]:
+            k += 1
+        failure[i] = k
+    return failure
+
+
+def _is_word(c: str) -> bool:
+    return c.isalnum() or c == "_"
+
+
+class SuffixOverlap:
+    """
+    Matches a completion, fed piece by piece, against the head of the suffix. `state` is the
+    length of the longest end of the completion so far that is a start of the suffix.
+    """
+
+    def __init__(
+        self,
+        suffix: str,
+        failure: Optional[List[int]] = None,
+        max_overlap: int = DEFAULT_MAX_OVERLAP,
+    ):
+        self.suffix = suffix
+        self.pattern = suffix[:max_overlap]
+        self.failure = (
+            failure if failure is not None else failure_function(self.pattern)
+        )
+        self.text = ""
+        self.state = 0
+
+    def feed(self, text: str):
+        pattern, failure, k = self.pattern, self.failure, self.state
+        if pattern:
+            for c in text:
+                if k == len(pattern):
+                    k = failure[k - 1]
+                while k and c != pattern[k]:
+                    k = failure[k - 1]
+                if c == pattern[k]:
+                    k += 1
+        self.text += text
+        self.state = k
+
+    def __at_word_boundaries(self, k: int) -> bool:
+        start = len(self.text) - k
+        if start > 0 and _is_word(self.text[start - 1]) and _is_word(self.text[start]):
+            return False
+        if (
+            k < len(self.suffix)
+            and _is_word(self.suffix[k - 1])
+            and _is_word(self.suffix[k])
+        ):
+            return False
+        return True
+
+    def overlap(self) -> int:
+        """The length of the overlap to trim: the longest one at word boundaries."""
+        k = self.state
+        while k and not self.__at_word_boundaries(k):
+            k = self.failure[k - 1]
+        return k
+
+
+def suffix_overlap(
+    completion: str, suffix: str, max_overlap: int = DEFAULT_MAX_OVERLAP
+) -> int:
+    """The number of characters at the end of `completion` that repeat the start of `suffix`."""
+    matcher = SuffixOverlap(suffix, max_overlap=max_overlap)
+    matcher.feed(completion)
+    return matcher.overlap()
+
+
+class PostProcessor:
+    """
+    Trims the suffix overlap of every model's completion and drops the empty ones. Generations
+    with a `status` (e.g. timed out) are passed on as they are. Adds `trimmed_overlap` (characters
+    trimmed) to the generation info.
+    """
+
+    def __init__(self, max_overlap: int = DEFAULT_MAX_OVERLAP):
+        self.__max_overlap = max_overlap
+        self.__lock = threading.Lock()
+        self.__completions = 0
+        self.__trimmed_completions = 0
+        self.__trimmed_chars = 0
+        self.__dropped_empty = 0
+
+    def __count(self, trimmed: int, dropped: bool):
+        with self.__lock:
+            self.__completions += 1
+            self.__trimmed_completions += trimmed > 0
+            self.__trimmed_chars += trimmed
+            self.__dropped_empty += dropped
+
+    def __matcher(
+        self, inputs: dict, failure: Optional[List[int]] = None
+    ) -> SuffixOverlap:
+        return SuffixOverlap(inputs.get("suffix") or "", failure, self.__max_overlap)
+
+    def __candidates(
+        self, inputs: dict, failure: List[int], candidates: List[Dict[str, Any]]
+    ) -> List[Dict[str, Any]]:
+        """The distinct, non-empty candidates after trimming, best first."""
+        distinct = {}
+        # unscored candidates last, the sort is stable so the engine's order breaks ties
+        for candidate in sorted(
+            candidates, key=lambda c: (c["score"] is None, -(c["score"] or 0.0))
+        ):
+            matcher = self.__matcher(inputs, failure)
+            matcher.feed(candidate["text"])
+            text = candidate["text"][: len(candidate["text"]) - matcher.overlap()]
+            if (
+                text.strip() and text not in distinct
+            ):  # a duplicate keeps the best score
+                distinct[text] = {**candidate, "text": text}
+        return list(distinct.values())
+
+    def __finish(
+        self,
+        inputs: dict,
+        failure: List[int],
+        matcher: SuffixOverlap,
+        generation_info: dict,
+    ) -> Tuple[str, dict]:
+        """The trimmed completion and its generation info, the top-ranked candidate if there are several."""
+        trimmed = matcher.overlap()
+        text = matcher.text[: len(matcher.text) - trimmed]
+        generation_info = {**generation_info, "trimmed_overlap": trimmed}
+        if generation_info.get("candidates"):
+            generation_info["candidates"] = self.__candidates(
+                inputs, failure, generation_info["candidates"]
+            )
+            if generation_info["candidates"]:
+                text = generation_info["candidates"][0]["text"]
+        self.__count(trimmed, dropped=not text.strip())
+        return text, generation_info
+
+    def __call__(
+        self, inputs: dict, generations: Dict[str, Generation]
+    ) -> Dict[str, Generation]:
+        processed = {}
+        failure = self.__matcher(
+            inputs
+        ).failure  # the suffix is the same for every model
+        for model, generation in generations.items():
+            generation_info = generation.generation_info or {}
+            if generation_info.get("status"):
+                processed[model] = generation
+                continue
+            matcher = self.__matcher(inputs, failure)
+            matcher.feed(generation.text)
+            text, generation_info = self.__finish(
+                inputs, failure, matcher, generation_info
+            )
+            if text.strip():
+                processed[model] = Generation(
+                    text=text, generation_info=generation_info
+                )
+        return processed
+
+    async def astream(
+        self, inputs: dict, chunks: AsyncIterator[Tuple[str, GenerationChunk]]
+    ) -> AsyncIterator[Tuple[str, GenerationChunk]]:
+        """
+        `__call__` for the (model, chunk) pairs of `completion.astream`. A model's chunks are held
+        back until what cannot be trimmed any more is more than whitespace, so that nothing is sent
+        of a completion that ends up empty.
+        Of a request for several candidates, only the top-ranked one is sent, with the last chunk.
+        """
+        failure = self.__matcher(inputs).failure
+        ranked = (inputs.get("candidates") or 1) > 1
+        matchers: Dict[str, SuffixOverlap] = {}
+        sent: Dict[str, int] = {}
+        async for model, chunk in chunks:
+            matcher = matchers.get(model)
+            if matcher is None:
+                matcher = matchers[model] = self.__matcher(inputs, failure)
+                sent[model] = 0
+            matcher.feed(chunk.text)
+            if chunk.generation_info is None:
+                if ranked:
+                    continue
+                # pass on what can no longer be part of an overlap, once it is more than whitespace
+                safe = len(matcher.text) - matcher.state
+                if safe > sent[model] and matcher.text[:safe].strip():
+                    yield model, GenerationChunk(text=matcher.text[sent[model] : safe])
+                    sent[model] = safe
+                continue
+            if chunk.generation_info.get("status"):
+                yield model, chunk  # e.g. timed out, passed on as is like in __call__
+                continue
+            # the last chunk, with the metadata
+            text, generation_info = self.__finish(
+                inputs, failure, matcher, chunk.generation_info
+            )
+            if text.strip():
+                yield model, GenerationChunk(
+                    text=text[sent[model] :], generation_info=generation_info
+                )
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "completions": self.__completions,
+                "trimmed_completions": self.__trimmed_completions,
+                "trimmed_chars": self.__trimmed_chars,
+                "dropped_empty": self.__dropped_empty,
+            }
@@ -0,0 +1,421 @@
+"""
+Incremental tokenization of the prompt, per session.
+
+Given a text prompt, vLLM tokenizes all of it, yet as the user types, consecutive prompts of a
+session are the same window around the cursor a few characters apart. `PromptTokenizer` keeps
+the tokens of the last prompt of every session and only tokenizes again what changed, passing
+the engine the token ids (`TokenizedPrompt`) rather than text to tokenize.
+
+The literals of the FIM template (its special tokens) split the prompt into segments that are
+tokenized independently, e.g. `{context}{file_header}{prefix}` and `{suffix}`. That only holds
+if the tokenizer never merges a literal with the text around it, which is checked with a few
+probes on first use; for templates that fail it, prompts are left as text.
+
+A segment changes at the cursor (the end of the prefix, the start of the suffix), at its far
+edge (where the context budget drops or adds whole lines) and wherever the repository context
+changed. Every change is spliced into the old tokens: those up to a token boundary `margin`
+characters before the change are kept, and so are those from `margin` characters after it;
+only the text in between is tokenized again. Pre-tokenizers split on whitespace and character
+classes and merges never cross those splits, so the tokens of the unchanged margins must come
+out the same as before. They are compared, and if they do not, the segment is tokenized in full.
+"""
+
+import string
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .fast import format_prompt
+
+DEFAULT_MARGIN = (
+    64  # characters on either side of a change that are tokenized again with it
+)
+EDGE_CHARS = 64  # characters of a segment's edge used to find the lines the context budget dropped or added
+
+# text on either side of a template literal, none of which may be merged with it (see `segmentable`)
+PROBES = ["", "x", "x ", "x\n", "x\n    ", "(", " ", "\n", "\t"]
+
+
+class TokenizedPrompt(str):
+    """A prompt that carries its token ids (special tokens included), so the engine need not tokenize it."""
+
+    def __new__(cls, text: str, token_ids: List[int]):
+        prompt = super().__new__(cls, text)
+        prompt.token_ids = token_ids
+        return prompt
+
+
+def encode_with_offsets(
+    tokenizer: Any, text: str
+) -> Tuple[List[int], List[Tuple[int, int]]]:
+    """Token ids of `text` and the character span of each, without special tokens (as a fast HF tokenizer)."""
+    encoding = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+    return encoding["input_ids"], encoding["offset_mapping"]
+
+
+def special_tokens(tokenizer: Any) -> Tuple[List[int], List[int]]:
+    """The ids the tokenizer adds in front of and after every prompt (e.g. BOS), as the engine encodes it."""
+    plain = tokenizer.encode("x", add_special_tokens=False)
+    full = tokenizer.encode("x", add_special_tokens=True)
+    for i in range(len(full) - len(plain) + 1):
+        if full[i : i + len(plain)] == plain:
+            return full[:i], full[i + len(plain) :]
+    raise ValueError("The special tokens of the tokenizer are not around the text.")
+
+
+def segmentable(
+    encode: Callable[[str], List[int]], literal: str, left: bool, right: bool
+) -> bool:
+    """Whether `literal` is tokenized the same with any text on its `left` and/or `right`."""
+    literal_ids = encode(literal)
+    for before in PROBES if left else [""]:
+        for after in PROBES if right else [""]:
+            if encode(before + literal + after) != encode(
+                before
+            ) + literal_ids + encode(after):
+                return False
+    return True
+
+
+def common_prefix(a: str, b: str) -> int:
+    """The length of the longest common start of `a` and `b` (by bisection, so that the comparisons run in C)."""
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a.startswith(b[:middle]):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def common_suffix(a: str, b: str, limit: int) -> int:
+    """The length of the longest common end of `a` and `b`, at most `limit`."""
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a.endswith(b[len(b) - middle :]):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+class _Segment:
+    """The tokens of a segment's text: ids and character spans, packed."""
+
+    def __init__(self, text: str, ids: array, starts: array, ends: array):
+        self.text = text
+        self.ids = ids
+        self.starts = starts
+        self.ends = ends
+
+    @classmethod
+    def tokenize(cls, tokenizer: Any, text: str, offset: int = 0) -> "_Segment":
+        ids, spans = encode_with_offsets(tokenizer, text) if text else ([], [])
+        starts = array("l", [s + offset for s, _ in spans])
+        ends = array("l", [e + offset for _, e in spans])
+        return cls(text, array("l", ids), starts, ends)
+
+    def position(self, i: int) -> int:
+        """Where the text is cut in front of token i."""
+        return (
+            0 if i == 0 else len(self.text) if i == len(self.ids) else self.ends[i - 1]
+        )
+
+    def clean(self, i: int) -> bool:
+        """Whether the text can be cut in front of token i: the tokens on either side share no character."""
+        return i == 0 or i == len(self.ids) or self.ends[i - 1] <= self.starts[i]
+
+    def cut_before(self, limit: int) -> int:
+        """The last token the text can be cut in front of at or before `limit`."""
+        if limit <= 0:
+            return 0
+        i = bisect_right(self.ends, limit)
+        while not self.clean(i):
+            i -= 1
+        return i
+
+    def cut_after(self, limit: int) -> int:
+        """The first token the text can be cut in front of at or after `limit`."""
+        if limit >= len(self.text):
+            return len(self.ids)
+        i = min(bisect_left(self.ends, limit) + 1, len(self.ids))
+        while not self.clean(i):
+            i += 1
+        return i
+
+
+class PromptTokenizer:
+    """
+    Formats the prompt of the chain's input dict, as a TokenizedPrompt if the template can be
+    tokenized by segments (a plain str otherwise). Holds the tokens of the last prompt of up to
+    `max_sessions` sessions. `get_tokenizer` returns the engine's tokenizer, which must give
+    character offsets (a fast HuggingFace tokenizer does).
+    """
+
+    def __init__(
+        self,
+        template: str,
+        get_tokenizer: Callable[[], Any],
+        margin: int = DEFAULT_MARGIN,
+        max_sessions: int = 512,
+    ):
+        self.template = template
+        self.__get_tokenizer = get_tokenizer
+        self.__margin = margin
+        self.__max_sessions = max_sessions
+        self.__tokenizer = None
+        self.__segments: Optional[List[List[str]]] = (
+            None  # the fields of every segment, None until checked
+        )
+        self.__literals: List[array] = []  # the ids of the literals around the segments
+        self.__sessions: OrderedDict[Optional[str], List[_Segment]] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__prompts = 0
+        self.__prompt_chars = 0
+        self.__tokenized_chars = 0
+        self.__tokenize_ms = 0.0
+        self.__segment_counts = {
+            "full_segments": 0,
+            "spliced_segments": 0,
+            "unchanged_segments": 0,
+            "resync_failures": 0,
+        }
+
+    @property
+    def incremental(self) -> bool:
+        """Whether prompts are tokenized by segments (known after the first prompt)."""
+        return bool(self.__segments)
+
+    def __call__(self, inputs: Dict[str, Any]) -> str:
+        text = format_prompt(
+            self.template, inputs
+        )  # still the cache key, and what string backends are given
+        if self.__segments is None:
+            self.__check_template()
+        if not self.__segments:
+            return text
+
+        start = time.thread_time()
+        values = {
+            "prefix": inputs["prefix"],
+            "suffix": inputs["suffix"],
+            "context": inputs.get("context", ""),
+            "file_header": inputs.get("file_header", ""),
+        }
+        session_id = inputs.get("session_id")
+        with self.__lock:
+            # taken out while in use, a concurrent request of the same session starts from scratch
+            previous = self.__sessions.pop(session_id, None)
+        segments = [
+            self.__update(
+                previous[k] if previous else None,
+                "".join(values[field] for field in fields),
+            )
+            for k, fields in enumerate(self.__segments)
+        ]
+        token_ids = array("l", self.__literals[0])
+        for segment, literal in zip(segments, self.__literals[1:]):
+            token_ids += segment.ids
+            token_ids += literal
+        elapsed = 1000 * (time.thread_time() - start)
+
+        with self.__lock:
+            self.__sessions[session_id] = segments
+            while len(self.__sessions) > self.__max_sessions:
+                self.__sessions.popitem(last=False)
+            self.__prompts += 1
+            self.__prompt_chars += len(text)
+            self.__tokenize_ms += elapsed
+        return TokenizedPrompt(text, token_ids.tolist())
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "incremental": self.incremental,
+                "sessions": len(self.__sessions),
+                "prompts": self.__prompts,
+                "prompt_chars": self.__prompt_chars,
+                "tokenized_chars": self.__tokenized_chars,
+                **self.__segment_counts,
+                "tokenize_ms": self.__tokenize_ms,
+            }
+
+    def __check_template(self):
+        """Split the template into segments and literals, or leave it whole if they cannot be tokenized apart."""
+        with self.__lock:
+            if self.__segments is not None:
+                return
+            segments: List[List[str]] = [[]]
+            literals = [""]
+            for literal, field, _, _ in string.Formatter().parse(self.template):
+                if literal and segments[-1]:
+                    segments.append([])
+                    literals.append("")
+                literals[-1] += literal
+                if field is not None:
+                    segments[-1].append(field)
+            if not segments[-1]:
+                segments.pop()
+            else:
+                literals.append("")
+            try:
+                tokenizer = self.__get_tokenizer()
+                encode_with_offsets(tokenizer, "x")
+                lead, trail = special_tokens(tokenizer)
+
+                def encode(text: str) -> List[int]:
+                    return tokenizer.encode(text, add_special_tokens=False)
+
+                if all(
+                    segmentable(encode, literal, left=i > 0, right=i < len(segments))
+                    for i, literal in enumerate(literals)
+                ):
+                    self.__tokenizer = tokenizer
+                    ids = [array("l", encode(literal)) for literal in literals]
+                    self.__literals = [
+                        array("l", lead) + ids[0],
+                        *ids[1:-1],
+                        ids[-1] + array("l", trail),
+                    ]
+                    self.__segments = segments
+                    return
+            except (
+                AttributeError,
+                TypeError,
+                KeyError,
+                ValueError,
+                NotImplementedError,
+            ):
+                pass  # e.g. a slow tokenizer, which has no offsets
+            self.__segments = []
+
+    def __count(self, counter: str, tokenized_chars: int):
+        with self.__lock:
+            self.__segment_counts[counter] += 1
+            self.__tokenized_chars += tokenized_chars
+
+    def __update(self, segment: Optional[_Segment], text: str) -> _Segment:
+        """The tokens of `text`, spliced into those of the session's last `segment` where possible."""
+        if segment is not None and segment.text == text:
+            self.__count("unchanged_segments", 0)
+            return segment
+        if segment is not None and segment.text and text:
+            spliced, tokenized = self.__splice_changes(segment, text)
+            if spliced is not None:
+                self.__count("spliced_segments", tokenized)
+                return spliced
+            self.__count("resync_failures", tokenized)
+        self.__count("full_segments", len(text))
+        return _Segment.tokenize(self.__tokenizer, text)
+
+    def __splice_changes(
+        self, segment: _Segment, text: str
+    ) -> Tuple[Optional[_Segment], int]:
+        """
+        Turn the segment into `text`: splice its edges (lines dropped or added by the context budget,
+        text typed at the end), then whatever still differs in between. Also returns the characters tokenized.
+        """
+        edits = []
+        old = segment.text
+        head, old_head = text[:EDGE_CHARS], old[:EDGE_CHARS]
+        if not old.startswith(head):
+            if (k := old.find(head)) > 0:
+                edits.append((0, k, ""))
+            elif (k := text.find(old_head)) > 0:
+                edits.append((0, 0, text[:k]))
+        tail, old_tail = text[-EDGE_CHARS:], old[-EDGE_CHARS:]
+        if not old.endswith(tail):
+            if (k := old.rfind(tail)) >= 0:
+                edits.append((k + len(tail), len(old), ""))
+            elif (k := text.rfind(old_tail)) >= 0:
+                edits.append((len(old), len(old), text[k + len(old_tail) :]))
+        if len(edits) == 2 and edits[1][0] < edits[0][1]:
+            edits.pop()  # the edges overlap, the last splice sorts it out
+
+        tokenized = 0
+        shift = 0  # the first edit moves the second one
+        for start, end, replacement in edits:
+            segment, chars = self.__splice(
+                segment, start + shift, end + shift, replacement
+            )
+            tokenized += chars
+            if segment is None:
+                return None, tokenized
+            shift = len(replacement) - (end - start)
+
+        old = segment.text
+        if old != text:
+            a = common_prefix(old, text)
+            b = common_suffix(old, text, min(len(old), len(text)) - a)
+            segment, chars = self.__splice(
+                segment, a, len(old) - b, text[a : len(text) - b]
+            )
+            tokenized += chars
+        return segment, tokenized
+
+    def __splice(
+        self, segment: _Segment, start: int, end: int, replacement: str
+    ) -> Tuple[Optional[_Segment], int]:
+        """
+        Replace segment.text[start:end] by `replacement`, tokenizing only the text between the token
+        boundaries `margin` characters around it. None if the margins are not tokenized as before.
+        """
+        i = segment.cut_before(start - self.__margin)
+        j = segment.cut_after(end + self.__margin)
+        left, right = segment.position(i), segment.position(j)
+        shift = len(replacement) - (end - start)
+        text = segment.text[:start] + replacement + segment.text[end:]
+        window = _Segment.tokenize(
+            self.__tokenizer, text[left : right + shift], offset=left
+        )
+
+        # the tokens of the first half of the left margin and of the last half of the right one, at
+        # least those next to the cuts (a segment's own start and end need no checking)
+        p = (
+            max(bisect_right(segment.ends, left + (start - left) // 2, i, j), i + 1)
+            if i > 0
+            else i
+        )
+        q = (
+            min(bisect_left(segment.starts, right - (right - end) // 2, i, j), j - 1)
+            if j < len(segment.ids)
+            else j
+        )
+        if p > j or q < i:
+            return None, 0
+        n, m = p - i, j - q
+        if n > len(window.ids) or m > len(window.ids) - n:
+            return None, len(window.text)
+        if n and (
+            window.ids[:n] != segment.ids[i:p]
+            or window.starts[:n] != segment.starts[i:p]
+            or window.ends[:n] != segment.ends[i:p]
+        ):
+            return None, len(window.text)
+        if m:
+            tail = len(window.ids) - m
+            if (
+                window.ids[tail:] != segment.ids[q:j]
+                or window.starts[tail:]
+                != array("l", [s + shift for s in segment.starts[q:j]])
+                or window.ends[tail:]
+                != array("l", [e + shift for e in segment.ends[q:j]])
+            ):
+                return None, len(window.text)
+
+        rest_starts, rest_ends = segment.starts[j:], segment.ends[j:]
+        if shift:
+            rest_starts = array("l", [s + shift for s in rest_starts])
+            rest_ends = array("l", [e + shift for e in rest_ends])
+        spliced = _Segment(
+            text,
+            segment.ids[:i] + window.ids + segment.ids[j:],
+            segment.starts[:i] + window.starts + rest_starts,
+            segment.ends[:i] + window.ends + rest_ends,
+        )
+        return spliced, len(window.text)
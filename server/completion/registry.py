@@ -0,0 +1,320 @@
+"""
+Config-driven, lazy model registry.
+
+Models are declared in `model_specs.yaml` instead of being built when the package
+is imported, so importing `completion` is cheap (no vLLM, no GPU) and the API can
+serve the session and user endpoints while the engines are still loading.
+An engine is built on first use, or ahead of time by `warm_up` (which the server
+runs in a background thread at start-up). Specs that only differ in template or
+sampling parameters share one engine.
+"""
+
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+import yaml
+from langchain_core.language_models.llms import BaseLLM
+from langchain_core.outputs import Generation, GenerationChunk
+from langchain_core.prompts import PromptTemplate
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+from pydantic import BaseModel
+
+from .budget import ContextBudget
+from .cache import CachedModel, CompletionCache
+from .fast import FastModel
+from .prompt_tokens import PromptTokenizer
+from .replicas import ReplicaPool, routing_key
+from .repo_context import RepoContext
+from .stopping import StoppingModel
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPECS = Path(__file__).parent / "model_specs.yaml"
+
+
+class ModelSpec(BaseModel):
+    """
+    One entry of model_specs.yaml.
+    """
+
+    name: str  # the key of the model's completion in GenerateResponse
+    backend: str = "vllm"  # see BACKENDS
+    model: str  # HuggingFace model name or path
+    template: str  # FIM prompt template with {prefix} and {suffix}, optionally {context} and {file_header}
+    engine: Dict[str, Any] = {}  # arguments of the engine, e.g. VLLM_M fields
+    sampling: Dict[str, Any] = {}  # sampling parameters for every request
+    candidates: Dict[str, Any] = (
+        {}
+    )  # sampling parameters of requests for several candidates (see stopping.py)
+    context: Dict[str, Any] = {}  # arguments of the ContextBudget
+    repo_context: Dict[str, Any] = (
+        {}
+    )  # arguments of the RepoContext, i.e. other files of the project in {context}
+    replicas: int = (
+        1  # engines to build, requests are routed over them by session (see replicas.py)
+    )
+    routing: Dict[str, Any] = {}  # arguments of the ReplicaPool, if replicas > 1
+
+    def engine_key(self) -> str:
+        """Specs with the same key can share an engine."""
+        return json.dumps(
+            [self.backend, self.model, self.engine, self.replicas, self.routing],
+            sort_keys=True,
+        )
+
+
+def build_vllm(spec: ModelSpec) -> BaseLLM:
+    from .vllm_modified import (
+        VLLM_M,
+    )  # imports vllm, so only once a model is actually needed
+
+    return VLLM_M(model=spec.model, **spec.engine)
+
+
+def build_simulated(spec: ModelSpec) -> BaseLLM:
+    from .simulated import SimulatedLLM
+
+    return SimulatedLLM(model=spec.model, **spec.engine)
+
+
+# backend name -> function building the engine of a spec
+BACKENDS: Dict[str, Callable[[ModelSpec], BaseLLM]] = {
+    "vllm": build_vllm,
+    "simulated": build_simulated,  # CPU stand-in, see simulated.py
+}
+
+
+class ModelNotReady(Exception):
+    """The model's engine is still being built; the request should skip it."""
+
+
+class LazyModel(Runnable):
+    """
+    The completion pipeline of one model (context budget | repository context | prompt + stopping
+    criteria | cached LLM), built on first use. `ainvoke_fast` / `astream_fast` run the same pipeline
+    without the runnables (see fast.py).
+    From async code a model that is not built yet raises ModelNotReady (and starts building in
+    the background) rather than blocking the request for minutes.
+    """
+
+    def __init__(self, spec: ModelSpec, registry: "ModelRegistry"):
+        self.spec = spec
+        self.__registry = registry
+        self.__pipeline: Optional[Runnable] = None
+        self.__budget: Optional[ContextBudget] = None
+        self.__repo_context: Optional[RepoContext] = None
+        self.__stopping: Optional[StoppingModel] = None
+        self.__fast: Optional[FastModel] = None
+        self.__prompt_tokenizer: Optional[PromptTokenizer] = None
+        self.__speculation = (
+            None  # the engine's SpeculationStats, if it uses prompt lookup
+        )
+        self.__replicas: Optional[ReplicaPool] = None
+        self.__build_lock = threading.Lock()  # held for the whole (minutes long) build
+        self.__builder_lock = threading.Lock()
+        self.__builder: Optional[threading.Thread] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.__pipeline is not None
+
+    def pipeline(self) -> Runnable:
+        """Build (blocking) and return the pipeline."""
+        with self.__build_lock:
+            if self.__pipeline is None:
+                llm = self.__registry.engine(self.spec)
+                self.__budget = ContextBudget(llm.get_num_tokens, **self.spec.context)
+                self.__repo_context = RepoContext(
+                    llm.get_num_tokens, **self.spec.repo_context
+                )
+                model = CachedModel(
+                    self.spec.name, llm, self.__registry.cache, self.spec.sampling
+                )
+                self.__stopping = StoppingModel(
+                    PromptTemplate.from_template(self.spec.template),
+                    model,
+                    llm.get_tokenizer,
+                    llm.get_num_tokens,
+                    candidate_params=self.spec.candidates or None,
+                )
+                budget, repo_context = self.__budget, self.__repo_context
+                self.__prompt_tokenizer = PromptTokenizer(
+                    self.spec.template, llm.get_tokenizer
+                )
+                self.__fast = FastModel(
+                    lambda input: repo_context(budget(input)),
+                    self.__prompt_tokenizer,
+                    self.__stopping,
+                    model,
+                )
+                self.__speculation = getattr(llm, "speculation", None)
+                self.__replicas = llm if isinstance(llm, ReplicaPool) else None
+                self.__pipeline = (
+                    RunnableLambda(self.__budget)
+                    | RunnableLambda(self.__repo_context)
+                    | self.__stopping
+                )
+            return self.__pipeline
+
+    def __build(self):
+        try:
+            self.pipeline()
+        except Exception as e:
+            logger.error(f"Building {self.spec.name} failed: {e}")
+
+    def __ready_pipeline(self) -> Runnable:
+        if self.__pipeline is not None:
+            return self.__pipeline
+        with self.__builder_lock:
+            if self.__builder is None or not self.__builder.is_alive():
+                self.__builder = threading.Thread(
+                    target=self.__build, name=f"build-{self.spec.name}", daemon=True
+                )
+                self.__builder.start()
+        raise ModelNotReady(f"{self.spec.name} is still loading.")
+
+    @staticmethod
+    def _with_wall_time(generation: Generation, start: float) -> Generation:
+        """Add the model's wall time (ms), i.e. including everything around the engine, to the metadata."""
+        generation_info = {
+            **(generation.generation_info or {}),
+            "wall_ms": 1000 * (time.perf_counter() - start),
+        }
+        return type(generation)(text=generation.text, generation_info=generation_info)
+
+    def invoke(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> Generation:
+        routing_key.set(
+            input.get("session_id")
+        )  # the replica pool routes by session, see replicas.py
+        start = time.perf_counter()
+        return self._with_wall_time(
+            self.pipeline().invoke(input, config, **kwargs), start
+        )
+
+    async def ainvoke(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> Generation:
+        pipeline = self.__ready_pipeline()
+        routing_key.set(input.get("session_id"))
+        start = time.perf_counter()
+        return self._with_wall_time(
+            await pipeline.ainvoke(input, config, **kwargs), start
+        )
+
+    async def astream(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AsyncIterator[GenerationChunk]:
+        pipeline = self.__ready_pipeline()
+        routing_key.set(input.get("session_id"))
+        start = time.perf_counter()
+        async for chunk in pipeline.astream(input, config, **kwargs):
+            # the metadata is on the last chunk
+            yield (
+                self._with_wall_time(chunk, start)
+                if chunk.generation_info is not None
+                else chunk
+            )
+
+    async def ainvoke_fast(self, input: Dict[str, Any]) -> Generation:
+        """`ainvoke` without the runnables and their callbacks."""
+        self.__ready_pipeline()
+        routing_key.set(input.get("session_id"))
+        start = time.perf_counter()
+        return self._with_wall_time(await self.__fast.ainvoke(input), start)
+
+    async def astream_fast(
+        self, input: Dict[str, Any]
+    ) -> AsyncIterator[GenerationChunk]:
+        """`astream` without the runnables and their callbacks."""
+        self.__ready_pipeline()
+        routing_key.set(input.get("session_id"))
+        start = time.perf_counter()
+        async for chunk in self.__fast.astream(input):
+            yield (
+                self._with_wall_time(chunk, start)
+                if chunk.generation_info is not None
+                else chunk
+            )
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "context_budget": (
+                self.__budget.stats() if self.__budget is not None else None
+            ),
+            "repo_context": (
+                self.__repo_context.stats() if self.__repo_context is not None else None
+            ),
+            "prompt_tokens": (
+                self.__prompt_tokenizer.stats()
+                if self.__prompt_tokenizer is not None
+                else None
+            ),
+            "stopping": (
+                self.__stopping.stats() if self.__stopping is not None else None
+            ),
+            "speculation": (
+                self.__speculation.stats() if self.__speculation is not None else None
+            ),
+            "replicas": (
+                self.__replicas.stats() if self.__replicas is not None else None
+            ),
+        }
+
+
+class ModelRegistry:
+    """
+    Holds a LazyModel per spec (`models`, ordered as in the config) and the engines they share.
+    """
+
+    def __init__(self, specs: List[ModelSpec], cache: CompletionCache):
+        self.cache = cache
+        self.models: Dict[str, LazyModel] = {
+            spec.name: LazyModel(spec, self) for spec in specs
+        }
+        self.__engines: Dict[str, BaseLLM] = {}
+        self.__build_lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path: Path, cache: CompletionCache) -> "ModelRegistry":
+        with open(path, encoding="utf-8") as f:
+            specs = [ModelSpec(**spec) for spec in yaml.safe_load(f) or []]
+        return cls(specs, cache)
+
+    def engine(self, spec: ModelSpec) -> BaseLLM:
+        """The (shared) engine of a spec, built if it does not exist yet."""
+        # NOTE: building holds the lock, so two specs with the same engine never build it twice
+        with self.__build_lock:
+            key = spec.engine_key()
+            if key not in self.__engines:
+                logger.info(
+                    f"Building {spec.replicas} {spec.backend} engine(s) of {spec.model}."
+                )
+                if spec.replicas == 1:
+                    self.__engines[key] = BACKENDS[spec.backend](spec)
+                else:
+                    replicas = [
+                        BACKENDS[spec.backend](spec) for _ in range(spec.replicas)
+                    ]
+                    self.__engines[key] = ReplicaPool(replicas=replicas, **spec.routing)
+            return self.__engines[key]
+
+    def warm_up(self):
+        """Build every model ahead of its first request. Blocking, so run it in a thread."""
+        for model in self.models.values():
+            try:
+                model.pipeline()
+            except Exception as e:
+                logger.error(f"Warming up {model.spec.name} failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "engines": len(self.__engines),
+            "models": {name: model.stats() for name, model in self.models.items()},
+        }
@@ -0,0 +1,275 @@
+"""
+Session-affinity routing over several replicas of an engine.
+
+With automatic prefix caching an engine keeps the KV cache of recent prompts, and the
+consecutive keystroke requests of a session share nearly all of their prompt. With several
+replicas that only pays off if a session keeps landing on the same replica, so `ReplicaPool`
+routes each request by its session id on a consistent hash ring (adding or removing a
+replica only moves the sessions next to it on the ring), and only falls back to the least
+loaded replica while the preferred one already has `max_in_flight` requests.
+
+The pool is an LLM itself, so the cache, stopping criteria and fast path on top of it are
+unchanged. The session id reaches it through the `routing_key` context variable, which
+LazyModel sets for every request (requests without one go to the least loaded replica).
+"""
+
+import bisect
+import hashlib
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.language_models.base import LanguageModelInput
+from langchain_core.language_models.llms import BaseLLM
+from langchain_core.outputs import Generation, GenerationChunk, LLMResult
+from langchain_core.runnables import RunnableConfig, ensure_config
+
+# the session id of the request being generated, set by LazyModel
+routing_key: ContextVar[Optional[str]] = ContextVar("routing_key", default=None)
+
+
+def _hash(key: str) -> int:
+    # stable across processes and restarts, unlike hash()
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto `n` nodes, each placed at `virtual_nodes` points of the ring
+    so that the keys spread evenly.
+    """
+
+    def __init__(self, n: int, virtual_nodes: int = 64):
+        points = sorted(
+            (_hash(f"{node}-{i}"), node)
+            for node in range(n)
+            for i in range(virtual_nodes)
+        )
+        self.__hashes = [point for point, _ in points]
+        self.__nodes = [node for _, node in points]
+
+    def lookup(self, key: str) -> int:
+        """The node of a key: the first point clockwise from its hash."""
+        i = bisect.bisect(self.__hashes, _hash(key)) % len(self.__hashes)
+        return self.__nodes[i]
+
+
+class ReplicaPool(BaseLLM):
+    """Routes requests over replicas of the same engine, see the module's docstring."""
+
+    replicas: List[Any]
+    """The engines (e.g. VLLM_M or SimulatedLLM), all of the same model."""
+
+    max_in_flight: int = 4
+    """Requests a replica may have running before requests for it go to the least loaded replica."""
+
+    virtual_nodes: int = 64
+    """Points per replica on the hash ring."""
+
+    ring: Any  #: :meta private:
+
+    lock: Any  #: :meta private:
+
+    counters: Any  #: :meta private:
+
+    speculation: Any  #: :meta private:
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.ring = HashRing(len(self.replicas), self.virtual_nodes)
+        self.lock = threading.Lock()
+        self.counters = [
+            {
+                "requests": 0,
+                "in_flight": 0,
+                "affinity": 0,  # requests of a session that got its preferred replica
+                "fallbacks": 0,  # requests of a session that were moved off its saturated replica
+                "prefix_cache_hits": 0,  # requests that found part of their prompt cached
+                "prefix_cache_misses": 0,
+                "cached_tokens": 0,
+                "prompt_tokens": 0,
+            }
+            for _ in self.replicas
+        ]
+        # one total over all replicas
+        self.speculation = getattr(self.replicas[0], "speculation", None)
+        if self.speculation is not None:
+            for replica in self.replicas[1:]:
+                replica.speculation = self.speculation
+
+    @property
+    def _default_params(self) -> Dict[str, Any]:
+        return self.replicas[0]._default_params
+
+    def get_tokenizer(self) -> Any:
+        return self.replicas[0].get_tokenizer()
+
+    def get_token_ids(self, text: str) -> List[int]:
+        return self.replicas[0].get_token_ids(text)
+
+    def preferred(self, key: str) -> int:
+        return self.ring.lookup(key)
+
+    @contextmanager
+    def _route(self) -> Iterator[int]:
+        """Pick the replica of the current request and count it as in flight while it runs."""
+        key = routing_key.get()
+        with self.lock:
+            load = [counter["in_flight"] for counter in self.counters]
+            preferred = self.preferred(key) if key is not None else None
+            if preferred is not None and load[preferred] < self.max_in_flight:
+                replica = preferred
+                self.counters[replica]["affinity"] += 1
+            else:
+                replica = min(range(len(load)), key=load.__getitem__)
+                if preferred is not None and replica != preferred:
+                    self.counters[replica]["fallbacks"] += 1
+            self.counters[replica]["requests"] += 1
+            self.counters[replica]["in_flight"] += 1
+        try:
+            yield replica
+        finally:
+            with self.lock:
+                self.counters[replica]["in_flight"] -= 1
+
+    def _record(self, replica: int, generation_info: Optional[dict]):
+        """Count the replica's prefix cache hit / miss, as far as its engine reports cached tokens."""
+        metrics = (generation_info or {}).get("metrics") or {}
+        if metrics.get("cached_tokens") is None:
+            return
+        with self.lock:
+            counter = self.counters[replica]
+            counter[
+                (
+                    "prefix_cache_hits"
+                    if metrics["cached_tokens"]
+                    else "prefix_cache_misses"
+                )
+            ] += 1
+            counter["cached_tokens"] += metrics["cached_tokens"]
+            counter["prompt_tokens"] += metrics.get("prompt_tokens") or 0
+
+    @staticmethod
+    def _tagged(replica: int, generation: Generation) -> Generation:
+        generation_info = {**(generation.generation_info or {}), "replica": replica}
+        return type(generation)(text=generation.text, generation_info=generation_info)
+
+    def _generate(
+        self,
+        prompts: List[str],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> LLMResult:
+        with self._route() as replica:
+            result = self.replicas[replica]._generate(prompts, stop, None, **kwargs)
+        for generations in result.generations:
+            self._record(replica, generations[0].generation_info)
+        return LLMResult(
+            generations=[
+                [self._tagged(replica, g) for g in gs] for gs in result.generations
+            ]
+        )
+
+    async def _agenerate(
+        self,
+        prompts: List[str],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> LLMResult:
+        with self._route() as replica:
+            result = await self.replicas[replica]._agenerate(
+                prompts, stop, None, **kwargs
+            )
+        for generations in result.generations:
+            self._record(replica, generations[0].generation_info)
+        return LLMResult(
+            generations=[
+                [self._tagged(replica, g) for g in gs] for gs in result.generations
+            ]
+        )
+
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        with self._route() as replica:
+            async for chunk in self.replicas[replica]._astream(
+                prompt, stop, None, **kwargs
+            ):
+                if chunk.generation_info is None:
+                    yield chunk
+                    continue
+                # the last chunk, with the metadata
+                self._record(replica, chunk.generation_info)
+                yield self._tagged(replica, chunk)
+
+    # NOTE: same overrides as VLLM_M, so that the metadata is returned as well
+    def invoke(
+        self,
+        input: LanguageModelInput,
+        config: Optional[RunnableConfig] = None,
+        *,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> Generation:
+        config = ensure_config(config)
+        return self.generate_prompt(
+            [self._convert_input(input)],
+            stop=stop,
+            callbacks=config.get("callbacks"),
+            **kwargs,
+        ).generations[0][0]
+
+    async def ainvoke(
+        self,
+        input: LanguageModelInput,
+        config: Optional[RunnableConfig] = None,
+        *,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> Generation:
+        config = ensure_config(config)
+        llm_result = await self.agenerate_prompt(
+            [self._convert_input(input)],
+            stop=stop,
+            callbacks=config.get("callbacks"),
+            **kwargs,
+        )
+        return llm_result.generations[0][0]
+
+    async def astream(
+        self,
+        input: LanguageModelInput,
+        config: Optional[RunnableConfig] = None,
+        *,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        prompt = self._convert_input(input).to_string()
+        async for chunk in self._astream(prompt, stop=stop, **kwargs):
+            yield chunk
+
+    def stats(self) -> dict:
+        with self.lock:
+            counters = [dict(counter) for counter in self.counters]
+        for counter in counters:
+            lookups = counter["prefix_cache_hits"] + counter["prefix_cache_misses"]
+            counter["prefix_cache_hit_rate"] = (
+                counter["prefix_cache_hits"] / lookups if lookups else 0.0
+            )
+        return {"max_in_flight": self.max_in_flight, "replicas": counters}
+
+    @property
+    def _llm_type(self) -> str:
+        """Return type of llm."""
+        return "replica_pool"
@@ -0,0 +1,189 @@
+"""
+Repository-level context for FIM.
+
+DeepSeek-Coder and StarCoder2 are also trained on whole repositories: other files of the
+project, each introduced by its path, in front of the file being completed. The plugin can
+send such files along with a request (`GenerateRequest.context_files`, with their contents
+cached per session so only changed files are uploaded again, see Session.resolve_context_files).
+`RepoContext` ranks them by how much they share with the code around the cursor and packs the
+most relevant ones into the `{context}` of the model's template, within a token budget:
+
+- a file scores the identifiers it shares with the `window_lines` around the cursor, plus a
+  bonus if its name is mentioned there (e.g. imported) and if it is in the same directory;
+- files that share nothing are left out, as unrelated code only costs prefill;
+- files are added in order of relevance until the budget is spent, the first one that does
+  not fit is cut to its first lines;
+- the most relevant file goes last, i.e. nearest to the cursor.
+
+Identifiers and token counts are kept per file content, so a file that did not change since
+the last request is not tokenized again.
+"""
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from pathlib import PurePosixPath
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+IDENTIFIER = re.compile(
+    r"[A-Za-z_][A-Za-z0-9_]{2,}"
+)  # shorter names (i, x, id) match far too much
+
+NAME_BONUS = (
+    1.0  # the file's name is mentioned near the cursor, e.g. `from utils import ...`
+)
+DIRECTORY_BONUS = 0.25  # the file is next to the one being edited
+MIN_TRUNCATED_TOKENS = 64  # a file cut shorter than this is left out instead
+
+
+def identifiers(text: str) -> FrozenSet[str]:
+    return frozenset(IDENTIFIER.findall(text))
+
+
+def content_hash(content: str) -> str:
+    """The hash the plugin sends for a file instead of its content (ContextFile.hash)."""
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class RepoContext:
+    """
+    Adds `context` (the packed files) and `file_header` (the path of the edited file, for
+    templates that introduce it) to the chain's input dict. Use it as a chain stage
+    (RunnableLambda) after the ContextBudget. With `max_tokens` 0 both stay empty.
+    """
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        max_tokens: int = 0,
+        file_template: str = "{path}\n{content}\n",
+        file_header_template: str = "",
+        window_lines: int = 50,
+        max_files: int = 4096,
+    ):
+        self.__count_tokens = count_tokens
+        self.__max_tokens = max_tokens
+        self.__file_template = file_template
+        self.__file_header_template = file_header_template
+        self.__window_lines = window_lines
+        self.__max_files = max_files
+        # (path, content hash) -> (identifiers, token count) of the file as formatted by file_template
+        self.__files: OrderedDict[Tuple[str, str], Tuple[FrozenSet[str], int]] = (
+            OrderedDict()
+        )
+        self.__lock = threading.Lock()
+        self.__requests = 0
+        self.__offered_files = 0
+        self.__packed_files = 0
+        self.__truncated_files = 0
+        self.__context_tokens = 0
+        self.__tokenized_files = 0
+        self.__reused_files = 0
+
+    def __call__(self, inputs: dict) -> dict:
+        files = inputs.get("context_files") or []
+        file_path = inputs.get("file_path")
+        if self.__max_tokens <= 0:
+            return {**inputs, "context": "", "file_header": ""}
+        header = self.__file_header_template.format(path=file_path) if file_path else ""
+        context = self.__pack(inputs, files, file_path) if files else ""
+        return {**inputs, "context": context, "file_header": header}
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "requests": self.__requests,
+                "offered_files": self.__offered_files,
+                "packed_files": self.__packed_files,
+                "truncated_files": self.__truncated_files,
+                "context_tokens": self.__context_tokens,
+                "tokenized_files": self.__tokenized_files,
+                "reused_files": self.__reused_files,
+            }
+
+    def __file(
+        self, path: str, content: str, hash: Optional[str]
+    ) -> Tuple[str, FrozenSet[str], int]:
+        """The formatted file, its identifiers and token count (cached by content)."""
+        text = self.__file_template.format(path=path, content=content)
+        key = (path, hash or content_hash(content))
+        with self.__lock:
+            cached = self.__files.get(key)
+            if cached is not None:
+                self.__files.move_to_end(key)
+                self.__reused_files += 1
+                return (text, *cached)
+        cached = (identifiers(content), self.__count_tokens(text))
+        with self.__lock:
+            self.__files[key] = cached
+            self.__tokenized_files += 1
+            while len(self.__files) > self.__max_files:
+                self.__files.popitem(last=False)
+        return (text, *cached)
+
+    def rank(
+        self, inputs: dict, files: List[Dict[str, Any]], file_path: Optional[str]
+    ) -> List[Tuple[float, dict]]:
+        """The files worth including, most relevant first, as (score, file) pairs."""
+        before = inputs["prefix"].splitlines()[-self.__window_lines :]
+        after = inputs["suffix"].splitlines()[: self.__window_lines // 2]
+        window = identifiers("\n".join(before + after))
+        if not window:
+            return []
+        directory = PurePosixPath(file_path).parent if file_path else None
+        ranked = []
+        for file in files:
+            if file["path"] == file_path:
+                continue  # the edited file itself is the prefix and suffix
+            text, names, tokens = self.__file(
+                file["path"], file["content"], file.get("hash")
+            )
+            shared = len(window & names)
+            if not shared:
+                continue
+            path = PurePosixPath(file["path"])
+            score = shared / len(window)
+            if path.stem in window:
+                score += NAME_BONUS
+            if directory is not None and path.parent == directory:
+                score += DIRECTORY_BONUS
+            ranked.append((score, {**file, "text": text, "tokens": tokens}))
+        ranked.sort(key=lambda pair: pair[0], reverse=True)
+        return ranked
+
+    def __pack(
+        self, inputs: dict, files: List[Dict[str, Any]], file_path: Optional[str]
+    ) -> str:
+        packed: List[str] = []
+        used, truncated = 0, 0
+        for _, file in self.rank(inputs, files, file_path):
+            left = self.__max_tokens - used
+            if file["tokens"] <= left:
+                packed.append(file["text"])
+                used += file["tokens"]
+                continue
+            if left >= MIN_TRUNCATED_TOKENS:
+                # the first lines (imports, signatures) are usually the most telling part
+                text = file["text"]
+                cut = text.rfind("\n", 0, len(text) * left // file["tokens"]) + 1
+                tokens = self.__count_tokens(text[:cut]) if cut else 0
+                while (
+                    cut and tokens > left
+                ):  # the cut by characters was only an estimate
+                    cut = text.rfind("\n", 0, cut - 1) + 1
+                    tokens = self.__count_tokens(text[:cut]) if cut else 0
+                if cut:
+                    packed.append(text[:cut])
+                    used += tokens
+                    truncated += 1
+            break
+
+        with self.__lock:
+            self.__requests += 1
+            self.__offered_files += len(files)
+            self.__packed_files += len(packed)
+            self.__truncated_files += truncated
+            self.__context_tokens += used
+        packed.reverse()  # the most relevant file nearest to the cursor
+        return "".join(packed)
@@ -0,0 +1,103 @@
+"""
+Per-language (and per-project, IDE or plugin version) model routing.
+
+Without it every request fans out to every model, also for languages where completions
+are never accepted. The routing table (model_routing.yaml) maps a request to the subset
+of models worth running: the first rule that matches it decides, and a request that no
+rule matches goes to all models. A rule without models means no generation at all.
+"""
+
+import logging
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import Collection, List, Optional
+
+import yaml
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROUTING = Path(__file__).parent / "model_routing.yaml"
+
+
+class RoutingRule(BaseModel):
+    """
+    One entry of model_routing.yaml. Every condition that is given has to match; an empty one matches anything.
+    """
+
+    languages: List[str] = []  # the file's language, GenerateRequest.language
+    project_languages: List[str] = []  # the session's project_primary_language
+    ides: List[str] = []  # the session's project_ide
+    plugin_versions: List[str] = (
+        []
+    )  # fnmatch patterns of the session's plugin version, e.g. '0.3.*'
+    models: List[str]  # the models to run, none at all if empty
+
+    def matches(
+        self,
+        language: str,
+        project_language: Optional[str],
+        ide: Optional[str],
+        plugin_version: Optional[str],
+    ) -> bool:
+        return (
+            (not self.languages or language in self.languages)
+            and (
+                not self.project_languages or project_language in self.project_languages
+            )
+            and (not self.ides or ide in self.ides)
+            and (
+                not self.plugin_versions
+                or any(
+                    plugin_version is not None and fnmatch(plugin_version, pattern)
+                    for pattern in self.plugin_versions
+                )
+            )
+        )
+
+
+class RoutingTable:
+    """
+    The rules of model_routing.yaml, in order. Counts how often each rule decided.
+    """
+
+    def __init__(self, rules: List[RoutingRule]):
+        self.rules = rules
+        self.__matches = [0] * len(rules)
+        self.__unmatched = 0
+
+    @classmethod
+    def from_file(cls, path: Path, models: Collection[str]) -> "RoutingTable":
+        with open(path, encoding="utf-8") as f:
+            rules = [RoutingRule(**rule) for rule in yaml.safe_load(f) or []]
+        for rule in rules:
+            if unknown := set(rule.models) - set(models):
+                logger.warning(
+                    f'The routing rule for {rule.languages or "any language"} names unknown models {unknown}.'
+                )
+        return cls(rules)
+
+    def route(
+        self,
+        language: str,
+        project_language: Optional[str] = None,
+        ide: Optional[str] = None,
+        plugin_version: Optional[str] = None,
+    ) -> Optional[List[str]]:
+        """The models to run for a request, None for all of them."""
+        # NOTE: the counters are only approximate under concurrency, they are not worth a lock
+        for i, rule in enumerate(self.rules):
+            if rule.matches(language, project_language, ide, plugin_version):
+                self.__matches[i] += 1
+                return rule.models
+        self.__unmatched += 1
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "rules": [
+                {"languages": rule.languages, "models": rule.models, "matches": matches}
+                for rule, matches in zip(self.rules, self.__matches)
+            ],
+            "unmatched": self.__unmatched,
+        }
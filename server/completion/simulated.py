@@ -0,0 +1,484 @@
+"""
+CPU stand-in for VLLM_M, for load tests and benchmarks without a GPU.
+
+`SimulatedLLM` honours the same contract as VLLM_M (`invoke`/`ainvoke` return a
+Generation whose `generation_info` looks like VLLM_M's, `astream`
+yields GenerationChunks with the metadata on the last one), so the rest of the
+stack (scheduling, caching, fan-out, persistence) cannot tell the difference.
+
+Completions are replayed from a cassette (JSONL of {"prompt", "text", "generation_info"},
+see `save_to_cassette`) or, for prompts that are not on it, synthesized from the prompt
+itself. Latency follows a simple model of a GPU engine: prefill costs time per prompt
+token of the whole batch, every decode step costs time per step, slightly more for
+every extra sequence in the batch. Prompts are batched by the same MicroBatchScheduler
+as the blocking vLLM engine.
+
+Select it with `backend: simulated` in the model specs (see model_specs.simulated.yaml).
+"""
+
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.language_models.base import LanguageModelInput
+from langchain_core.language_models.llms import BaseLLM
+from langchain_core.outputs import Generation, GenerationChunk, LLMResult
+from langchain_core.pydantic_v1 import root_validator
+from langchain_core.runnables import RunnableConfig, ensure_config
+
+from .batching import MicroBatchScheduler
+from .confidence import candidate, chosen_logprobs, confidence
+from .prompt_tokens import TokenizedPrompt
+from .speculative import SpeculationStats, replay
+
+# words, runs of whitespace and single symbols: close enough to a code tokenizer for timing purposes
+TOKEN_PATTERN = re.compile(r"\s+|\w+|[^\w\s]")
+
+
+@dataclass
+class Logprob:
+    """Mirrors vllm.sequence.Logprob"""
+
+    logprob: float
+    rank: Optional[int] = None
+    decoded_token: Optional[str] = None
+
+
+PREFIX_BLOCK_SIZE = 16  # tokens per KV cache block, vLLM's default block size
+
+
+class PrefixCache:
+    """
+    The prompt blocks whose KV cache an engine with automatic prefix caching still holds, LRU.
+    Like in vLLM a block is identified by all the tokens up to its end, so only shared prefixes hit.
+    """
+
+    def __init__(self, max_blocks: int):
+        self.__max_blocks = max_blocks
+        self.__blocks: OrderedDict[int, None] = OrderedDict()
+        self.__lock = (
+            threading.Lock()
+        )  # the scheduler's worker thread and _astream both prefill
+
+    def prefill(self, token_ids: List[int]) -> int:
+        """Cache the full blocks of a prompt; returns how many of its leading tokens were cached already."""
+        cached, block_hash = 0, 0
+        with self.__lock:
+            for end in range(PREFIX_BLOCK_SIZE, len(token_ids) + 1, PREFIX_BLOCK_SIZE):
+                block_hash = hash(
+                    (block_hash, tuple(token_ids[end - PREFIX_BLOCK_SIZE : end]))
+                )
+                if block_hash in self.__blocks and cached == end - PREFIX_BLOCK_SIZE:
+                    cached = end
+                self.__blocks[block_hash] = None
+                self.__blocks.move_to_end(block_hash)
+            while len(self.__blocks) > self.__max_blocks:
+                self.__blocks.popitem(last=False)
+        return cached
+
+
+class SimulatedTokenizer:
+    """Just enough of a HuggingFace tokenizer (encode/decode/eos_token_id) for logits processors."""
+
+    eos_token_id = 0
+
+    def __init__(self):
+        self.__vocab: Dict[int, str] = {}
+
+    def __token_id(self, token: str) -> int:
+        token_id = zlib.crc32(token.encode()) & 0xFFFF or 1  # 0 is EOS
+        self.__vocab[token_id] = (
+            token  # collisions only garble the decoded text a little
+        )
+        return token_id
+
+    def encode(self, text: str, add_special_tokens: bool = False) -> List[int]:
+        return [self.__token_id(token) for token in TOKEN_PATTERN.findall(text)]
+
+    def __call__(
+        self,
+        text: str,
+        add_special_tokens: bool = False,
+        return_offsets_mapping: bool = False,
+    ) -> Dict[str, list]:
+        """Like a fast tokenizer's, with the character span of every token if asked (see prompt_tokens.py)."""
+        matches = list(TOKEN_PATTERN.finditer(text))
+        encoding = {"input_ids": [self.__token_id(match.group()) for match in matches]}
+        if return_offsets_mapping:
+            encoding["offset_mapping"] = [match.span() for match in matches]
+        return encoding
+
+    def decode(self, token_ids: List[int]) -> str:
+        return "".join(self.__vocab.get(token_id, "") for token_id in token_ids)
+
+
+def save_to_cassette(path: str, prompt: str, generation: Generation):
+    """Append a (real) generation to a cassette, e.g. while running against the GPU backend."""
+    info = {
+        key: value
+        for key, value in (generation.generation_info or {}).items()
+        if key in ("finish_reason", "stop_reason", "cumulative_logprob", "token_ids")
+    }
+    info["token_ids"] = list(info.get("token_ids") or [])
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(
+            json.dumps(
+                {"prompt": prompt, "text": generation.text, "generation_info": info}
+            )
+            + "\n"
+        )
+
+
+class SimulatedLLM(BaseLLM):
+    """Simulated (CPU) language model."""
+
+    model: str = "simulated"
+    """Only used to tell models apart."""
+
+    cassette: Optional[str] = None
+    """Path of a JSONL file with recorded generations to replay."""
+
+    prefill_ms_per_token: float = 0.1
+    """Prefill time per prompt token (summed over the batch)."""
+
+    decode_ms_per_token: float = 12.0
+    """Time of one decode step for a single sequence."""
+
+    batch_decode_overhead: float = 0.05
+    """Relative slowdown of a decode step for every extra sequence in the batch."""
+
+    completion_tokens: int = 24
+    """Mean length of a synthesized completion, in tokens."""
+
+    max_new_tokens: int = 512
+    """Maximum number of tokens to generate per output sequence."""
+
+    temperature: float = 1.0
+    """Greedy (0) completions are reproducible, sampled ones are not."""
+
+    top_p: float = 1.0
+
+    logprobs: Optional[int] = None
+    """Whether to return (made up) log probabilities per output token."""
+
+    stop: Optional[List[str]] = None
+    """List of strings that stop the generation when they are generated."""
+
+    max_batch_wait_ms: float = 5.0
+    """Prompts sent concurrently are collected for up to this many milliseconds and decoded as one batch."""
+
+    max_batch_size: int = 16
+    """Maximum number of prompts decoded at once."""
+
+    prompt_lookup_tokens: Optional[int] = None
+    """If set, decode steps are counted as under prompt-lookup speculative decoding (see speculative.py)."""
+
+    prompt_lookup_max_ngram: int = 4
+    """Longest n-gram of the generated tokens that prompt lookup searches for."""
+
+    enable_prefix_caching: bool = False
+    """Whether prompt blocks of earlier requests are reused (no prefill time), like vLLM's automatic prefix caching."""
+
+    prefix_cache_blocks: int = 4096
+    """Blocks of PREFIX_BLOCK_SIZE tokens the prefix cache holds."""
+
+    recordings: Dict[str, Dict[str, Any]] = {}  #: :meta private:
+
+    scheduler: Any  #: :meta private:
+
+    tokenizer: Any  #: :meta private:
+
+    speculation: Any  #: :meta private:
+
+    prefix_cache: Any  #: :meta private:
+
+    @root_validator()
+    def validate_environment(cls, values: Dict) -> Dict:
+        """Load the cassette."""
+        recordings = {}
+        if values["cassette"] is not None:
+            with open(values["cassette"], encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        recordings[record["prompt"]] = record
+        values["recordings"] = recordings
+        return values
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.tokenizer = SimulatedTokenizer()
+        self.speculation = SpeculationStats() if self.prompt_lookup_tokens else None
+        self.prefix_cache = (
+            PrefixCache(self.prefix_cache_blocks)
+            if self.enable_prefix_caching
+            else None
+        )
+        # the scheduler runs the model's batches, so it can only be created once the model exists
+        self.scheduler = MicroBatchScheduler(
+            self._run_batch,
+            max_wait_ms=self.max_batch_wait_ms,
+            max_batch_size=self.max_batch_size,
+        )
+
+    @property
+    def _default_params(self) -> Dict[str, Any]:
+        return {
+            "max_tokens": self.max_new_tokens,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "stop": self.stop,
+            "logprobs": self.logprobs,
+        }
+
+    def _params(self, stop: Optional[List[str]], **kwargs: Any) -> Dict[str, Any]:
+        return {**self._default_params, **kwargs, "stop": stop or self.stop}
+
+    def get_tokenizer(self) -> SimulatedTokenizer:
+        return self.tokenizer
+
+    def get_token_ids(self, text: str) -> List[int]:
+        return self.tokenizer.encode(text)
+
+    def _prompt_token_ids(self, prompt: str) -> List[int]:
+        """Like the engine: the ids of a TokenizedPrompt are used as they are, other prompts are tokenized."""
+        return (
+            prompt.token_ids
+            if isinstance(prompt, TokenizedPrompt)
+            else self.get_token_ids(prompt)
+        )
+
+    def _complete(self, prompt: str, params: Dict[str, Any]) -> Generation:
+        """The completion itself, without any latency."""
+        generation = self._replay_or_synthesize(prompt, params)
+        if (params.get("n") or 1) > 1:
+            # like vLLM's parallel sampling: the other sequences share the prompt, only their decoding differs
+            sequences = [generation] + [
+                self._replay_or_synthesize(prompt, params)
+                for _ in range(params["n"] - 1)
+            ]
+            generation.generation_info["candidates"] = [
+                candidate(
+                    g.text,
+                    self.get_token_ids(g.text),
+                    g.generation_info.get("cumulative_logprob"),
+                )
+                for g in sequences
+            ]
+        if self.speculation is not None:
+            token_ids = self.get_token_ids(generation.text)
+            generation.generation_info["speculation"] = replay(
+                self._prompt_token_ids(prompt),
+                token_ids,
+                self.prompt_lookup_tokens,
+                self.prompt_lookup_max_ngram,
+            )
+            self.speculation.record(
+                generation.generation_info["speculation"], len(token_ids)
+            )
+        return generation
+
+    def _replay_or_synthesize(self, prompt: str, params: Dict[str, Any]) -> Generation:
+        if prompt in self.recordings:
+            record = self.recordings[prompt]
+            return Generation(
+                text=record["text"],
+                generation_info=dict(record.get("generation_info") or {}),
+            )
+
+        if params.get("temperature"):
+            rng = random.Random()
+        else:
+            rng = random.Random(hashlib.sha256(prompt.encode()).digest())
+        # echo a stretch of the prompt, which looks enough like code (minus the template's special tokens)
+        prompt_tokens = [
+            token for token in TOKEN_PATTERN.findall(prompt) if token.isascii()
+        ] or [" "]
+        max_tokens = params.get("max_tokens") or self.max_new_tokens
+        n = min(max(1, round(rng.expovariate(1 / self.completion_tokens))), max_tokens)
+        start = rng.randrange(len(prompt_tokens))
+        tokens = (prompt_tokens[start:] + prompt_tokens)[:n]
+        text, finish_reason = "".join(tokens), "length" if n == max_tokens else "stop"
+        # logits processors are called before every token; the engine stops when they force EOS
+        token_ids = self.get_token_ids(text)
+        for processor in params.get("logits_processors") or []:
+            for i in range(len(token_ids)):
+                if processor.should_stop(token_ids[:i]):
+                    text, finish_reason = self.tokenizer.decode(token_ids[:i]), "stop"
+                    token_ids = token_ids[:i]
+                    break
+        for stop in params.get("stop") or []:
+            if stop in text:
+                text, finish_reason = text[: text.index(stop)], "stop"
+
+        token_ids = self.get_token_ids(text)
+        token_logprobs = [-rng.expovariate(4) for _ in token_ids]
+        logprobs = chosen_logprobs(
+            token_ids,
+            (
+                [
+                    {token_id: Logprob(logprob=logprob, rank=1)}
+                    for token_id, logprob in zip(token_ids, token_logprobs)
+                ]
+                if params.get("logprobs") is not None
+                else None
+            ),
+        )
+        generation_info = {
+            "index": 0,
+            "token_ids": token_ids,
+            "cumulative_logprob": sum(token_logprobs),
+            "logprobs": logprobs,
+            "confidence": confidence(logprobs),
+            "finish_reason": finish_reason,
+            "stop_reason": None,
+        }
+        return Generation(text=text, generation_info=generation_info)
+
+    def _steps(self, generation: Generation) -> int:
+        """Decode steps of a generation: one per token, fewer with speculative decoding."""
+        speculation = generation.generation_info.get("speculation")
+        return (
+            speculation["steps"]
+            if speculation
+            else len(self.get_token_ids(generation.text))
+        )
+
+    def _latency(self, prompts: List[str], generations: List[Generation]) -> float:
+        """Seconds a GPU engine would take to prefill and decode this batch, recorded like VLLM_M's `metrics`."""
+        prompt_ids = [self._prompt_token_ids(p) for p in prompts]
+        cached = [
+            self.prefix_cache.prefill(ids) if self.prefix_cache else 0
+            for ids in prompt_ids
+        ]
+        prefill = self.prefill_ms_per_token * (
+            sum(len(ids) for ids in prompt_ids) - sum(cached)
+        )
+        step = self.decode_ms_per_token * (
+            1 + self.batch_decode_overhead * (len(prompts) - 1)
+        )
+        for ids, cached_tokens, generation in zip(prompt_ids, cached, generations):
+            generation.generation_info["metrics"] = {
+                "queue_ms": 0.0,  # the only wait is the scheduler's, before the batch reaches the engine
+                "prefill_ms": prefill,
+                "decode_ms": self._steps(generation) * step,
+                "prompt_tokens": len(ids),
+                "cached_tokens": cached_tokens,  # served from the prefix cache, no prefill needed
+            }
+        return (prefill + max(self._steps(g) for g in generations) * step) / 1000
+
+    def _run_batch(
+        self, prompts: List[str], params: Dict[str, Any]
+    ) -> List[Generation]:
+        """Called by the scheduler's worker thread, which blocks like the engine would."""
+        generations = [self._complete(prompt, params) for prompt in prompts]
+        time.sleep(self._latency(prompts, generations))
+        return generations
+
+    def _generate(
+        self,
+        prompts: List[str],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> LLMResult:
+        params = self._params(stop, **kwargs)
+        key = repr(sorted(params.items()))
+        futures = [self.scheduler.submit(prompt, params, key) for prompt in prompts]
+        return LLMResult(generations=[[future.result()] for future in futures])
+
+    async def _agenerate(
+        self,
+        prompts: List[str],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> LLMResult:
+        params = self._params(stop, **kwargs)
+        key = repr(sorted(params.items()))
+        futures = [self.scheduler.submit(prompt, params, key) for prompt in prompts]
+        generations = await asyncio.gather(*[asyncio.wrap_future(f) for f in futures])
+        return LLMResult(generations=[[generation] for generation in generations])
+
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        """Yield the completion token by token at the decode rate of a single sequence."""
+        generation = self._complete(prompt, self._params(stop, **kwargs))
+        self._latency([prompt], [generation])
+        await asyncio.sleep(generation.generation_info["metrics"]["prefill_ms"] / 1000)
+        tokens = TOKEN_PATTERN.findall(generation.text)
+        ms_per_token = generation.generation_info["metrics"]["decode_ms"] / max(
+            len(tokens), 1
+        )
+        for token in tokens:
+            await asyncio.sleep(ms_per_token / 1000)
+            yield GenerationChunk(text=token)
+        yield GenerationChunk(text="", generation_info=generation.generation_info)
+
+    # NOTE: same overrides as VLLM_M, so that the metadata is returned as well
+    def invoke(
+        self,
+        input: LanguageModelInput,
+        config: Optional[RunnableConfig] = None,
+        *,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> Generation:
+        config = ensure_config(config)
+        return self.generate_prompt(
+            [self._convert_input(input)],
+            stop=stop,
+            callbacks=config.get("callbacks"),
+            **kwargs,
+        ).generations[0][0]
+
+    async def ainvoke(
+        self,
+        input: LanguageModelInput,
+        config: Optional[RunnableConfig] = None,
+        *,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> Generation:
+        config = ensure_config(config)
+        llm_result = await self.agenerate_prompt(
+            [self._convert_input(input)],
+            stop=stop,
+            callbacks=config.get("callbacks"),
+            **kwargs,
+        )
+        return llm_result.generations[0][0]
+
+    async def astream(
+        self,
+        input: LanguageModelInput,
+        config: Optional[RunnableConfig] = None,
+        *,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        prompt = self._convert_input(input).to_string()
+        async for chunk in self._astream(prompt, stop=stop, **kwargs):
+            yield chunk
+
+    @property
+    def _llm_type(self) -> str:
+        """Return type of llm."""
+        return "simulated"
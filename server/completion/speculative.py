@@ -0,0 +1,121 @@
+"""
+Prompt-lookup (n-gram) speculative decoding.
+
+Completions often copy spans of the prefix or suffix: identifiers, repeated call
+patterns, closing lines. vLLM's `[ngram]` speculative model drafts the next tokens
+by finding the last few generated tokens earlier in the request's own prompt (the
+FIM prompt holds both prefix and suffix) and copying what followed; the model then
+verifies the whole draft in a single forward pass. Turn it on with the engine's
+`prompt_lookup_tokens` (see VLLM_M / SimulatedLLM).
+
+vLLM only reports acceptance for the whole engine, so `replay` re-runs the same
+proposer over a finished request to tell how many decode steps it took and how many
+drafted tokens were accepted. With greedy decoding (what we cache and serve) the
+replay is exact.
+"""
+
+import threading
+from typing import List, Sequence
+
+
+class PromptLookup:
+    """
+    Proposes drafts like vLLM's NGramWorker: the continuation of the first earlier occurrence of the
+    longest (up to `max_ngram` tokens) suffix of the sequence.
+    The token ids are kept as a str of code points, so the search is a (C speed) `str.find`.
+    """
+
+    def __init__(
+        self,
+        token_ids: Sequence[int],
+        num_tokens: int,
+        max_ngram: int = 4,
+        min_ngram: int = 1,
+    ):
+        self.num_tokens = num_tokens
+        self.__max_ngram = max_ngram
+        self.__min_ngram = min_ngram
+        self.__sequence = ""
+        self.extend(token_ids)
+
+    def extend(self, token_ids: Sequence[int]):
+        self.__sequence += "".join(map(chr, token_ids))
+
+    def propose(self) -> List[int]:
+        sequence, end = self.__sequence, len(self.__sequence)
+        for n in range(min(self.__max_ngram, end), self.__min_ngram - 1, -1):
+            start = sequence.find(
+                sequence[end - n :], 0, end - 1
+            )  # an earlier occurrence than the suffix itself
+            if start >= 0:
+                return list(map(ord, sequence[start + n : start + n + self.num_tokens]))
+        return []
+
+
+def replay(
+    prompt_ids: Sequence[int],
+    output_ids: Sequence[int],
+    num_tokens: int,
+    max_ngram: int = 4,
+    min_ngram: int = 1,
+) -> dict:
+    """
+    Decode steps, proposed and accepted draft tokens of a finished request under prompt lookup.
+    Every step emits the accepted part of its draft plus the one token the model computes itself.
+    """
+    lookup = PromptLookup(prompt_ids, num_tokens, max_ngram, min_ngram)
+    steps = proposed = accepted = 0
+    position = 0
+    while position < len(output_ids):
+        draft = lookup.propose()
+        n_accepted = 0
+        for drafted, actual in zip(draft, output_ids[position:]):
+            if drafted != actual:
+                break
+            n_accepted += 1
+        emitted = min(n_accepted + 1, len(output_ids) - position)
+        lookup.extend(output_ids[position : position + emitted])
+        position += emitted
+        steps += 1
+        proposed += len(draft)
+        accepted += n_accepted
+    return {
+        "steps": steps,
+        "proposed_tokens": proposed,
+        "accepted_tokens": accepted,
+        "acceptance_rate": accepted / proposed if proposed else 0.0,
+        "tokens_per_step": len(output_ids) / steps if steps else 0.0,
+    }
+
+
+class SpeculationStats:
+    """Totals of the per-request `replay`s of an engine, for the metrics endpoint."""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__requests = 0
+        self.__steps = 0
+        self.__tokens = 0
+        self.__proposed = 0
+        self.__accepted = 0
+
+    def record(self, replayed: dict, n_tokens: int):
+        with self.__lock:
+            self.__requests += 1
+            self.__steps += replayed["steps"]
+            self.__tokens += n_tokens
+            self.__proposed += replayed["proposed_tokens"]
+            self.__accepted += replayed["accepted_tokens"]
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "requests": self.__requests,
+                "acceptance_rate": (
+                    self.__accepted / self.__proposed if self.__proposed else 0.0
+                ),
+                # the decode speed-up over plain decoding, which needs a step per token
+                "tokens_per_step": (
+                    self.__tokens / self.__steps if self.__steps else 0.0
+                ),
+            }
@@ -0,0 +1,352 @@
+"""
+Language-aware early stopping.
+
+Without stop criteria the engine decodes up to `max_new_tokens` for every request,
+while the plugin only shows the first line (or block) of it. `stopping_params` picks
+the criteria of a request from its trigger, language and cursor position:
+
+- line mode (typing, or the cursor is in the middle of a line): stop at the end of the line,
+  i.e. at the first newline after something was written (a completion may start on the next
+  line, e.g. after `def f():`). Also a logits processor, as a stop string would stop at any newline.
+- block mode (explicit / idle triggers): stop once the block the cursor is in is closed,
+  i.e. a bracket opened before the cursor is closed (brace languages) or a line is
+  indented less than the cursor line (indentation languages). This needs to look at the
+  decoded text, so it is a logits processor that forces EOS.
+  Also stop when the model starts a line that repeats the first line of the suffix.
+
+All of it is enforced inside the engine (stop strings, max_tokens and logits processors),
+so the tokens after the stopping point are never decoded.
+"""
+
+import threading
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from langchain_core.outputs import Generation, GenerationChunk
+from langchain_core.prompts import BasePromptTemplate
+from langchain_core.runnables import Runnable, RunnableConfig
+
+# language ids (LanguageType values) whose blocks are delimited by brackets / by indentation
+BRACE_LANGUAGES = {
+    "c",
+    "cpp",
+    "cuda-cpp",
+    "csharp",
+    "java",
+    "javascript",
+    "javascriptreact",
+    "typescript",
+    "typescriptreact",
+    "go",
+    "rust",
+    "php",
+    "swift",
+    "dart",
+    "groovy",
+    "objective-c",
+    "objective-cpp",
+    "css",
+    "scss",
+    "less",
+    "json",
+    "jsonc",
+    "hlsl",
+    "shaderlab",
+    "r",
+}
+INDENT_LANGUAGES = {"python", "yaml", "coffeescript", "pweave", "jade", "dockercompose"}
+
+# trigger -> mode, the cursor being in the middle of a line always means line mode
+TRIGGER_MODES = {"auto": "line", "typeahead": "line", "man": "block", "idle": "block"}
+
+# the most tokens worth decoding in each mode
+MAX_TOKENS = {"line": 64, "block": 256}
+
+MIN_SUFFIX_STOP_LENGTH = (
+    4  # shorter suffix lines (e.g. ')' or '}') would stop far too eagerly
+)
+
+# sampling of requests for several candidates, as greedy decoding would give the same one n times
+DEFAULT_CANDIDATE_PARAMS = {"temperature": 0.6, "top_p": 0.95}
+
+OPENERS, CLOSERS = "([{", ")]}"
+
+
+def indent_of(line: str) -> int:
+    return len(line) - len(line.lstrip(" \t"))
+
+
+def line_end(text: str) -> Optional[int]:
+    """Where the first line with something written on it ends in the generated text, or None."""
+    start = len(text) - len(text.lstrip())
+    end = text.find("\n", start)
+    return None if start == len(text) or end < 0 else end
+
+
+def block_end(text: str, language: str, base_indent: int) -> Optional[int]:
+    """
+    Where the block the cursor is in ends in the generated text (the index to cut at), or None.
+    Brace languages: right after the bracket that closes a bracket opened before the cursor.
+    Indentation languages: at the start of the first (non-blank) line indented less than the cursor line.
+    """
+    if language in BRACE_LANGUAGES:
+        depth = 0
+        for i, char in enumerate(text):
+            if char in OPENERS:
+                depth += 1
+            elif char in CLOSERS:
+                depth -= 1
+                if depth < 0:
+                    return i + 1
+    elif language in INDENT_LANGUAGES:
+        start = text.find("\n") + 1  # the rest of the cursor line never ends the block
+        while start > 0:
+            end = text.find("\n", start)
+            line = text[start:] if end < 0 else text[start:end]
+            if line.strip() and indent_of(line) < base_indent:
+                return start
+            start = end + 1
+    return None
+
+
+class BlockEndProcessor:
+    """
+    vLLM logits processor that forces EOS once the generated text closes the cursor's block.
+    Stateless apart from the request's parameters, so it can be re-run on any prefix of the output.
+    """
+
+    def __init__(self, tokenizer: Any, language: str, base_indent: int):
+        self.tokenizer = tokenizer
+        self.language = language
+        self.base_indent = base_indent
+
+    def should_stop(self, token_ids: List[int]) -> bool:
+        if not token_ids:
+            return False
+        # only a newline or a closing bracket can end a block, so skip decoding everything otherwise
+        last = self.tokenizer.decode(token_ids[-1:])
+        if "\n" not in last and not any(char in last for char in CLOSERS):
+            if self.language not in INDENT_LANGUAGES or not last.strip():
+                return False
+        return (
+            block_end(self.tokenizer.decode(token_ids), self.language, self.base_indent)
+            is not None
+        )
+
+    def __call__(self, token_ids: List[int], logits):
+        if self.should_stop(token_ids):
+            logits[:] = float("-inf")
+            logits[self.tokenizer.eos_token_id] = 0.0
+        return logits
+
+    def __repr__(self) -> str:
+        # part of the completion cache key, so it describes the behaviour rather than the instance
+        return f"BlockEndProcessor({self.language!r}, {self.base_indent})"
+
+
+class LineEndProcessor:
+    """vLLM logits processor that forces EOS at the end of the first non-blank generated line."""
+
+    def __init__(self, tokenizer: Any):
+        self.tokenizer = tokenizer
+
+    def should_stop(self, token_ids: List[int]) -> bool:
+        if not token_ids or "\n" not in self.tokenizer.decode(token_ids[-1:]):
+            return False
+        return line_end(self.tokenizer.decode(token_ids)) is not None
+
+    def __call__(self, token_ids: List[int], logits):
+        if self.should_stop(token_ids):
+            logits[:] = float("-inf")
+            logits[self.tokenizer.eos_token_id] = 0.0
+        return logits
+
+    def __repr__(self) -> str:
+        return "LineEndProcessor()"
+
+
+def stopping_mode(inputs: Dict[str, Any]) -> str:
+    """'line' or 'block', see the module docstring."""
+    rest_of_line = inputs["suffix"].split("\n", 1)[0]
+    if rest_of_line.strip():
+        return "line"
+    return TRIGGER_MODES.get(inputs.get("trigger"), "block")
+
+
+def stopping_params(inputs: Dict[str, Any], tokenizer: Any) -> Dict[str, Any]:
+    """Sampling parameters (stop, max_tokens, logits_processors) for a request of the chain."""
+    prefix, suffix = inputs["prefix"], inputs["suffix"]
+    language, mode = inputs.get("language"), stopping_mode(inputs)
+    params = {"stop": [], "max_tokens": MAX_TOKENS[mode]}
+    if mode == "line":
+        params["logits_processors"] = [LineEndProcessor(tokenizer)]
+        return params
+
+    # anchored at the start of a line, so that the model can still write the same code mid-line
+    suffix_line = next((line for line in suffix.split("\n") if line.strip()), "")
+    if len(suffix_line.strip()) >= MIN_SUFFIX_STOP_LENGTH:
+        params["stop"].append("\n" + suffix_line.rstrip())
+    if language in BRACE_LANGUAGES or language in INDENT_LANGUAGES:
+        cursor_line = prefix.rsplit("\n", 1)[-1]
+        params["logits_processors"] = [
+            BlockEndProcessor(tokenizer, language, indent_of(cursor_line))
+        ]
+    return params
+
+
+def completion_end(inputs: Dict[str, Any]) -> Optional[Callable[[str], Optional[int]]]:
+    """Where a request's completion ends in the generated text (`line_end` / `block_end`), if it is cut."""
+    if stopping_mode(inputs) == "line":
+        return line_end
+    language = inputs.get("language")
+    if language in INDENT_LANGUAGES:
+        base_indent = indent_of(inputs["prefix"].rsplit("\n", 1)[-1])
+        return lambda text: block_end(text, language, base_indent)
+    return None
+
+
+class StoppingModel(Runnable):
+    """
+    Formats the chain's input dict with `prompt` and runs it through `model` (e.g. a CachedModel)
+    with the request's stopping parameters. Adds `decoded_tokens` (what the engine decoded) and
+    `returned_tokens` (what is returned) to the generation info.
+    Requests for several candidates (`inputs['candidates']`) are sampled `n` at a time in one
+    engine call with `candidate_params`, and each candidate is cut at the end of the block.
+    """
+
+    def __init__(
+        self,
+        prompt: BasePromptTemplate,
+        model: Runnable,
+        tokenizer: Callable[[], Any],
+        count_tokens: Callable[[str], int],
+        candidate_params: Optional[Dict[str, Any]] = None,
+    ):
+        self.prompt = prompt
+        self.model = model
+        # a getter, as the tokenizer is only needed once a logits processor decodes
+        self.__tokenizer = tokenizer
+        self.__count_tokens = count_tokens
+        self.__candidate_params = candidate_params or DEFAULT_CANDIDATE_PARAMS
+        self.__lock = threading.Lock()
+        self.__modes = {"line": 0, "block": 0}
+        self.__decoded_tokens = 0
+        self.__returned_tokens = 0
+
+    def params(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """The stopping (and candidate) parameters of a request, counted in the stats."""
+        params = stopping_params(inputs, _LazyTokenizer(self.__tokenizer))
+        if (inputs.get("candidates") or 1) > 1:
+            params.update(self.__candidate_params, n=inputs["candidates"])
+        with self.__lock:
+            self.__modes[stopping_mode(inputs)] += 1
+        return params
+
+    def finish(
+        self, inputs: Dict[str, Any], text: str, generation_info: Optional[dict]
+    ) -> Generation:
+        """Cut the completion at the end of the line or block and count its tokens."""
+        generation_info = dict(generation_info or {})
+        end_of = completion_end(inputs)
+        if end_of is not None:
+            # the token with the newline (or that started the dedented line) is decoded before EOS
+            # can be forced
+
+            def cut(text: str) -> str:
+                end = end_of(text)
+                return text if end is None else text[:end]
+
+            text = cut(text)
+            if generation_info.get("candidates"):
+                generation_info["candidates"] = [
+                    {**candidate, "text": cut(candidate["text"])}
+                    for candidate in generation_info["candidates"]
+                ]
+        decoded = (
+            0
+            if generation_info.get("cached")
+            else len(generation_info.get("token_ids") or [])
+        )
+        returned = self.__count_tokens(text) if text else 0
+        generation_info.update(decoded_tokens=decoded, returned_tokens=returned)
+        with self.__lock:
+            self.__decoded_tokens += decoded
+            self.__returned_tokens += returned
+        return Generation(text=text, generation_info=generation_info)
+
+    def invoke(
+        self,
+        input: Dict[str, Any],
+        config: Optional[RunnableConfig] = None,
+        **kwargs: Any,
+    ) -> Generation:
+        generation = self.model.invoke(
+            self.prompt.invoke(input), config, **self.params(input), **kwargs
+        )
+        return self.finish(input, generation.text, generation.generation_info)
+
+    async def ainvoke(
+        self,
+        input: Dict[str, Any],
+        config: Optional[RunnableConfig] = None,
+        **kwargs: Any,
+    ) -> Generation:
+        prompt = await self.prompt.ainvoke(input)
+        generation = await self.model.ainvoke(
+            prompt, config, **self.params(input), **kwargs
+        )
+        return self.finish(input, generation.text, generation.generation_info)
+
+    async def astream(
+        self,
+        input: Dict[str, Any],
+        config: Optional[RunnableConfig] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        prompt = await self.prompt.ainvoke(input)
+        async for chunk in self.trim_stream(
+            input, self.model.astream(prompt, config, **self.params(input), **kwargs)
+        ):
+            yield chunk
+
+    async def trim_stream(
+        self, inputs: Dict[str, Any], chunks: AsyncIterator[GenerationChunk]
+    ) -> AsyncIterator[GenerationChunk]:
+        """`finish` for a stream: holds back what the line or block end check might still cut."""
+        text, generation_info, sent = "", None, 0
+        async for chunk in chunks:
+            text += chunk.text
+            generation_info = chunk.generation_info or generation_info
+            if chunk.generation_info is None:
+                # hold back whatever the end check might still cut (past the line end / the current line)
+                if stopping_mode(inputs) == "line":
+                    safe = line_end(text)
+                    safe = len(text) if safe is None else safe
+                elif inputs.get("language") in INDENT_LANGUAGES:
+                    safe = text.rfind("\n") + 1
+                else:
+                    safe = len(text)
+                if safe > sent:
+                    yield GenerationChunk(text=text[sent:safe])
+                    sent = safe
+        generation = self.finish(inputs, text, generation_info)
+        yield GenerationChunk(
+            text=generation.text[sent:], generation_info=generation.generation_info
+        )
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "modes": dict(self.__modes),
+                "decoded_tokens": self.__decoded_tokens,
+                "returned_tokens": self.__returned_tokens,
+            }
+
+
+class _LazyTokenizer:
+    """Defers getting the engine's tokenizer until a logits processor actually decodes."""
+
+    def __init__(self, get_tokenizer: Callable[[], Any]):
+        self.__get_tokenizer = get_tokenizer
+
+    def __getattr__(self, name: str):
+        return getattr(self.__get_tokenizer(), name)
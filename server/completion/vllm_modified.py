@@ -2,6 +2,28 @@
 Interactions between vLLM and LangChain
 '''
 
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, AsyncIterator, Dict, List, Optional
+from uuid import uuid4
+
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.language_models.base import LanguageModelInput
+from langchain_core.language_models.llms import BaseLLM
+from langchain_core.outputs import Generation, GenerationChunk, LLMResult
+from langchain_core.pydantic_v1 import Field, root_validator
+from langchain_core.runnables import RunnableConfig, ensure_config
+from vllm import RequestOutput, SamplingParams
+
+from .batching import MicroBatchScheduler
+from .confidence import candidate, chosen_logprobs, confidence
+from .prompt_tokens import TokenizedPrompt
+from .speculative import SpeculationStats, replay
+
 ''' 
 Modified VLLM model to return logprobs and other metadata. 
 Why can't I just override the `_generate` method? Pydantic doesn't allow this. 
@@ -13,18 +35,41 @@ This returns just the output Text in case of ABC `BaseLLM`, which `VLLM` impleme
 Thus, I modify the `invoke` method to return the metadata as well.
 
 I also add `_agenerate` and `ainvoke` because we're in async land. 
+Likewise, `astream` yields `GenerationChunk`s (rather than str) so the last chunk 
+can carry the metadata. 
+With `use_async_engine=True` the model is backed by vLLM's `AsyncLLMEngine`, which 
+lives on its own event loop thread. Requests are submitted to that loop, so the 
+FastAPI event loop only awaits them and keeps serving other traffic in the meantime. 
+Cancelling a request (e.g. one superseded by a newer request of the session) aborts it in 
+the async engine. The blocking engine cannot be interrupted: with micro-batching, a prompt 
+still waiting for its batch is dropped, but a batch that started decodes to the end. 
+Prompts that come tokenized already (prompt_tokens.TokenizedPrompt) are handed to the 
+engine as token ids, so it does not tokenize them again. 
 '''
 
-from typing import Any, Dict, List, Optional
 
-from langchain_core.callbacks import CallbackManagerForLLMRun
-from langchain_core.language_models.llms import BaseLLM
-from langchain_core.outputs import Generation, LLMResult
-from langchain_core.pydantic_v1 import Field, root_validator
-from vllm import SamplingParams
+def engine_metrics(request_output: RequestOutput) -> Optional[Dict[str, float]]:
+    ''' Where a finished request spent its time in the engine (ms), from vLLM's RequestMetrics. '''
+    metrics = request_output.metrics
+    if metrics is None or metrics.first_scheduled_time is None or metrics.first_token_time is None:
+        return None
+    finished_time = metrics.finished_time or metrics.last_token_time
+    return {
+        "queue_ms": 1000 * (metrics.first_scheduled_time - metrics.arrival_time),  # waiting to be scheduled
+        "prefill_ms": 1000 * (metrics.first_token_time - metrics.first_scheduled_time),  # up to the first token
+        "decode_ms": 1000 * (finished_time - metrics.first_token_time),  # the remaining tokens
+        "prompt_tokens": len(request_output.prompt_token_ids),
+        # served from the prefix cache, only reported by vLLM versions that count them
+        "cached_tokens": getattr(request_output, "num_cached_tokens", None),
+    }
+
+
+def engine_input(prompt: str) -> Any:
+    ''' What the engine is given: the token ids of a TokenizedPrompt (a vllm TokensPrompt), the text of any other. '''
+    if isinstance(prompt, TokenizedPrompt):
+        return {"prompt_token_ids": prompt.token_ids}
+    return prompt
 
-from langchain_core.runnables import RunnableConfig, ensure_config
-from langchain_core.language_models.base import LanguageModelInput
 
 class VLLM_M(BaseLLM):
     """VLLM language model."""
@@ -88,8 +133,32 @@ class VLLM_M(BaseLLM):
     vllm_kwargs: Dict[str, Any] = Field(default_factory=dict)
     """Holds any model parameters valid for `vllm.LLM` call not explicitly specified."""
 
+    use_async_engine: bool = False
+    """Whether to use vLLM's `AsyncLLMEngine` (continuous batching, non-blocking) 
+    instead of the blocking `vllm.LLM`."""
+
+    max_batch_wait_ms: Optional[float] = None
+    """If set, prompts sent concurrently to the blocking engine are collected for up to 
+    this many milliseconds and decoded as one batch. Unused with the async engine."""
+
+    max_batch_size: int = 16
+    """Maximum number of prompts the micro-batching scheduler submits at once."""
+
+    prompt_lookup_tokens: Optional[int] = None
+    """If set, speculative decoding drafts up to this many tokens per step by n-gram lookup 
+    in the prompt (vLLM's `[ngram]` speculative model). See speculative.py."""
+
+    prompt_lookup_max_ngram: int = 4
+    """Longest n-gram of the generated tokens that prompt lookup searches for."""
+
     client: Any  #: :meta private:
 
+    speculation: Any  #: :meta private:
+
+    engine_loop: Any  #: :meta private:
+
+    scheduler: Any  #: :meta private:
+
     @root_validator()
     def validate_environment(cls, values: Dict) -> Dict:
         """Validate that python package exists in environment."""
@@ -102,14 +171,55 @@ class VLLM_M(BaseLLM):
                 "Please install it with `pip install vllm`."
             )
 
+        speculative_kwargs = {}
+        values["speculation"] = None
+        if values["prompt_lookup_tokens"]:
+            speculative_kwargs = {
+                "speculative_model": "[ngram]",
+                "num_speculative_tokens": values["prompt_lookup_tokens"],
+                "ngram_prompt_lookup_max": values["prompt_lookup_max_ngram"],
+                "use_v2_block_manager": True,  # required by speculative decoding
+            }
+            values["speculation"] = SpeculationStats()
+
+        if values["use_async_engine"]:
+            from vllm import AsyncEngineArgs, AsyncLLMEngine
+
+            engine_args = AsyncEngineArgs(
+                model=values["model"],
+                tensor_parallel_size=values["tensor_parallel_size"],
+                trust_remote_code=values["trust_remote_code"],
+                dtype=values["dtype"],
+                download_dir=values["download_dir"],
+                # the async engine logs every request by default, which floods the logs
+                **{"disable_log_requests": True, **speculative_kwargs, **values["vllm_kwargs"]},
+            )
+            values["client"] = AsyncLLMEngine.from_engine_args(engine_args)
+
+            # the engine's background loop is bound to the event loop it starts on,
+            # so give it a dedicated one rather than whichever loop calls us first
+            values["engine_loop"] = asyncio.new_event_loop()
+            threading.Thread(
+                target=values["engine_loop"].run_forever,
+                name=f"vllm-engine-loop-{values['model']}",
+                daemon=True,
+            ).start()
+            return values
+
         values["client"] = VLLModel(
             model=values["model"],
             tensor_parallel_size=values["tensor_parallel_size"],
             trust_remote_code=values["trust_remote_code"],
             dtype=values["dtype"],
             download_dir=values["download_dir"],
-            **values["vllm_kwargs"],
+            **{**speculative_kwargs, **values["vllm_kwargs"]},
         )
+        if values["max_batch_wait_ms"] is not None:
+            values["scheduler"] = MicroBatchScheduler(
+                values["client"].generate,
+                max_wait_ms=values["max_batch_wait_ms"],
+                max_batch_size=values["max_batch_size"],
+            )
 
         return values
 
@@ -131,6 +241,93 @@ class VLLM_M(BaseLLM):
             "logprobs": self.logprobs,
         }
 
+    def get_tokenizer(self) -> Any:
+        ''' The model's HuggingFace tokenizer, e.g. for logits processors that look at the decoded text. '''
+        engine = self.client.engine if self.use_async_engine else self.client.llm_engine
+        return engine.get_tokenizer()
+
+    def get_token_ids(self, text: str) -> List[int]:
+        ''' Tokenize with the model's own tokenizer, instead of LangChain's default (GPT-2) one. '''
+        return self.get_tokenizer().encode(text, add_special_tokens=False)
+
+    def _params(self, stop: Optional[List[str]], **kwargs: Any) -> Dict[str, Any]:
+        ''' Build the sampling parameters for a single call. '''
+        return {**self._default_params, **kwargs, "stop": stop}
+
+    def _schedule(self, prompts: List[str], params: Dict[str, Any]) -> List[Future]:
+        ''' Hand prompts to the micro-batching scheduler; identical params share a batch. '''
+        sampling_params = SamplingParams(**params)
+        key = repr(sorted(params.items()))
+        return [self.scheduler.submit(engine_input(prompt), sampling_params, key) for prompt in prompts]
+
+    def _to_generation(self, request_output: RequestOutput) -> Generation:
+        ''' Convert a finished vLLM RequestOutput into a Generation with its metadata. '''
+        output = request_output.outputs[0]
+        text = output.text
+
+        # NOTE: added modification
+        # get all the other metadata e.g. logprobs and stop reason. Of the logprobs only
+        # those of the chosen tokens are kept, packed, rather than a dict per token
+        logprobs = chosen_logprobs(output.token_ids, output.logprobs)
+        generation_info = {
+            "index": output.index,
+            "token_ids": output.token_ids,
+            "cumulative_logprob": output.cumulative_logprob,
+            "logprobs": logprobs,
+            "confidence": confidence(logprobs),
+            "finish_reason": output.finish_reason,
+            "stop_reason": output.stop_reason,
+            "metrics": engine_metrics(request_output),
+        }
+        if len(request_output.outputs) > 1:
+            # the other sequences of a request for several (n), which shared its prompt's KV cache
+            generation_info["candidates"] = [
+                candidate(o.text, o.token_ids, o.cumulative_logprob) for o in request_output.outputs
+            ]
+
+        if self.speculation is not None:
+            # decode steps and accepted draft tokens of this request, see speculative.py
+            generation_info["speculation"] = replay(
+                request_output.prompt_token_ids, output.token_ids,
+                self.prompt_lookup_tokens, self.prompt_lookup_max_ngram,
+            )
+            self.speculation.record(generation_info["speculation"], len(output.token_ids))
+
+        return Generation(text=text, generation_info=generation_info)
+
+    async def _engine_generate(
+        self, prompt: str, sampling_params: SamplingParams
+    ) -> RequestOutput:
+        ''' Run one prompt through the async engine. Must be scheduled on `engine_loop`. '''
+        final_output = None
+        async for request_output in self.client.generate(
+            engine_input(prompt), sampling_params, str(uuid4())
+        ):
+            final_output = request_output
+        return final_output
+
+    async def _engine_stream(
+        self,
+        prompt: str,
+        sampling_params: SamplingParams,
+        loop: asyncio.AbstractEventLoop,
+        queue: asyncio.Queue,
+    ) -> None:
+        ''' Forward every partial output to `queue` on the caller's `loop`, then a None sentinel. '''
+        try:
+            async for request_output in self.client.generate(
+                engine_input(prompt), sampling_params, str(uuid4())
+            ):
+                loop.call_soon_threadsafe(queue.put_nowait, request_output)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    def _submit(self, prompt: str, sampling_params: SamplingParams) -> Future:
+        ''' Schedule a generation on the engine loop; cancelling the future aborts it. '''
+        return asyncio.run_coroutine_threadsafe(
+            self._engine_generate(prompt, sampling_params), self.engine_loop
+        )
+
     def _generate(
         self,
         prompts: List[str],
@@ -141,25 +338,88 @@ class VLLM_M(BaseLLM):
         ''' Run the LLM on the given prompt and input. Return logprobs and other metadata '''
 
         # build sampling parameters
-        params = {**self._default_params, **kwargs, "stop": stop}
-        sampling_params = SamplingParams(**params)
+        params = self._params(stop, **kwargs)
         # call the model
-        outputs = self.client.generate(prompts, sampling_params)
-
-        generations = []
-        for output in outputs:
+        if self.use_async_engine:
+            sampling_params = SamplingParams(**params)
+            futures = [self._submit(prompt, sampling_params) for prompt in prompts]
+            outputs = [future.result() for future in futures]
+        elif self.scheduler is not None:
+            outputs = [future.result() for future in self._schedule(prompts, params)]
+        else:
+            outputs = self.client.generate([engine_input(prompt) for prompt in prompts], SamplingParams(**params))
+
+        generations = [[self._to_generation(output)] for output in outputs]
+        return LLMResult(generations=generations)
 
-            output = output.outputs[0]
-            text = output.text
-            
-            # NOTE: added modification
-            # get all the other metadata e.g. logprobs and stop reason
-            del output.__dict__['text']
-            generation_info = output.__dict__
+    async def _agenerate(
+        self,
+        prompts: List[str],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> LLMResult:
+        ''' Async counterpart of `_generate`, awaits the engine without blocking the caller's loop '''
+        params = self._params(stop, **kwargs)
+        if self.use_async_engine:
+            sampling_params = SamplingParams(**params)
+            futures = [self._submit(prompt, sampling_params) for prompt in prompts]
+        elif self.scheduler is not None:
+            futures = self._schedule(prompts, params)
+        else:
+            # the blocking engine can only be pushed to a worker thread
+            return await super()._agenerate(prompts, stop, run_manager, **kwargs)
+
+        outputs = await asyncio.gather(*[asyncio.wrap_future(f) for f in futures])
+
+        generations = [[self._to_generation(output)] for output in outputs]
+        return LLMResult(generations=generations)
 
-            generations.append([Generation(text=text, generation_info=generation_info)])
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        ''' Yield the newly decoded text as it arrives; the last chunk holds the metadata '''
+        if not self.use_async_engine:
+            # the blocking engine has no partial outputs, so the whole generation is one chunk
+            result = await self._agenerate([prompt], stop, run_manager, **kwargs)
+            generation = result.generations[0][0]
+            yield GenerationChunk(
+                text=generation.text, generation_info=generation.generation_info
+            )
+            return
 
-        return LLMResult(generations=generations)
+        params = self._params(stop, **kwargs)
+        sampling_params = SamplingParams(**params)
+        # vLLM only cuts a stop string off once it is complete, so the partial output can end in
+        # the start of one; hold back that many characters until the request is finished
+        hold_back = max((len(s) for s in params["stop"] or []), default=1) - 1
+        queue = asyncio.Queue()
+        future = asyncio.run_coroutine_threadsafe(
+            self._engine_stream(
+                prompt, sampling_params, asyncio.get_running_loop(), queue
+            ),
+            self.engine_loop,
+        )
+        try:
+            sent, final_output = 0, None  # characters yielded so far
+            while (request_output := await queue.get()) is not None:
+                final_output = request_output
+                text = request_output.outputs[0].text
+                safe = len(text) if request_output.finished else len(text) - hold_back
+                if safe > sent:
+                    yield GenerationChunk(text=text[sent:safe])
+                    sent = safe
+            await asyncio.wrap_future(future)  # re-raise engine errors, if any
+
+            # a closing chunk with whatever was held back and the metadata of the finished request
+            generation = self._to_generation(final_output)
+            yield GenerationChunk(text=generation.text[sent:], generation_info=generation.generation_info)
+        finally:
+            future.cancel()  # the caller stopped listening -> abort the request in the engine
 
     # NOTE: Added from langchain_core.language_models.llms.BaseLLM
     def invoke(
@@ -183,6 +443,40 @@ class VLLM_M(BaseLLM):
         ).generations[0][0]
         return llm_result
 
+    # NOTE: Added from langchain_core.language_models.llms.BaseLLM
+    async def ainvoke(
+        self,
+        input: LanguageModelInput,
+        config: Optional[RunnableConfig] = None,
+        *,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> Generation:
+        config = ensure_config(config)
+        llm_result = await self.agenerate_prompt(
+            [self._convert_input(input)],
+            stop=stop,
+            callbacks=config.get("callbacks"),
+            tags=config.get("tags"),
+            metadata=config.get("metadata"),
+            run_name=config.get("run_name"),
+            run_id=config.pop("run_id", None),
+            **kwargs,
+        )
+        return llm_result.generations[0][0]
+
+    # NOTE: Added from langchain_core.language_models.llms.BaseLLM
+    async def astream(
+        self,
+        input: LanguageModelInput,
+        config: Optional[RunnableConfig] = None,
+        *,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        prompt = self._convert_input(input).to_string()
+        async for chunk in self._astream(prompt, stop=stop, **kwargs):
+            yield chunk
 
     @property
     def _llm_type(self) -> str:
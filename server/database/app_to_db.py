@@ -1,4 +1,5 @@
 import logging
+from array import array
 from logging import Logger
 from typing import List
 
@@ -123,18 +124,27 @@ def get_generation_from_request(
                     query_id=query.query_id,
                     model_id=app.llms[completion_model],
                     completion=request.completions[completion_model].completion,
-                    generation_time=0,
+                    # 0 for completions that were not generated, e.g. typed through
+                    generation_time=request.completions[
+                        completion_model
+                    ].generation_time
+                    or 0,
+                    queue_time=request.completions[completion_model].queue_time,
+                    prefill_time=request.completions[completion_model].prefill_time,
+                    decode_time=request.completions[completion_model].decode_time,
+                    prompt_tokens=request.completions[completion_model].prompt_tokens,
+                    generated_tokens=request.completions[
+                        completion_model
+                    ].generated_tokens,
                     shown_at=[
                         str(x) for x in request.completions[completion_model].shown_at
                     ],
                     was_accepted=request.completions[completion_model].accepted,
-                    confidence=1.0,
-                    logprobs=[
-                        0.2,
-                        0.3,
-                        0.4,
-                        0.1,
-                    ],  # TODO: Fix this -> this is simply a placeholder for the time being
+                    confidence=request.completions[completion_model].confidence,
+                    # unpacked only here, the session keeps them as packed float32
+                    logprobs=array(
+                        "f", request.completions[completion_model].logprobs
+                    ).tolist(),
                 )
             )
 
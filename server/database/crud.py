@@ -237,6 +237,21 @@ def get_telemetries_with_relative_document_position_in_range(db: Session, lower_
     return get_all_telemetries(db)
 
 
+def get_telemetries_with_acceptance(db: Session) -> list[tuple]:
+    """
+    One row per query: its telemetry (time_since_last_completion, typing_speed, document_char_length,
+    relative_document_position) and whether any of its completions was accepted. Used to train the TelemetryGate.
+    """
+    return db.query(db_models.Telemetry.time_since_last_completion,
+                    db_models.Telemetry.typing_speed,
+                    db_models.Telemetry.document_char_length,
+                    db_models.Telemetry.relative_document_position,
+                    func.bool_or(db_models.HadGeneration.was_accepted)) \
+        .join(db_models.Query, db_models.Query.telemetry_id == db_models.Telemetry.telemetry_id) \
+        .join(db_models.HadGeneration, db_models.HadGeneration.query_id == db_models.Query.query_id) \
+        .group_by(db_models.Telemetry.telemetry_id).all()
+
+
 # context Table
 def get_all_contexts(db: Session) -> list[Type[db_models.Context]]:
     return db.query(db_models.Context).all()
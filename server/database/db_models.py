@@ -83,8 +83,14 @@ class HadGeneration(Base):
     generation_time = Column(Integer, nullable=False)
     shown_at = Column(ARRAY(DateTime(timezone=True)), nullable=False)
     was_accepted = Column(Boolean, nullable=False)
-    confidence = Column(Float, nullable=False)
+    confidence = Column(Float, nullable=True)  # NULL when unknown, see update_3_nullable_confidence.sql
     logprobs = Column(ARRAY(Float), nullable=False)
+    # where the generation_time went (ms) and its size, see update_4_generation_timing.sql
+    queue_time = Column(Integer, nullable=True)
+    prefill_time = Column(Integer, nullable=True)
+    decode_time = Column(Integer, nullable=True)
+    prompt_tokens = Column(Integer, nullable=True)
+    generated_tokens = Column(Integer, nullable=True)
 
     query = relationship('Query', back_populates='had_generations')
     model = relationship('ModelName', back_populates='had_generations')
@@ -112,8 +112,13 @@ class HadGenerationBase(BaseModel):
     generation_time: int
     shown_at: list[str]
     was_accepted: bool
-    confidence: float
+    confidence: float | None
     logprobs: list[float]
+    queue_time: int | None = None  # ms, see update_4_generation_timing.sql
+    prefill_time: int | None = None
+    decode_time: int | None = None
+    prompt_tokens: int | None = None
+    generated_tokens: int | None = None
 
 
 class HadGeneration(HadGenerationBase):
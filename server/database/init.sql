@@ -52,8 +52,13 @@ CREATE TABLE IF NOT EXISTS public.had_generation
     generation_time integer NOT NULL,
     shown_at timestamp with time zone[] NOT NULL,
     was_accepted boolean NOT NULL,
-    confidence double precision NOT NULL,
+    confidence double precision, -- NULL when unknown (no logprobs), see update_3
     logprobs double precision[] NOT NULL,
+    queue_time integer, -- ms in the engine's queue / prefill / decode, and token counts, see update_4
+    prefill_time integer,
+    decode_time integer,
+    prompt_tokens integer,
+    generated_tokens integer,
     PRIMARY KEY (query_id, model_id)
 );
 
@@ -188,7 +193,7 @@ INSERT INTO public.programming_language (language_name) VALUES ('plaintext'), ('
                                                                ('jlweave'), ('rsweave'), ('csv'), ('tsv'), ('jinja'),
                                                                ('pip-requirements'), ('toml'), ('raw'), ('ssh_config'),
                                                                ('Vimscript');
-INSERT INTO public.trigger_type (trigger_type_name) VALUES ('man'), ('auto'), ('idle');
+INSERT INTO public.trigger_type (trigger_type_name) VALUES ('man'), ('auto'), ('idle'), ('typeahead');
 -- we can later add the actual plugin versions
 INSERT INTO public.plugin_version (version_name, ide_type, description) VALUES ('0.0.1j', 'JetBrains', 'the mvp version of the plugin'),
                                                                                ('0.0.1v', 'VSCode', 'the mvp version of the plugin');
@@ -0,0 +1,18 @@
+-- requests answered with the rest of the previous completion (the user typed through it) are stored
+-- with their own trigger type, see TriggerType.typeahead in models/Types.py
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1
+        FROM information_schema.tables
+        WHERE table_name = 'trigger_type'
+    ) AND NOT EXISTS (
+        SELECT 1
+        FROM public.trigger_type
+        WHERE trigger_type_name = 'typeahead'
+    ) THEN
+        INSERT INTO public.trigger_type (trigger_type_name)
+        VALUES ('typeahead');
+    END IF;
+END
+$$;
@@ -0,0 +1,15 @@
+-- completions that did not come from a model (e.g. the rest of a completion the user typed through)
+-- have no logprobs, so their confidence is unknown rather than a placeholder value
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1
+        FROM information_schema.columns
+        WHERE table_name = 'had_generation'
+        AND column_name = 'confidence'
+        AND is_nullable = 'NO'
+    ) THEN
+        ALTER TABLE public.had_generation ALTER COLUMN confidence DROP NOT NULL;
+    END IF;
+END
+$$;
@@ -0,0 +1,50 @@
+-- where each generation's time went in the engine (milliseconds) and how many tokens it took,
+-- from vLLM's request metrics (see engine_metrics in completion/vllm_modified.py)
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1
+        FROM information_schema.columns
+        WHERE table_name = 'had_generation'
+        AND column_name = 'queue_time'
+    ) THEN
+        ALTER TABLE public.had_generation ADD COLUMN queue_time integer;
+    END IF;
+
+    IF NOT EXISTS (
+        SELECT 1
+        FROM information_schema.columns
+        WHERE table_name = 'had_generation'
+        AND column_name = 'prefill_time'
+    ) THEN
+        ALTER TABLE public.had_generation ADD COLUMN prefill_time integer;
+    END IF;
+
+    IF NOT EXISTS (
+        SELECT 1
+        FROM information_schema.columns
+        WHERE table_name = 'had_generation'
+        AND column_name = 'decode_time'
+    ) THEN
+        ALTER TABLE public.had_generation ADD COLUMN decode_time integer;
+    END IF;
+
+    IF NOT EXISTS (
+        SELECT 1
+        FROM information_schema.columns
+        WHERE table_name = 'had_generation'
+        AND column_name = 'prompt_tokens'
+    ) THEN
+        ALTER TABLE public.had_generation ADD COLUMN prompt_tokens integer;
+    END IF;
+
+    IF NOT EXISTS (
+        SELECT 1
+        FROM information_schema.columns
+        WHERE table_name = 'had_generation'
+        AND column_name = 'generated_tokens'
+    ) THEN
+        ALTER TABLE public.had_generation ADD COLUMN generated_tokens integer;
+    END IF;
+END
+$$;
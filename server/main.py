@@ -1,8 +1,10 @@
+import asyncio
 import datetime
+import hashlib
 import json
 import threading
 import time
-from typing import Union
+from typing import AsyncIterator, Union
 
 import os
 import logging
@@ -10,18 +12,27 @@ from uuid import uuid4
 
 import sqlalchemy.orm
 from fastapi import FastAPI, APIRouter, Request, WebSocket, WebSocketDisconnect
-from starlette.responses import FileResponse
-from contextlib import asynccontextmanager
+from pydantic import BaseModel
+from starlette.responses import FileResponse, StreamingResponse
+from contextlib import asynccontextmanager, aclosing
 
 from database.db_schemas import UserCreate
 from models.Requests import SessionEndRequest
-from models.Responses import NewUserResponse
+from models.Responses import NewUserResponse, MetricsResponse
 from models.Sessions import (
     Session,
     SessionManager,
     delete_expired_sessions,
 )
-from completion import chain as completion_chain
+from completion import (
+    chain as completion_chain,
+    fast_chain as completion_fast_chain,
+    astream as completion_stream,
+    route as completion_route,
+    stats as completion_stats,
+    set_deadlines as completion_set_deadlines,
+    warm_up as completion_warm_up,
+)
 from database import get_db
 from database.crud import (
     get_user_by_token,
@@ -33,15 +44,29 @@ from database.crud import (
 )
 from models import (
     GenerateRequest,
+    ContextFile,
     VerifyRequest,
     SurveyRequest,
     SessionRequest,
     GenerateResponse,
+    ModelTiming,
+    CompletionCandidate,
+    CompletionChunk,
     VerifyResponse,
     SurveyResponse,
     SessionResponse,
     ErrorResponse,
     CoCoConfig,
+    TriggerType,
+    TelemetryGate,
+    AdmissionQueue,
+    AdmissionRejected,
+    SingleFlight,
+    EncodedRoute,
+    JSON,
+    encode,
+    decode,
+    websocket_media_type,
 )
 
 import pickle
@@ -155,6 +180,272 @@ def get_session_by_token_if_exists(fastapi: FastAPI, session_token: str):
     return fastapi.session_manager.get_session(session_token)
 
 
+def supersede_in_flight_request(
+    fastapi: FastAPI, session: Session, request_id: str, handle
+):
+    """
+    A function which registers a new generation for the session and cancels the one it replaces.
+    """
+    if session.supersede_in_flight_request(request_id, handle):
+        fastapi.cancellation_stats["superseded"] += 1
+        logger.log(
+            logging.INFO,
+            f"Request {request_id} superseded an in-flight generation -> "
+            f"{fastapi.cancellation_stats['superseded']} superseded so far.",
+        )
+
+
+def get_typeahead_response(
+    fastapi: FastAPI, session: Session, gen_req: GenerateRequest, t: float
+) -> GenerateResponse | None:
+    """
+    A function which answers the request with the rest of the session's last completions if the user typed through
+    them, so that the models are skipped entirely. The request is stored with the typeahead trigger, and the
+    response is remembered for retries like any other.
+    """
+    completions = session.get_typeahead_completions(gen_req)
+    if completions is None:
+        return None
+    # the generation that is still running (if any) was for an older prefix
+    if session.cancel_in_flight_request():
+        fastapi.cancellation_stats["superseded"] += 1
+    gen_req = gen_req.model_copy(update={"trigger": TriggerType.typeahead})
+    t = time.time() - t  # seconds (float)
+    logger.log(
+        logging.INFO,
+        f"Request with id {gen_req.request_id} typed through the previous completions -> answered in {t} seconds.",
+    )
+    session.add_active_request(gen_req.request_id, gen_req, completions, t)
+    response = GenerateResponse(
+        time=t,
+        completions=completions,
+        timing={model: ModelTiming(typeahead=True) for model in completions},
+    )
+    fastapi.single_flight.remember(get_request_key(gen_req), response)
+    return response
+
+
+def get_gated_response(
+    fastapi: FastAPI, gen_req: GenerateRequest, t: float
+) -> GenerateResponse | None:
+    """
+    A function which answers the request with no completions if the telemetry gate predicts that a completion would
+    not be accepted, so that the models are skipped entirely. The request is not stored, as nothing was shown.
+    """
+    if fastapi.gate is None or not fastapi.gate.should_skip(gen_req, logger):
+        return None
+    return GenerateResponse(time=time.time() - t, completions={}, gated=True)
+
+
+def get_routed_models(
+    fastapi: FastAPI, session: Session, gen_req: GenerateRequest
+) -> list[str] | None:
+    """
+    A function which looks up the models worth running for the request's language and the session's project, IDE
+    and plugin version in the routing table (completion/routing.py). None means all models, [] none at all.
+    """
+    project_language = session.get_project_primary_language()
+    ide = session.get_project_ide()
+    return fastapi.chain_route(
+        gen_req.language.value,
+        project_language.value if project_language is not None else None,
+        ide.value if ide is not None else None,
+        session.get_coco_version(),
+    )
+
+
+def get_request_with_context_files(
+    session: Session, gen_req: GenerateRequest
+) -> tuple[GenerateRequest, list[str]]:
+    """
+    A function which fills in the context files the client sent by hash from the session's cache (see
+    completion/repo_context.py). Returns the request with the files the server has, and the paths of the files whose
+    content the client has to send again.
+    """
+    if not gen_req.context_files:
+        return gen_req, []
+    files, missing = session.resolve_context_files(gen_req.context_files)
+    if missing:
+        logger.log(
+            logging.INFO,
+            f"Context files {missing} of request with id {gen_req.request_id} are not cached -> left out.",
+        )
+    return gen_req.model_copy(update={"context_files": files}), missing
+
+
+def get_unrouted_response(
+    gen_req: GenerateRequest, models: list[str] | None, t: float
+) -> GenerateResponse | None:
+    """
+    A function which answers the request with no completions if its language is routed to no model at all. The
+    request is not stored, as nothing was shown.
+    """
+    if models is None or models:
+        return None
+    logger.log(
+        logging.INFO,
+        f"No models are routed to {gen_req.language.value} -> no completions generated for request with id "
+        f"{gen_req.request_id}.",
+    )
+    return GenerateResponse(time=time.time() - t, completions={})
+
+
+async def generate_when_admitted(
+    fastapi: FastAPI, gen_req: GenerateRequest, models: list[str] | None = None
+) -> dict:
+    """
+    A function which runs the completion chain (on the routed models) once the admission queue lets the request in.
+    Raises AdmissionRejected if it is shed instead (see models/Admission.py).
+    """
+    async with fastapi.admission.admit(gen_req.trigger):
+        return await fastapi.chain.ainvoke(gen_req, models=models)
+
+
+def get_request_key(gen_req: GenerateRequest) -> str:
+    """
+    A function which keys a request by its id within its session, so that a retry finds the generation (or response)
+    of the original request, while another session reusing the (client-supplied) id does not.
+    """
+    return f"request:{gen_req.session_id}:{gen_req.request_id}"
+
+
+def get_context_file_digest(file: ContextFile) -> str:
+    """
+    A function which returns the sha256 hex digest of a context file, hashing its content if it was not sent by hash.
+    """
+    return (
+        file.hash
+        if file.hash is not None
+        else hashlib.sha256(file.content.encode()).hexdigest()
+    )
+
+
+def get_prompt_key(gen_req: GenerateRequest, models: list[str] | None = None) -> str:
+    """
+    A function which hashes everything that determines the completions of a request, so that identical requests
+    (e.g. plugin retries under a new request id) can share one generation. The trigger is part of it, as it picks the
+    stopping criteria (see completion/stopping.py).
+    """
+    payload = json.dumps(
+        [
+            gen_req.session_id,
+            gen_req.prefix,
+            gen_req.suffix,
+            gen_req.language.value,
+            gen_req.trigger.value,
+            gen_req.file_path,
+            [[f.path, get_context_file_digest(f)] for f in gen_req.context_files],
+            gen_req.candidates,
+            models,
+        ]
+    )
+    return "prompt:" + hashlib.sha256(payload.encode()).hexdigest()
+
+
+async def generate_once(
+    fastapi: FastAPI, gen_req: GenerateRequest, models: list[str] | None = None
+) -> dict:
+    """
+    A function which generates the completions of a request, unless the same request (by request id or by prompt) is
+    generating already, in which case it waits for that generation instead (see models/SingleFlight.py).
+    """
+    return await fastapi.single_flight.run(
+        [get_request_key(gen_req), get_prompt_key(gen_req, models)],
+        lambda: generate_when_admitted(fastapi, gen_req, models),
+    )
+
+
+def get_replayed_response(
+    fastapi: FastAPI, gen_req: GenerateRequest
+) -> GenerateResponse | None:
+    """
+    A function which answers a retry of a request that already finished with the response it got, so that /complete is
+    idempotent: the retry is neither generated nor counted again.
+    """
+    response = fastapi.single_flight.recall(get_request_key(gen_req))
+    if response is not None:
+        logger.log(
+            logging.INFO,
+            f"Request with id {gen_req.request_id} was answered already -> response replayed.",
+        )
+    return response
+
+
+def get_rejected_response(
+    gen_req: GenerateRequest, rejection: AdmissionRejected
+) -> ErrorResponse:
+    """
+    A function which answers a request that admission control did not let through, distinctly from other errors
+    so that the client can tell the server is overloaded.
+    """
+    logger.log(
+        logging.WARNING,
+        f"Request with id {gen_req.request_id} was not admitted ({rejection}) -> no completions generated.",
+    )
+    return ErrorResponse(
+        error=f"Server overloaded ({rejection.reason}) -> no completions generated.",
+        overloaded=True,
+    )
+
+
+def get_model_timing(
+    generation_info: dict | None, breakdown: bool = False
+) -> ModelTiming:
+    """
+    A function which extracts how a model's completion was produced from the metadata of its Generation.
+    With breakdown, the wall time and the engine's queue / prefill / decode times are included as well.
+    """
+    generation_info = generation_info or {}
+    speculation = generation_info.get("speculation") or {}
+    cached = bool(generation_info.get("cached", False))
+    # a cached completion's engine metrics are those of the request that generated it
+    metrics = (generation_info.get("metrics") or {}) if breakdown and not cached else {}
+    return ModelTiming(
+        cached=cached,
+        decoded_tokens=generation_info.get("decoded_tokens"),
+        returned_tokens=generation_info.get("returned_tokens"),
+        decode_steps=speculation.get("steps"),
+        draft_acceptance=speculation.get("acceptance_rate"),
+        wall_ms=generation_info.get("wall_ms") if breakdown else None,
+        **metrics,
+    )
+
+
+def get_candidates(generation_info: dict | None) -> list[CompletionCandidate] | None:
+    """
+    A function which extracts the ranked candidates of a model from the metadata of its Generation, None if the request
+    asked for only one.
+    """
+    candidates = (generation_info or {}).get("candidates")
+    if not candidates:
+        return None
+    return [CompletionCandidate(text=c["text"], score=c["score"]) for c in candidates]
+
+
+def get_generation_details(generation_info: dict | None) -> dict:
+    """
+    A function which extracts what is stored of a model's completion (packed logprobs, confidence and timing) from
+    the metadata of its Generation, see ModelCompletionDetails.
+    """
+    generation_info = generation_info or {}
+    logprobs = generation_info.get("logprobs")
+    # a cached completion was not generated (again), so its engine metrics are not this request's
+    metrics = (
+        {} if generation_info.get("cached") else generation_info.get("metrics") or {}
+    )
+    wall_ms = generation_info.get("wall_ms")
+    return {
+        "logprobs": logprobs.tobytes() if logprobs is not None else b"",
+        "confidence": generation_info.get("confidence"),
+        "generation_time": round(wall_ms) if wall_ms is not None else None,
+        "queue_time": round(metrics["queue_ms"]) if metrics else None,
+        "prefill_time": round(metrics["prefill_ms"]) if metrics else None,
+        "decode_time": round(metrics["decode_ms"]) if metrics else None,
+        "prompt_tokens": metrics.get("prompt_tokens"),
+        "generated_tokens": generation_info.get("decoded_tokens"),
+    }
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
 
@@ -165,7 +456,16 @@ async def lifespan(app: FastAPI):
     # await FastAPILimiter.init(redis_connection)
 
     app.config = config
-    app.chain = completion_chain
+    if app.config.langchain_pipeline:
+        app.chain = completion_chain
+        app.chain_stream = completion_stream
+    else:
+        app.chain = completion_fast_chain
+        app.chain_stream = completion_fast_chain.astream
+    app.chain_route = completion_route
+    app.chain_stats = completion_stats
+    # manual requests get a longer latency budget than the ones that pop up while typing
+    completion_set_deadlines(app.config.completion_deadlines)
     app.server_db_session = get_db(app.config)
 
     # check whether a pickle file exists for some of the values
@@ -185,6 +485,10 @@ async def lifespan(app: FastAPI):
     # cache some of the tables in memory for faster access
     cache_tables(app, app.server_db_session)
     app.session_manager = SessionManager(app.config.session_length)
+    # generations that were cancelled before finishing, as their result would be thrown away:
+    # superseded -> a newer request of the same session arrived while generating
+    # collapsed -> a queued websocket request was replaced by a newer one before it started
+    app.cancellation_stats = {"superseded": 0, "collapsed": 0}
     stop_event = threading.Event()
     app.cleaning_thread = threading.Thread(
         target=delete_expired_sessions,
@@ -192,6 +496,27 @@ async def lifespan(app: FastAPI):
         daemon=True,
     )
     app.cleaning_thread.start()
+    # requests that are unlikely to be accepted are answered without calling the models (see models/Gate.py)
+    app.gate = None
+    if app.config.gate_model_path is not None:
+        app.gate = TelemetryGate.load(
+            app.config.gate_model_path,
+            app.config.gate_thresholds,
+            app.config.gate_shadow_mode,
+        )
+    # at most admission_max_concurrent requests generate at once, the rest wait by priority (see models/Admission.py)
+    app.admission = AdmissionQueue(
+        app.config.admission_max_concurrent,
+        app.config.admission_max_queued,
+        app.config.admission_max_age,
+    )
+    # identical requests in flight share one generation, retries of finished ones get its response (models/SingleFlight.py)
+    app.single_flight = SingleFlight()
+    # the models take minutes to load; the other endpoints are served in the meantime
+    app.warm_up_thread = threading.Thread(
+        target=completion_warm_up, name="model-warm-up", daemon=True
+    )
+    app.warm_up_thread.start()
 
     yield
 
@@ -236,10 +561,8 @@ async def lifespan(app: FastAPI):
 
 # --------------------- Normal API Endpoints ---------------------
 
-router = APIRouter(prefix="/api/v3")
-
-# TODO: Try streaming to reduce latency
-# TODO: Can squeeze out a little more performance with https://fastapi.tiangolo.com/advanced/custom-response/#use-orjsonresponse
+# responses are encoded straight from the models, as JSON or msgpack (see models/Encoding.py)
+router = APIRouter(prefix="/api/v3", route_class=EncodedRoute)
 
 
 @router.post("/user/new")
@@ -390,24 +713,250 @@ async def autocomplete_v3(
             f"User {gen_req.session_id} requested completions with completion id {gen_req.request_id}.",
         )
         try:
+            replayed = get_replayed_response(app, gen_req)
+            if replayed is not None:
+                return replayed
             if not request_in_limit(app, session):
                 return ErrorResponse(
                     error="User has exceeded the request limit -> no completions generated."
                 )
             t = time.time()
-            completions: dict[str, str] = app.chain.invoke(gen_req)
+            typeahead = get_typeahead_response(app, session, gen_req, t)
+            if typeahead is not None:
+                return typeahead
+            gated = get_gated_response(app, gen_req, t)
+            if gated is not None:
+                return gated
+            models = get_routed_models(app, session, gen_req)
+            unrouted = get_unrouted_response(gen_req, models, t)
+            if unrouted is not None:
+                return unrouted
+            gen_req, missing_context_files = get_request_with_context_files(
+                session, gen_req
+            )
+            generation = asyncio.ensure_future(generate_once(app, gen_req, models))
+            supersede_in_flight_request(app, session, gen_req.request_id, generation)
+            try:
+                # asyncio.wait (rather than await) so that a superseded generation does not cancel us
+                await asyncio.wait({generation})
+            except asyncio.CancelledError:
+                generation.cancel()  # the client went away
+                raise
+            finally:
+                session.clear_in_flight_request(gen_req.request_id)
+            if generation.cancelled():
+                logger.log(
+                    logging.INFO,
+                    f"Generation for request with id {gen_req.request_id} was superseded.",
+                )
+                return ErrorResponse(
+                    error="Request superseded by a newer request -> no completions generated."
+                )
+            generations = generation.result()
             t = time.time() - t  # seconds (float)
+            timed_out = [
+                model
+                for model, g in generations.items()
+                if (g.generation_info or {}).get("status") == "timed_out"
+            ]
+            generations = {
+                model: g for model, g in generations.items() if model not in timed_out
+            }
+            completions = {model: g.text for model, g in generations.items()}
+            timing = {
+                model: get_model_timing(g.generation_info, gen_req.timing_breakdown)
+                for model, g in generations.items()
+            }
             logger.log(
                 logging.INFO,
                 f"Completions generated for request with id {gen_req.request_id} in {t} seconds.",
             )
-            session.add_active_request(gen_req.request_id, gen_req, completions, t)
-            return GenerateResponse(time=t, completions=completions)
+            if timed_out:
+                logger.log(
+                    logging.WARNING,
+                    f"Models {timed_out} timed out for request with id {gen_req.request_id}.",
+                )
+            details = {
+                model: get_generation_details(g.generation_info)
+                for model, g in generations.items()
+            }
+            candidates = {
+                model: c
+                for model, g in generations.items()
+                if (c := get_candidates(g.generation_info)) is not None
+            }
+            session.add_active_request(
+                gen_req.request_id, gen_req, completions, t, details
+            )
+            response = GenerateResponse(
+                time=t,
+                completions=completions,
+                timing=timing,
+                timed_out=timed_out,
+                missing_context_files=missing_context_files,
+                candidates=candidates,
+            )
+            app.single_flight.remember(get_request_key(gen_req), response)
+            return response
+        except AdmissionRejected as rejection:
+            return get_rejected_response(gen_req, rejection)
         except Exception as e:
             logger.log(logging.ERROR, f"Error generating completions: {e}")
             return ErrorResponse(error="Error generating completions.")
 
 
+async def stream_autocomplete_v3(
+    gen_req: GenerateRequest, request: Request
+) -> AsyncIterator[CompletionChunk | GenerateResponse | ErrorResponse]:
+    """
+    Shared logic of the streaming endpoints. Yields a CompletionChunk for every piece of text as soon as
+    it is decoded and finishes with the full GenerateResponse (or an ErrorResponse).
+    """
+    ip = request.client.host
+    if not ensure_not_blacklisted_ip(app, ip):
+        yield ErrorResponse(
+            error="Access denied. - Blacklisted - Contact us if you think this is a mistake."
+        )
+        return
+    session = get_session_by_token_if_exists(app, gen_req.session_id)
+    if session is None:
+        logger.log(
+            logging.ERROR,
+            f"Invalid session token {gen_req.session_id} -> no completions generated.",
+        )
+        yield ErrorResponse(error="Invalid session token -> no completions generated.")
+        return
+    logger.log(
+        logging.INFO,
+        f"User {gen_req.session_id} requested streamed completions with completion id {gen_req.request_id}.",
+    )
+    try:
+        replayed = get_replayed_response(app, gen_req)
+        if replayed is not None:
+            for model, text in replayed.completions.items():
+                yield CompletionChunk(model=model, text=text)
+            yield replayed
+            return
+        if not request_in_limit(app, session):
+            yield ErrorResponse(
+                error="User has exceeded the request limit -> no completions generated."
+            )
+            return
+        t = time.time()
+        typeahead = get_typeahead_response(app, session, gen_req, t)
+        if typeahead is not None:
+            for model, text in typeahead.completions.items():
+                yield CompletionChunk(model=model, text=text)
+            yield typeahead
+            return
+        gated = get_gated_response(app, gen_req, t)
+        if gated is not None:
+            yield gated
+            return
+        models = get_routed_models(app, session, gen_req)
+        unrouted = get_unrouted_response(gen_req, models, t)
+        if unrouted is not None:
+            yield unrouted
+            return
+        gen_req, missing_context_files = get_request_with_context_files(
+            session, gen_req
+        )
+        completions: dict[str, str] = {}
+        timing: dict[str, ModelTiming] = {}
+        details: dict[str, dict] = {}
+        candidates: dict[str, list[CompletionCandidate]] = {}
+        timed_out: list[str] = []
+        # a stream cannot be cancelled from the outside, so it checks this token between chunks
+        superseded = asyncio.get_running_loop().create_future()
+        supersede_in_flight_request(app, session, gen_req.request_id, superseded)
+        try:
+            async with app.admission.admit(gen_req.trigger):
+                async with aclosing(app.chain_stream(gen_req, models=models)) as stream:
+                    async for model, chunk in stream:
+                        if superseded.cancelled():
+                            break  # closing the stream aborts the generation in the engine
+                        if not completions:
+                            logger.log(
+                                logging.INFO,
+                                f"First chunk for request with id {gen_req.request_id} after {time.time() - t} seconds.",
+                            )
+                        if (chunk.generation_info or {}).get("status") == "timed_out":
+                            # missed the deadline, what it sent so far is not part of the response
+                            timed_out.append(model)
+                            completions.pop(model, None)
+                            continue
+                        completions[model] = completions.get(model, "") + chunk.text
+                        if chunk.generation_info:  # only set on a model's last chunk
+                            timing[model] = get_model_timing(
+                                chunk.generation_info, gen_req.timing_breakdown
+                            )
+                            details[model] = get_generation_details(
+                                chunk.generation_info
+                            )
+                            if (c := get_candidates(chunk.generation_info)) is not None:
+                                candidates[model] = c
+                        if chunk.text:
+                            yield CompletionChunk(model=model, text=chunk.text)
+        finally:
+            session.clear_in_flight_request(gen_req.request_id)
+        if superseded.cancelled():
+            logger.log(
+                logging.INFO,
+                f"Generation for request with id {gen_req.request_id} was superseded.",
+            )
+            yield ErrorResponse(
+                error="Request superseded by a newer request -> no completions generated."
+            )
+            return
+        t = time.time() - t  # seconds (float)
+        logger.log(
+            logging.INFO,
+            f"Completions streamed for request with id {gen_req.request_id} in {t} seconds.",
+        )
+        if timed_out:
+            logger.log(
+                logging.WARNING,
+                f"Models {timed_out} timed out for request with id {gen_req.request_id}.",
+            )
+        session.add_active_request(gen_req.request_id, gen_req, completions, t, details)
+        response = GenerateResponse(
+            time=t,
+            completions=completions,
+            timing=timing,
+            timed_out=timed_out,
+            missing_context_files=missing_context_files,
+            candidates=candidates,
+        )
+        app.single_flight.remember(get_request_key(gen_req), response)
+        yield response
+    except AdmissionRejected as rejection:
+        yield get_rejected_response(gen_req, rejection)
+    except Exception as e:
+        logger.log(logging.ERROR, f"Error generating completions: {e}")
+        yield ErrorResponse(error="Error generating completions.")
+
+
+@router.post("/complete/stream")
+async def autocomplete_stream_v3(
+    gen_req: GenerateRequest, request: Request
+) -> StreamingResponse:
+    """
+    Server-Sent-Events variant of /complete. Sends a `chunk` event (CompletionChunk) per decoded piece of
+    text, then a `done` event with the GenerateResponse, or a single `error` event with an ErrorResponse.
+    """
+    events = {
+        CompletionChunk: "chunk",
+        GenerateResponse: "done",
+        ErrorResponse: "error",
+    }
+
+    async def event_stream():
+        async for message in stream_autocomplete_v3(gen_req, request):
+            yield f"event: {events[type(message)]}\ndata: {message.model_dump_json()}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
 @router.post("/verify")
 async def verify_v3(
     verify_req: VerifyRequest, request: Request
@@ -467,22 +1016,60 @@ async def survey(
         return SurveyResponse(redirect_url=redirect_url)
 
 
+@router.get("/metrics")
+async def metrics(request: Request) -> ErrorResponse | MetricsResponse:
+    """
+    Endpoint to inspect the counters of the completion pipeline.
+    """
+    ip = request.client.host
+    if not ensure_not_blacklisted_ip(app, ip):
+        return ErrorResponse(
+            error="Access denied. - Blacklisted - Contact us if you think this is a mistake."
+        )
+    return MetricsResponse(
+        metrics={
+            "cancellations": app.cancellation_stats,
+            "admission": app.admission.stats(),
+            "single_flight": app.single_flight.stats(),
+            **({"gate": app.gate.stats()} if app.gate is not None else {}),
+            **app.chain_stats(),
+        }
+    )
+
+
 # --------------------- WebSocket Endpoints ---------------------
 class WebSocketManager:
     def __init__(self):
         self.active_connections: dict[str, WebSocket] = {}
 
     async def connect(self, websocket: WebSocket, session_id: str):
-        await websocket.accept()
+        # the frames are JSON text, or msgpack binary if the client negotiated it in the handshake
+        websocket.state.media_type, subprotocol = websocket_media_type(websocket)
+        await websocket.accept(subprotocol=subprotocol)
         self.active_connections[session_id] = websocket
 
     def disconnect(self, session_id: str):
         if session_id in self.active_connections:
             del self.active_connections[session_id]
 
-    async def send_message(self, session_id: str, message: str):
+    @staticmethod
+    async def receive_message(
+        websocket: WebSocket, model: type[BaseModel]
+    ) -> BaseModel:
+        if websocket.state.media_type == JSON:
+            return decode(await websocket.receive_text(), model)
+        return decode(
+            await websocket.receive_bytes(), model, websocket.state.media_type
+        )
+
+    async def send_message(self, session_id: str, message: BaseModel):
         if session_id in self.active_connections:
-            await self.active_connections[session_id].send_text(message)
+            websocket = self.active_connections[session_id]
+            data = encode(message, websocket.state.media_type)
+            if websocket.state.media_type == JSON:
+                await websocket.send_text(data.decode())
+            else:
+                await websocket.send_bytes(data)
 
 
 manager = WebSocketManager()
@@ -491,16 +1078,44 @@ manager = WebSocketManager()
 @router.websocket("/ws/complete")
 async def websocket_autocomplete(websocket: WebSocket):
     await manager.connect(websocket, "autocomplete")
+    queue: asyncio.Queue[GenerateRequest] = asyncio.Queue()
+
+    async def receive_requests():
+        # keep reading while a generation runs, so newer requests can supersede it
+        while True:
+            gen_req = await manager.receive_message(websocket, GenerateRequest)
+            session = get_session_by_token_if_exists(app, gen_req.session_id)
+            if session is not None and session.cancel_in_flight_request():
+                app.cancellation_stats["superseded"] += 1
+            await queue.put(gen_req)
+
+    receiver = asyncio.create_task(receive_requests())
     try:
         while True:
-            data = await websocket.receive_text()
-            gen_req = GenerateRequest(**json.loads(data))
-            response = await autocomplete_v3(gen_req)
-            await manager.send_message(
-                "autocomplete", json.dumps(response.model_dump())
+            next_request = asyncio.create_task(queue.get())
+            await asyncio.wait(
+                {next_request, receiver}, return_when=asyncio.FIRST_COMPLETED
             )
+            if not next_request.done():
+                next_request.cancel()
+                receiver.result()  # raises WebSocketDisconnect once the client is gone
+            gen_req = next_request.result()
+            # requests that have not started yet are outdated by the latest one
+            while not queue.empty():
+                gen_req = queue.get_nowait()
+                app.cancellation_stats["collapsed"] += 1
+
+            if gen_req.stream:
+                # send every decoded piece as its own frame, the last frame is the full response
+                async for message in stream_autocomplete_v3(gen_req, websocket):
+                    await manager.send_message("autocomplete", message)
+                continue
+            response = await autocomplete_v3(gen_req, websocket)
+            await manager.send_message("autocomplete", response)
     except WebSocketDisconnect:
         manager.disconnect("autocomplete")
+    finally:
+        receiver.cancel()
 
 
 @router.websocket("/ws/verify")
@@ -508,10 +1123,9 @@ async def websocket_verify(websocket: WebSocket):
     await manager.connect(websocket, "verify")
     try:
         while True:
-            data = await websocket.receive_text()
-            verify_req = VerifyRequest(**json.loads(data))
-            response = await verify_v3(verify_req)
-            await manager.send_message("verify", json.dumps(response.model_dump()))
+            verify_req = await manager.receive_message(websocket, VerifyRequest)
+            response = await verify_v3(verify_req, websocket)
+            await manager.send_message("verify", response)
     except WebSocketDisconnect:
         manager.disconnect("verify")
 
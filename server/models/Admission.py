@@ -0,0 +1,145 @@
+import asyncio
+import threading
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from models.Types import TriggerType
+
+# the priority classes, highest first: the user explicitly asked, the user is typing, the user is idle
+PRIORITIES = (TriggerType.man, TriggerType.auto, TriggerType.idle)
+
+
+class AdmissionRejected(Exception):
+    """
+    A request was not admitted to generation, because its priority class' queue was full ("overloaded") or
+    because it waited longer than its class' max age ("expired").
+    """
+
+    def __init__(self, trigger: TriggerType, reason: str):
+        super().__init__(f"{trigger.value} request {reason}")
+        self.trigger = trigger
+        self.reason = reason
+
+
+class AdmissionQueue:
+    """
+    Admission control in front of generation. At most `max_concurrent` requests generate at once; the others wait
+    in a queue per priority class, and a freed slot goes to the oldest request of the highest class.
+    Under overload, low priority work is shed quickly rather than letting the queues grow: a request whose class'
+    queue already holds `max_queued[class]` requests is rejected right away (0 means it never waits), and a queued
+    request that waited `max_age[class]` seconds is dropped, as its completion would arrive too late to be shown.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int,
+        max_queued: dict[str, int],
+        max_age: dict[str, float],
+    ):
+        self.__max_concurrent = max_concurrent
+        self.__max_queued = max_queued
+        self.__max_age = max_age
+        self.__running = 0
+        self.__queues: dict[TriggerType, deque[asyncio.Future]] = {
+            trigger: deque() for trigger in PRIORITIES
+        }
+        self.__lock = (
+            threading.Lock()
+        )  # only for the counters, the queues are used from the event loop
+        self.__counters = {
+            trigger.value: {"admitted": 0, "queued": 0, "overloaded": 0, "expired": 0}
+            for trigger in PRIORITIES
+        }
+
+    @staticmethod
+    def priority_class(trigger: TriggerType) -> TriggerType:
+        return trigger if trigger in PRIORITIES else TriggerType.auto
+
+    def __count(self, trigger: TriggerType, counter: str):
+        with self.__lock:
+            self.__counters[trigger.value][counter] += 1
+
+    def __has_priority(self, trigger: TriggerType) -> bool:
+        """Whether a request of this class may take a free slot, i.e. no request of its class or above is waiting."""
+        for waiting in PRIORITIES[: PRIORITIES.index(trigger) + 1]:
+            if self.__queues[waiting]:
+                return False
+        return True
+
+    def __release(self):
+        """Free a slot, handing it straight to the next waiting request, if any."""
+        for trigger in PRIORITIES:
+            queue = self.__queues[trigger]
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.done():  # not cancelled or expired in the meantime
+                    waiter.set_result(
+                        None
+                    )  # the slot is passed on, so the running count stays
+                    return
+        self.__running -= 1
+
+    async def __wait(self, trigger: TriggerType):
+        queue = self.__queues[trigger]
+        if len(queue) >= self.__max_queued.get(trigger.value, 0):
+            self.__count(trigger, "overloaded")
+            raise AdmissionRejected(trigger, "overloaded")
+        waiter = asyncio.get_running_loop().create_future()
+        queue.append(waiter)
+        self.__count(trigger, "queued")
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(waiter), timeout=self.__max_age.get(trigger.value)
+            )
+        except asyncio.TimeoutError:
+            if waiter.done():  # handed a slot just as the wait timed out
+                return
+            waiter.cancel()
+            self.__discard(queue, waiter)
+            self.__count(trigger, "expired")
+            raise AdmissionRejected(trigger, "expired")
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.__release()  # it was handed a slot, which it will not use
+            else:
+                waiter.cancel()
+                self.__discard(queue, waiter)
+            raise
+
+    @staticmethod
+    def __discard(queue: deque, waiter: asyncio.Future):
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            pass  # already popped by __release
+
+    @asynccontextmanager
+    async def admit(self, trigger: TriggerType) -> AsyncIterator[None]:
+        """
+        Hold one of the generation slots for the duration of the context. Raises AdmissionRejected if the request
+        is shed instead.
+        """
+        trigger = self.priority_class(trigger)
+        if self.__running < self.__max_concurrent and self.__has_priority(trigger):
+            self.__running += 1
+        else:
+            await self.__wait(trigger)
+        self.__count(trigger, "admitted")
+        try:
+            yield
+        finally:
+            self.__release()
+
+    def stats(self) -> dict:
+        with self.__lock:
+            counters = {
+                trigger: dict(counter) for trigger, counter in self.__counters.items()
+            }
+        for trigger in PRIORITIES:
+            counters[trigger.value]["depth"] = len(self.__queues[trigger])
+        return {
+            "running": self.__running,
+            "max_concurrent": self.__max_concurrent,
+            "classes": counters,
+        }
@@ -24,3 +24,35 @@ class CoCoConfig(BaseSettings):
     db_user: str = Field(alias="DB_USER", frozen=True)
     db_name: str = Field(alias="DB_NAME", frozen=True)
     db_port: int = Field(alias="DB_PORT", frozen=True)
+    # telemetry gate (see models/Gate.py), off unless a trained gate is configured
+    gate_model_path: str | None = Field(
+        default=None, alias="GATE_MODEL_PATH", frozen=True
+    )
+    gate_thresholds: dict[str, float] = Field(
+        default={"auto": 0.05}, alias="GATE_THRESHOLDS", frozen=True
+    )  # per trigger type, the acceptance probability below which a request is skipped (JSON in the .env)
+    gate_shadow_mode: bool = Field(
+        default=True, alias="GATE_SHADOW_MODE", frozen=True
+    )  # only log what the gate would skip
+    langchain_pipeline: bool = Field(
+        default=False, alias="LANGCHAIN_PIPELINE", frozen=True
+    )  # serve completions through the LangChain chain instead of its fast path (completion/fast.py)
+    # admission control in front of generation (see models/Admission.py), per trigger type (JSON in the .env)
+    admission_max_concurrent: int = Field(
+        default=32, alias="ADMISSION_MAX_CONCURRENT", frozen=True
+    )  # requests generating at once, the rest wait by priority: man, then auto, then idle
+    admission_max_queued: dict[str, int] = Field(
+        default={"man": 64, "auto": 32, "idle": 0},
+        alias="ADMISSION_MAX_QUEUED",
+        frozen=True,
+    )  # waiting requests beyond which a class is rejected right away (0: never waits)
+    admission_max_age: dict[str, float] = Field(
+        default={"man": 5.0, "auto": 1.0, "idle": 0.5},
+        alias="ADMISSION_MAX_AGE",
+        frozen=True,
+    )  # seconds after which a waiting request is dropped, as its completion would be too late
+    completion_deadlines: dict[str, float] = Field(
+        default={"man": 4.0, "auto": 2.0, "idle": 1.5},
+        alias="COMPLETION_DEADLINES",
+        frozen=True,
+    )  # seconds the models get per trigger type before they are reported as timed out (see completion/fanout.py)
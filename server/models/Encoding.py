@@ -0,0 +1,132 @@
+import functools
+import importlib.util
+import inspect
+from typing import Any, Callable, TypeVar
+
+import orjson
+from fastapi import Request, WebSocket
+from fastapi.routing import APIRoute
+from pydantic import BaseModel
+from starlette.responses import Response
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+MSGPACK_ALIASES = (MSGPACK, "application/x-msgpack")
+MSGPACK_SUBPROTOCOL = "msgpack"  # what a websocket client offers in Sec-WebSocket-Protocol to get msgpack frames
+
+# msgpack is only imported once a client asks for it, and only offered if it is installed
+MSGPACK_AVAILABLE = importlib.util.find_spec("msgpack") is not None
+
+Model = TypeVar("Model", bound=BaseModel)
+
+
+def negotiate(accept: str | None) -> str:
+    """
+    The media type to answer a client with: msgpack if its Accept header prefers it over JSON (and msgpack is
+    installed), JSON otherwise.
+    """
+    if not accept or not MSGPACK_AVAILABLE:
+        return JSON
+    quality: dict[str, float] = {}
+    for media_range in accept.split(","):
+        media_type, *parameters = [part.strip() for part in media_range.split(";")]
+        q = 1.0
+        for parameter in parameters:
+            if parameter.startswith("q="):
+                try:
+                    q = float(parameter[2:])
+                except ValueError:
+                    q = 0.0
+        quality[media_type.lower()] = q
+    msgpack_q = max(quality.get(alias, 0.0) for alias in MSGPACK_ALIASES)
+    return MSGPACK if msgpack_q > 0 and msgpack_q >= quality.get(JSON, 0.0) else JSON
+
+
+def encode(content: Any, media_type: str = JSON) -> bytes:
+    """
+    Encode a response. Pydantic models are serialized straight to bytes by pydantic-core, without building a dict
+    first; anything else goes through orjson.
+    """
+    if media_type == MSGPACK:
+        import msgpack
+
+        if isinstance(content, BaseModel):
+            content = content.model_dump(mode="json")
+        return msgpack.packb(content)
+    if isinstance(content, BaseModel):
+        return content.__pydantic_serializer__.to_json(content)
+    return orjson.dumps(content)
+
+
+def decode(data: str | bytes, model: type[Model], media_type: str = JSON) -> Model:
+    """
+    Decode a request into a Pydantic model, JSON straight from the text (or bytes) without building a dict first.
+    """
+    if media_type == MSGPACK:
+        import msgpack
+
+        return model.model_validate(msgpack.unpackb(data))
+    return model.model_validate_json(data)
+
+
+class EncodedResponse(Response):
+    """
+    A response rendered by `encode`, as JSON unless another media type is given.
+    """
+
+    media_type = JSON
+
+    def render(self, content: Any) -> bytes:
+        return encode(content, self.media_type)
+
+
+def encoded_endpoint(endpoint: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Wrap an async endpoint so that the Pydantic model it returns comes back as an EncodedResponse, in the media type
+    the client accepts. Other return values (None, responses of their own, e.g. a StreamingResponse) pass through.
+    """
+    if not inspect.iscoroutinefunction(endpoint):
+        return endpoint
+
+    @functools.wraps(
+        endpoint
+    )  # FastAPI reads the parameters and the response model from the endpoint's signature
+    async def wrapper(**kwargs: Any) -> Any:
+        content = await endpoint(**kwargs)
+        if not isinstance(content, BaseModel):
+            return content
+        request = next(
+            (value for value in kwargs.values() if isinstance(value, Request)), None
+        )
+        media_type = negotiate(
+            request.headers.get("accept") if request is not None else None
+        )
+        return EncodedResponse(
+            content, media_type=media_type, headers={"Vary": "Accept"}
+        )
+
+    return wrapper
+
+
+class EncodedRoute(APIRoute):
+    """
+    The route class of the API: the endpoints' Pydantic models are encoded straight to bytes, in the media type the
+    client accepts (see `negotiate`), rather than validated again and converted to a dict by FastAPI and then
+    encoded with the stdlib's json. The response models are still documented as declared.
+    """
+
+    def __init__(self, path: str, endpoint: Callable[..., Any], **kwargs: Any):
+        super().__init__(path, endpoint=encoded_endpoint(endpoint), **kwargs)
+
+
+def websocket_media_type(websocket: WebSocket) -> tuple[str, str | None]:
+    """
+    The media type of a websocket's frames and the subprotocol to accept it with: msgpack if the client offers the
+    `msgpack` subprotocol or accepts msgpack in the handshake's Accept header (and msgpack is installed), JSON
+    otherwise.
+    """
+    if MSGPACK_AVAILABLE and MSGPACK_SUBPROTOCOL in websocket.scope.get(
+        "subprotocols", []
+    ):
+        return MSGPACK, MSGPACK_SUBPROTOCOL
+    return negotiate(websocket.headers.get("accept")), None
@@ -0,0 +1,195 @@
+import argparse
+import logging
+import threading
+from logging import Logger
+from typing import Sequence
+
+import numpy as np
+
+from models.Requests import GenerateRequest, Telemetry
+
+# the telemetry fields the gate looks at, in the order of its weights
+FEATURES = (
+    "time_since_last_completion",
+    "typing_speed",
+    "document_length",
+    "cursor_relative_position",
+)
+
+
+def telemetry_features(
+    time_since_last_completion: float | None,
+    typing_speed: float | None,
+    document_length: float | None,
+    cursor_relative_position: float | None,
+) -> np.ndarray:
+    """
+    Turn one request's telemetry into the gate's feature vector. The counts are heavy-tailed, so they are
+    log-scaled; missing values are NaN and end up as the training mean (0 after standardisation).
+    """
+    values = np.array(
+        [
+            time_since_last_completion,
+            typing_speed,
+            document_length,
+            cursor_relative_position,
+        ],
+        dtype=np.float64,  # None -> nan
+    )
+    values[:3] = np.log1p(np.maximum(values[:3], 0))
+    return values
+
+
+def request_features(telemetry: Telemetry) -> np.ndarray:
+    return telemetry_features(*(getattr(telemetry, feature) for feature in FEATURES))
+
+
+class TelemetryGate:
+    """
+    A logistic model of P(completion accepted | telemetry), used to skip requests that are unlikely to be
+    accepted without calling the models at all.
+    Requests are only skipped for trigger types that have a threshold (e.g. just `auto`; explicit requests are
+    always answered), when their predicted probability is below it. In shadow mode the decisions are only
+    logged and counted, so a threshold can be evaluated on live traffic before it is enforced.
+    """
+
+    def __init__(
+        self,
+        weights: np.ndarray,
+        bias: float,
+        mean: np.ndarray,
+        std: np.ndarray,
+        thresholds: dict[str, float],
+        shadow: bool = True,
+    ):
+        self.__weights = np.asarray(weights, dtype=np.float64)
+        self.__bias = float(bias)
+        self.__mean = np.asarray(mean, dtype=np.float64)
+        self.__std = np.asarray(std, dtype=np.float64)
+        self.__thresholds = dict(thresholds)
+        self.__shadow = shadow
+        self.__lock = threading.Lock()
+        self.__evaluated = 0
+        self.__below_threshold = 0  # skipped, or would have been in shadow mode
+
+    @classmethod
+    def fit(
+        cls,
+        features: np.ndarray,
+        accepted: np.ndarray,
+        thresholds: dict[str, float],
+        shadow: bool = True,
+        iterations: int = 500,
+        learning_rate: float = 0.5,
+        l2: float = 1e-3,
+    ) -> "TelemetryGate":
+        """
+        Train the gate with (full batch) gradient descent on standardised features.
+        features is an (n, len(FEATURES)) array of telemetry_features, accepted the (n,) labels.
+        """
+        features = np.asarray(features, dtype=np.float64)
+        accepted = np.asarray(accepted, dtype=np.float64)
+        mean = np.nanmean(features, axis=0)
+        mean = np.where(np.isnan(mean), 0.0, mean)  # a feature that is never reported
+        x = np.where(np.isnan(features), mean, features)
+        std = x.std(axis=0)
+        std[std == 0] = 1.0
+        x = (x - mean) / std
+
+        weights, bias = np.zeros(x.shape[1]), 0.0
+        for _ in range(iterations):
+            error = 1 / (1 + np.exp(-(x @ weights + bias))) - accepted
+            weights -= learning_rate * (x.T @ error / len(x) + l2 * weights)
+            bias -= learning_rate * error.mean()
+        return cls(weights, bias, mean, std, thresholds, shadow)
+
+    @classmethod
+    def load(
+        cls, path: str, thresholds: dict[str, float], shadow: bool = True
+    ) -> "TelemetryGate":
+        """
+        Load a gate saved by `save`; the thresholds and shadow mode come from the config.
+        """
+        with np.load(path) as saved:
+            return cls(
+                saved["weights"],
+                float(saved["bias"]),
+                saved["mean"],
+                saved["std"],
+                thresholds,
+                shadow,
+            )
+
+    def save(self, path: str):
+        np.savez(
+            path,
+            weights=self.__weights,
+            bias=self.__bias,
+            mean=self.__mean,
+            std=self.__std,
+        )
+
+    def predict(self, features: np.ndarray) -> float:
+        """
+        The probability that a completion for a request with these telemetry_features is accepted.
+        """
+        x = np.where(np.isnan(features), self.__mean, features)
+        x = (x - self.__mean) / self.__std
+        return float(1 / (1 + np.exp(-(x @ self.__weights + self.__bias))))
+
+    def should_skip(self, request: GenerateRequest, logger: Logger) -> bool:
+        """
+        Whether to answer the request without calling the models. Always False in shadow mode.
+        """
+        threshold = self.__thresholds.get(str(request.trigger.value))
+        if threshold is None:
+            return False
+        probability = self.predict(request_features(request.telemetry))
+        below_threshold = probability < threshold
+        with self.__lock:
+            self.__evaluated += 1
+            self.__below_threshold += below_threshold
+        if below_threshold:
+            logger.log(
+                logging.INFO,
+                f"Request {request.request_id} ({request.trigger.value}) is unlikely to be accepted "
+                f"(p={probability:.3f} < {threshold}) -> {'would be skipped (shadow mode)' if self.__shadow else 'skipped'}.",
+            )
+        return below_threshold and not self.__shadow
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "shadow": self.__shadow,
+                "thresholds": dict(self.__thresholds),
+                "evaluated": self.__evaluated,
+                "below_threshold": self.__below_threshold,
+            }
+
+
+def train_gate(rows: Sequence[tuple], thresholds: dict[str, float]) -> TelemetryGate:
+    """
+    Train a gate on the rows of crud.get_telemetries_with_acceptance.
+    """
+    features = np.array([telemetry_features(*row[:4]) for row in rows])
+    accepted = np.array([bool(row[4]) for row in rows])
+    return TelemetryGate.fit(features, accepted, thresholds)
+
+
+if __name__ == "__main__":
+    # python -m models.Gate gate.npz -> train on the database of the .env and save the weights
+    from database.crud import get_telemetries_with_acceptance
+    from database import get_db
+    from models.CoCoConfig import CoCoConfig
+
+    parser = argparse.ArgumentParser(description="Train the telemetry gate.")
+    parser.add_argument(
+        "output", help="where to save the gate (.npz), see GATE_MODEL_PATH"
+    )
+    args = parser.parse_args()
+
+    config = CoCoConfig()
+    rows = get_telemetries_with_acceptance(get_db(config))
+    gate = train_gate(rows, config.gate_thresholds)
+    gate.save(args.output)
+    print(f"Trained the gate on {len(rows)} queries -> {args.output}")
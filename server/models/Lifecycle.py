@@ -10,6 +10,22 @@ class ModelCompletionDetails(BaseModel):
     completion: str
     shown_at: List[datetime.datetime]
     accepted: bool = False
+    logprobs: bytes = (
+        b""  # logprob of every generated token, packed float32 (array('f').tobytes())
+    )
+    confidence: Optional[float] = (
+        None  # exp(mean logprob), None if the model returned no logprobs
+    )
+    generation_time: Optional[int] = (
+        None  # the model's wall time in ms, None if it was not generated
+    )
+    queue_time: Optional[int] = None  # ms waiting in the engine's queue
+    prefill_time: Optional[int] = (
+        None  # ms processing the prompt, up to the first token
+    )
+    decode_time: Optional[int] = None  # ms decoding the remaining tokens
+    prompt_tokens: Optional[int] = None
+    generated_tokens: Optional[int] = None  # tokens the engine decoded
 
     def __getitem__(self, item):
         return getattr(self, item)
@@ -1,6 +1,6 @@
 import datetime
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator, model_validator
 from typing import Union, Dict
 
 from .Types import TriggerType, LanguageType, IDEType
@@ -24,6 +24,27 @@ class Telemetry(BaseModel):
     ]  # the position of the cursor relative to the document
 
 
+class ContextFile(BaseModel):
+    """
+    The ContextFile class is a Pydantic BaseModel class that defines a file of the user's project that is sent along
+        with a GenerateRequest, as context for repository-level completion.
+    The server keeps the contents per session, so a file's content only has to be sent once: afterwards its hash
+        suffices until the file changes (see GenerateResponse.missing_context_files).
+    """
+
+    path: str  # relative to the project root
+    content: Union[str, None] = (
+        None  # the file's content, can be left out if the server has it already
+    )
+    hash: Union[str, None] = None  # the sha256 hex digest of the UTF-8 encoded content
+
+    @model_validator(mode="after")
+    def check_content_or_hash(self) -> "ContextFile":
+        if self.content is None and self.hash is None:
+            raise ValueError("A context file needs its content or its hash.")
+        return self
+
+
 class GenerateRequest(BaseModel):
     """
     The GenerateRequest class is a Pydantic BaseModel class that defines the structure of a request for code generation.
@@ -40,6 +61,29 @@ class GenerateRequest(BaseModel):
     timestamp: (
         datetime.datetime
     )  # the timestamp of the request (in the user's timezone)
+    stream: bool = False  # stream the completions as they are decoded (/ws/complete)
+    timing_breakdown: bool = (
+        False  # also return each model's wall/queue/prefill/decode times (ModelTiming)
+    )
+    file_path: Union[str, None] = (
+        None  # path of the edited file, relative to the project root
+    )
+    context_files: list[ContextFile] = (
+        []
+    )  # other files of the project, for repository-level completion
+    candidates: int = Field(
+        default=1, ge=1, le=8
+    )  # completions per model, generated in one engine call and
+    # returned ranked in GenerateResponse.candidates, for the IDE to cycle through
+
+    @field_validator("trigger")
+    @classmethod
+    def check_trigger_is_not_typeahead(cls, trigger: TriggerType) -> TriggerType:
+        if trigger == TriggerType.typeahead:
+            raise ValueError(
+                "The typeahead trigger is set by the server, not by the client."
+            )
+        return trigger
 
     model_config = {
         "json_schema_extra": {
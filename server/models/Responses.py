@@ -1,6 +1,59 @@
 from pydantic import BaseModel
 
 
+class ModelTiming(BaseModel):
+    """
+    The ModelTiming class is a Pydantic BaseModel class that defines how a single model's completion
+        was produced.
+    This is meant to be used in the GenerateResponse, keyed by model name.
+    """
+
+    cached: bool = (
+        False  # whether the completion was served from the completion cache instead of the model
+    )
+    typeahead: bool = (
+        False  # whether the completion is the rest of the previous one, which the user typed through
+    )
+    decoded_tokens: int | None = (
+        None  # tokens the engine decoded for this completion (0 when cached)
+    )
+    returned_tokens: int | None = (
+        None  # tokens of the returned completion, after the stopping criteria
+    )
+    decode_steps: int | None = (
+        None  # engine steps it took, fewer than decoded_tokens with speculative decoding
+    )
+    draft_acceptance: float | None = (
+        None  # share of the speculatively drafted tokens the model accepted
+    )
+    # only with GenerateRequest.timing_breakdown, and only for completions that came from the engine:
+    wall_ms: float | None = (
+        None  # the model's whole part of the request, as seen by the server
+    )
+    queue_ms: float | None = (
+        None  # waiting in the engine's queue until it was scheduled
+    )
+    prefill_ms: float | None = None  # processing the prompt, up to the first token
+    decode_ms: float | None = None  # decoding the remaining tokens
+    prompt_tokens: int | None = None  # tokens of the prompt the engine saw
+    cached_tokens: int | None = (
+        None  # of which were in the engine's prefix cache, if the engine reports it
+    )
+
+
+class CompletionCandidate(BaseModel):
+    """
+    The CompletionCandidate class is a Pydantic BaseModel class that defines one of the completions a model generated
+        for a request that asked for several (GenerateRequest.candidates).
+    This is meant to be used in the GenerateResponse, in a list per model name, best first.
+    """
+
+    text: str  # the completion
+    score: float | None = (
+        None  # the mean logprob of its tokens, None if the model returned no logprobs
+    )
+
+
 class GenerateResponse(BaseModel):
     """
     The GenerateResponse class is a Pydantic BaseModel class that defines the structure of a response for
@@ -11,6 +64,32 @@ class GenerateResponse(BaseModel):
 
     time: float  # the time taken by the server to generate the completions
     completions: dict[str, str]  # the completions generated by the models
+    timing: dict[str, ModelTiming] = {}  # how each model's completion was produced
+    timed_out: list[str] = (
+        []
+    )  # the models that did not finish in time (and thus have no completion)
+    gated: bool = (
+        False  # the request was unlikely to be accepted, so no model was called (see models/Gate.py)
+    )
+    missing_context_files: list[str] = (
+        []
+    )  # paths of context files sent by hash that the server does not have
+    # (any more), so they were left out: send their content with the next request
+    # only if more than one was asked for: each model's distinct completions ranked by score, of which
+    # completions holds the top-ranked one
+    candidates: dict[str, list[CompletionCandidate]] = {}
+
+
+class CompletionChunk(BaseModel):
+    """
+    The CompletionChunk class is a Pydantic BaseModel class that defines the structure of a piece of a completion
+        that is sent to the client as soon as it is decoded.
+    This response is meant to be used by the streaming variants of the /complete endpoint, which finish by
+        sending a GenerateResponse with the full completions.
+    """
+
+    model: str  # the model that generated this piece of text
+    text: str  # the newly decoded text, to be appended to the model's completion so far
 
 
 class VerifyResponse(BaseModel):
@@ -51,6 +130,9 @@ class ErrorResponse(BaseModel):
     """
 
     error: str  # the error message to be displayed to the user
+    overloaded: bool = (
+        False  # the request was shed by admission control (see models/Admission.py), retrying later may work
+    )
 
 
 class NewUserResponse(BaseModel):
@@ -61,3 +143,13 @@ class NewUserResponse(BaseModel):
     """
 
     user_id: str  # the user id to be used for the next request
+
+
+class MetricsResponse(BaseModel):
+    """
+    The MetricsResponse class is a Pydantic BaseModel class that defines the structure of a response for
+        the metrics endpoint.
+    This response is meant to be used along with the /metrics endpoint to inspect the server's counters.
+    """
+
+    metrics: dict[str, dict]  # the counters, grouped by the component that keeps them
@@ -1,13 +1,15 @@
 import datetime
+import hashlib
 import threading
 import time
+from collections import OrderedDict
 from logging import Logger
 
 import sqlalchemy.orm
 from fastapi import FastAPI
 
 from database.app_to_db import add_active_request_to_db
-from models import GenerateRequest, VerifyRequest
+from models import GenerateRequest, VerifyRequest, ContextFile
 from models.Types import LanguageType, IDEType
 from models.Lifecycle import ActiveRequest
 
@@ -59,6 +61,10 @@ class UserSetting:
         }
 
 
+# per session, the contents of the context files (see resolve_context_files) are kept up to this many characters
+MAX_CONTEXT_FILE_CHARS = 4_000_000
+
+
 class Session:
     def __init__(
         self,
@@ -82,6 +88,16 @@ class Session:
         self.__user_database_session = db_session
         self.__user_active_requests = {}
         self.__user_request_count = 0
+        self.__in_flight_request = (
+            None  # (request_id, [handles]) of the generation that is still running
+        )
+        self.__last_completions = (
+            None  # (prefix, suffix, {model: completion}) of the last completed request
+        )
+        self.__context_files = (
+            OrderedDict()
+        )  # {sha256: content} of the context files, least recently used first
+        self.__context_file_chars = 0
 
     def add_active_request(
         self,
@@ -89,7 +105,23 @@ class Session:
         request: GenerateRequest,
         completions: dict,
         time_taken: float,
+        generation_details: dict | None = None,
     ):
+        """
+        Store a request with its completions ({model: completion}). generation_details optionally holds
+        {model: {"logprobs": bytes, "confidence": float}} of the completions that came from a model.
+        """
+        generation_details = generation_details or {}
+        if request.context_files:
+            # the contents are kept once, in the context file cache
+            request = request.model_copy(
+                update={
+                    "context_files": [
+                        ContextFile(path=f.path, hash=f.hash) if f.hash else f
+                        for f in request.context_files
+                    ]
+                }
+            )
         self.__user_active_requests[request_id] = ActiveRequest.model_validate(
             {
                 "request": request,
@@ -98,6 +130,7 @@ class Session:
                         "completion": completions[key],
                         "shown_at": [],
                         "accepted": False,
+                        **generation_details.get(key, {}),
                     }
                     for key in completions.keys()
                 },
@@ -105,8 +138,118 @@ class Session:
                 "ground_truth": [],
             }
         )
+        self.__last_completions = (request.prefix, request.suffix, dict(completions))
         self.increment_user_request_count()
 
+    def get_typeahead_completions(
+        self, request: GenerateRequest
+    ) -> dict[str, str] | None:
+        """
+        If the user kept typing exactly what the last completions predicted (same suffix, and the prefix grew by a
+        non-empty leading slice of every model's completion), return the rest of each completion. Otherwise return None.
+        """
+        if self.__last_completions is None:
+            return None
+        prefix, suffix, completions = self.__last_completions
+        if (
+            not completions
+            or request.suffix != suffix
+            or not request.prefix.startswith(prefix)
+        ):
+            return None
+        typed = request.prefix[len(prefix) :]
+        if not typed:
+            return None  # nothing typed, e.g. the cursor moved away and back, so nothing was confirmed
+        remaining = {}
+        for model, completion in completions.items():
+            if not completion.startswith(typed) or len(completion) == len(typed):
+                return None  # typed something else, or typed the whole completion
+            remaining[model] = completion[len(typed) :]
+        return remaining
+
+    def resolve_context_files(
+        self, files: list[ContextFile]
+    ) -> tuple[list[ContextFile], list[str]]:
+        """
+        Fill in the content of the context files sent by hash from the session's cache, and cache the ones sent with
+        their content (the least recently used contents are dropped beyond MAX_CONTEXT_FILE_CHARS).
+        Returns the files with their content and hash, and the paths of the files whose content is not cached.
+        """
+        resolved, missing = [], []
+        for file in files:
+            if file.content is not None:
+                digest = hashlib.sha256(file.content.encode()).hexdigest()
+                self.__cache_context_file(digest, file.content)
+                resolved.append(
+                    ContextFile(path=file.path, content=file.content, hash=digest)
+                )
+            elif file.hash in self.__context_files:
+                self.__context_files.move_to_end(file.hash)
+                resolved.append(
+                    ContextFile(
+                        path=file.path,
+                        content=self.__context_files[file.hash],
+                        hash=file.hash,
+                    )
+                )
+            else:
+                missing.append(file.path)
+        return resolved, missing
+
+    def __cache_context_file(self, digest: str, content: str):
+        if digest in self.__context_files:
+            self.__context_files.move_to_end(digest)
+            return
+        self.__context_files[digest] = content
+        self.__context_file_chars += len(content)
+        while (
+            self.__context_file_chars > MAX_CONTEXT_FILE_CHARS
+            and len(self.__context_files) > 1
+        ):
+            _, dropped = self.__context_files.popitem(last=False)
+            self.__context_file_chars -= len(dropped)
+
+    def supersede_in_flight_request(self, request_id: str, handle) -> bool:
+        """
+        Register the generation for request_id as the session's in-flight generation.
+        The handle is anything with a cancel() method (e.g. an asyncio.Task). The generation
+        it replaces is cancelled as its result would be thrown away by the client anyway,
+        unless it is for the same request_id: a retry waits for the same generation, so its
+        handle is cancelled along with the original one instead.
+        Returns whether a generation was superseded.
+        """
+        if (
+            self.__in_flight_request is not None
+            and self.__in_flight_request[0] == request_id
+        ):
+            self.__in_flight_request[1].append(handle)
+            return False
+        superseded = self.cancel_in_flight_request()
+        self.__in_flight_request = (request_id, [handle])
+        return superseded
+
+    def cancel_in_flight_request(self) -> bool:
+        """
+        Cancel the in-flight generation of this session, if any. Returns whether one was cancelled.
+        """
+        if self.__in_flight_request is None:
+            return False
+        _, handles = self.__in_flight_request
+        self.__in_flight_request = None
+        for handle in handles:
+            handle.cancel()
+        return True
+
+    def clear_in_flight_request(self, request_id: str):
+        """
+        Mark the generation for request_id as finished (if it is still the in-flight one).
+        """
+        if (
+            self.__in_flight_request is not None
+            and self.__in_flight_request[0] == request_id
+        ):
+            self.__in_flight_request = None
+
     def get_session_since(self) -> datetime.datetime:
         return self.__session_since
 
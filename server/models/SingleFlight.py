@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Sequence
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Future, keys: Sequence[str]):
+        self.task = task
+        self.keys = keys
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Deduplication of work in progress. The first caller of `run` starts the work; callers that come with any of its
+    keys while it is still running wait for the same result instead of starting it again. The work runs as a task of
+    its own, which is only cancelled once every caller waiting for it was cancelled (superseded or disconnected).
+    Results worth replaying are kept (`remember`) for `ttl` seconds, so that a retry of a finished request gets the
+    same answer back (`recall`) rather than a second one.
+    """
+
+    def __init__(self, max_remembered: int = 4096, ttl: float = 300.0):
+        self.__flights: dict[str, _Flight] = {}
+        self.__remembered: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.__max_remembered = max_remembered
+        self.__ttl = ttl
+        self.__lock = (
+            threading.Lock()
+        )  # only for the counters and results, the flights are used from the event loop
+        self.__counters = {"started": 0, "joined": 0, "replayed": 0}
+
+    def __count(self, counter: str):
+        with self.__lock:
+            self.__counters[counter] += 1
+
+    def __land(self, flight: _Flight):
+        for key in flight.keys:
+            if self.__flights.get(key) is flight:
+                del self.__flights[key]
+
+    async def run(self, keys: Sequence[str], work: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Await the result of `work`, or of the work in progress under any of the keys. Raises what the work raises.
+        """
+        flight = next(
+            (self.__flights[key] for key in keys if key in self.__flights), None
+        )
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(work()), keys)
+            flight.task.add_done_callback(lambda _: self.__land(flight))
+            self.__count("started")
+        else:
+            self.__count("joined")
+        for key in keys:  # a joined flight is found under the new keys as well
+            self.__flights.setdefault(key, flight)
+        flight.keys = list(dict.fromkeys([*flight.keys, *keys]))
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                flight.task.cancel()  # nobody is waiting for it any more
+
+    def remember(self, key: str, result: Any):
+        with self.__lock:
+            self.__remembered[key] = (time.monotonic(), result)
+            self.__remembered.move_to_end(key)
+            while len(self.__remembered) > self.__max_remembered:
+                self.__remembered.popitem(last=False)
+
+    def recall(self, key: str) -> Any | None:
+        """The remembered result of a key, None if there is none (any more)."""
+        with self.__lock:
+            entry = self.__remembered.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.__ttl:
+                del self.__remembered[key]
+                entry = None
+            if entry is None:
+                return None
+            self.__counters["replayed"] += 1
+            return entry[1]
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                **self.__counters,
+                "in_flight": len({id(flight) for flight in self.__flights.values()}),
+                "remembered": len(self.__remembered),
+            }
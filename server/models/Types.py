@@ -8,10 +8,13 @@ class TriggerType(str, Enum):
     "auto" - The trigger was automatically generated.
     "man" - The trigger was manually generated (e.g., by a user using ctrl+space).
     "idle" - The trigger was generated by the IDE when the user is idle (e.g., after a certain time of inactivity).
+    "typeahead" - Set by the server (GenerateRequest rejects it from clients) when the user typed through the previous
+        completion, and the request was answered with the rest of it instead of generating a new one.
     """
     auto = "auto"
     man = "man"
     idle = "idle"
+    typeahead = "typeahead"
 
 
 class IDEType(str, Enum):
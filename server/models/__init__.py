@@ -1,6 +1,10 @@
 
 from .CoCoConfig import CoCoConfig
-from .Requests import GenerateRequest, VerifyRequest, SurveyRequest, SessionRequest
-from .Responses import GenerateResponse, VerifyResponse, SurveyResponse, SessionResponse, ErrorResponse
+from .Requests import GenerateRequest, ContextFile, VerifyRequest, SurveyRequest, SessionRequest
+from .Responses import GenerateResponse, ModelTiming, CompletionCandidate, CompletionChunk, VerifyResponse, SurveyResponse, SessionResponse, ErrorResponse
 from .Types import TriggerType, LanguageType, IDEType
 from .Sessions import Session, SessionManager, UserSetting, delete_expired_sessions
+from .Gate import TelemetryGate
+from .Admission import AdmissionQueue, AdmissionRejected
+from .SingleFlight import SingleFlight
+from .Encoding import EncodedResponse, EncodedRoute, JSON, MSGPACK, negotiate, encode, decode, websocket_media_type
@@ -1,10 +1,11 @@
 import os
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 from uuid import uuid4
 from datetime import datetime
 
 import pytest
 from dotenv import load_dotenv
+from langchain_core.outputs import Generation
 from sqlalchemy.orm import Session as sql_session
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
@@ -128,8 +129,10 @@ class TestEndToEnd:
         # define the mocked behavior of the completion chain
         # TODO: also remove this
         global mock_chain
-        mock_response = MagicMock(return_value={"deepseek-1.3b": "np.array(items)"})
-        mock_chain.invoke = mock_response
+        mock_response = AsyncMock(
+            return_value={"deepseek-1.3b": Generation(text="np.array(items)")}
+        )
+        mock_chain.ainvoke = mock_response
 
         generation_response = client.post(
             "/api/v3/complete", json=generate_req.model_dump()
@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+from models import TriggerType
+from models.Admission import AdmissionQueue, AdmissionRejected
+
+
+def get_queue(max_concurrent: int = 1, **max_age) -> AdmissionQueue:
+    return AdmissionQueue(
+        max_concurrent,
+        max_queued={"man": 2, "auto": 2, "idle": 0},
+        max_age={"man": 5.0, "auto": 5.0, "idle": 5.0, **max_age},
+    )
+
+
+class TestAdmissionQueue:
+
+    def test_freed_slot_goes_to_the_highest_priority_first(self):
+        # Arrange
+        admission = get_queue()
+        order = []
+
+        async def generate(trigger: TriggerType, name: str, hold: asyncio.Event = None):
+            async with admission.admit(trigger):
+                order.append(name)
+                if hold is not None:
+                    await hold.wait()
+
+        async def run():
+            hold = asyncio.Event()
+            running = asyncio.create_task(generate(TriggerType.auto, "running", hold))
+            await asyncio.sleep(0)
+            queued = [
+                asyncio.create_task(generate(TriggerType.auto, "auto")),
+                asyncio.create_task(generate(TriggerType.man, "man")),
+            ]
+            await asyncio.sleep(0)
+            depths = {c: s["depth"] for c, s in admission.stats()["classes"].items()}
+            hold.set()
+            await asyncio.gather(running, *queued)
+            return depths
+
+        # Act
+        depths = asyncio.run(run())
+
+        # Assert
+        assert order == ["running", "man", "auto"]
+        assert depths == {"man": 1, "auto": 1, "idle": 0}
+        assert admission.stats()["running"] == 0
+
+    def test_low_priority_work_is_rejected_right_away_under_overload(self):
+        # Arrange
+        admission = get_queue()
+
+        async def run():
+            hold = asyncio.Event()
+
+            async def generate(trigger: TriggerType):
+                async with admission.admit(trigger):
+                    await hold.wait()
+
+            running = asyncio.create_task(generate(TriggerType.man))
+            await asyncio.sleep(0)
+            queued = [asyncio.create_task(generate(TriggerType.auto)) for _ in range(2)]
+            await asyncio.sleep(0)
+            rejections = []
+            for trigger in (TriggerType.idle, TriggerType.auto):
+                with pytest.raises(AdmissionRejected) as rejection:
+                    await generate(trigger)
+                rejections.append(rejection.value.reason)
+            hold.set()
+            await asyncio.gather(running, *queued)
+            return rejections
+
+        # Act
+        rejections = asyncio.run(run())
+
+        # Assert
+        assert rejections == ["overloaded", "overloaded"]
+        classes = admission.stats()["classes"]
+        assert (classes["idle"]["overloaded"], classes["auto"]["overloaded"]) == (1, 1)
+        assert (classes["man"]["admitted"], classes["auto"]["admitted"]) == (1, 2)
+
+    def test_queued_request_expires_and_cancelled_ones_free_their_place(self):
+        # Arrange
+        admission = get_queue(auto=0.05)
+
+        async def run():
+            hold = asyncio.Event()
+
+            async def generate(trigger: TriggerType):
+                async with admission.admit(trigger):
+                    await hold.wait()
+
+            running = asyncio.create_task(generate(TriggerType.man))
+            await asyncio.sleep(0)
+            cancelled = asyncio.create_task(generate(TriggerType.man))
+            await asyncio.sleep(0)
+            cancelled.cancel()
+            with pytest.raises(AdmissionRejected) as rejection:
+                await generate(TriggerType.auto)
+            hold.set()
+            await running
+            return rejection.value.reason
+
+        # Act
+        reason = asyncio.run(run())
+
+        # Assert
+        assert reason == "expired"
+        stats = admission.stats()
+        assert stats["classes"]["auto"]["expired"] == 1
+        assert stats["classes"]["man"]["depth"] == 0
+        assert stats["running"] == 0
@@ -0,0 +1,1678 @@
+import asyncio
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+
+def get_fake_request_output(
+    text: str, finished: bool = True, logprobs: list = None
+) -> SimpleNamespace:
+    output = SimpleNamespace(
+        index=0,
+        text=text,
+        token_ids=list(range(len(text))),
+        cumulative_logprob=sum(logprobs or []),
+        logprobs=(
+            [{i: SimpleNamespace(logprob=lp)} for i, lp in enumerate(logprobs)]
+            if logprobs
+            else None
+        ),
+        finish_reason="stop",
+        stop_reason=None,
+    )
+    return SimpleNamespace(
+        outputs=[output], prompt_token_ids=[], finished=finished, metrics=None
+    )
+
+
+class FakeAsyncEngine:
+    """Stands in for vllm.AsyncLLMEngine, emitting one character per engine step."""
+
+    def __init__(self, text: str, step_time: float = 0.01):
+        self.text = text
+        self.step_time = step_time
+        self.request_ids = []
+        self.prompts = []
+        # one token per character
+        self.engine = SimpleNamespace(
+            get_tokenizer=lambda: SimpleNamespace(
+                encode=lambda text, add_special_tokens: list(text)
+            )
+        )
+
+    async def generate(self, prompt, sampling_params, request_id):
+        self.request_ids.append(request_id)
+        self.prompts.append(prompt)
+        for i in range(1, len(self.text) + 1):
+            time.sleep(
+                self.step_time
+            )  # the engine loop is allowed to block, the caller's loop is not
+            await asyncio.sleep(0)
+            yield get_fake_request_output(self.text[:i], finished=i == len(self.text))
+
+
+@pytest.fixture(scope="module")
+def mock_vllm():
+    """Import the completion package against a mocked vllm, so no engine is actually built"""
+    mock_vllm = MagicMock()
+    mock_vllm.SamplingParams = lambda **kwargs: kwargs
+    with patch.dict("sys.modules", {"vllm": mock_vllm}):
+        from completion import (
+            vllm_modified,
+            batching,
+            cache,
+            budget,
+            fanout,
+            registry,
+            simulated,
+            stopping,
+            speculative,
+            replicas,
+            routing,
+            repo_context,
+            postprocess,
+            prompt_tokens,
+        )
+
+        mock_vllm.vllm_modified = vllm_modified
+        mock_vllm.batching = batching
+        mock_vllm.cache = cache
+        mock_vllm.budget = budget
+        mock_vllm.fanout = fanout
+        mock_vllm.registry = registry
+        mock_vllm.simulated = simulated
+        mock_vllm.stopping = stopping
+        mock_vllm.speculative = speculative
+        mock_vllm.replicas = replicas
+        mock_vllm.routing = routing
+        mock_vllm.repo_context = repo_context
+        mock_vllm.postprocess = postprocess
+        mock_vllm.prompt_tokens = prompt_tokens
+        yield mock_vllm
+
+
+class TestVLLMModified:
+
+    @pytest.fixture
+    def async_llm(self, mock_vllm):
+        engine = FakeAsyncEngine("np.array(items)")
+        mock_vllm.AsyncLLMEngine.from_engine_args.return_value = engine
+        llm = mock_vllm.vllm_modified.VLLM_M(model="fake-model", use_async_engine=True)
+        return llm, engine
+
+    def test_ainvoke_returns_generation_with_metadata(self, async_llm):
+        # Arrange
+        llm, engine = async_llm
+
+        # Act
+        generation = asyncio.run(llm.ainvoke("arr = "))
+
+        # Assert
+        assert generation.text == "np.array(items)"
+        assert generation.generation_info["finish_reason"] == "stop"
+        assert len(engine.request_ids) == 1
+
+    def test_ainvoke_does_not_block_event_loop(self, async_llm):
+        # Arrange
+        llm, _ = async_llm
+        ticks = []
+
+        async def ticker(done: asyncio.Event):
+            while not done.is_set():
+                ticks.append(time.time())
+                await asyncio.sleep(0.005)
+
+        async def generate_while_ticking():
+            done = asyncio.Event()
+            ticking = asyncio.create_task(ticker(done))
+            generation = await llm.ainvoke("arr = ")
+            done.set()
+            await ticking
+            return generation
+
+        # Act
+        generation = asyncio.run(generate_while_ticking())
+
+        # Assert
+        assert generation.text == "np.array(items)"
+        assert len(ticks) > 5  # the loop kept running while the engine was generating
+
+    def test_astream_yields_decoded_text_then_metadata(self, async_llm):
+        # Arrange
+        llm, _ = async_llm
+
+        async def collect():
+            return [chunk async for chunk in llm.astream("arr = ")]
+
+        # Act
+        chunks = asyncio.run(collect())
+
+        # Assert
+        assert len(chunks) == len("np.array(items)") + 1
+        assert "".join(chunk.text for chunk in chunks) == "np.array(items)"
+        assert chunks[0].text == "n"
+        assert chunks[-1].generation_info["finish_reason"] == "stop"
+
+    def test_invoke_from_sync_code_uses_async_engine(self, async_llm):
+        # Arrange
+        llm, engine = async_llm
+
+        # Act
+        generation = llm.invoke("arr = ")
+
+        # Assert
+        assert generation.text == "np.array(items)"
+        assert len(engine.request_ids) == 1
+
+    def test_tokenized_prompt_is_handed_to_the_engine_as_token_ids(
+        self, mock_vllm, async_llm
+    ):
+        # Arrange
+        llm, engine = async_llm
+        prompt = mock_vllm.prompt_tokens.TokenizedPrompt("arr = ", [1, 7, 3])
+
+        # Act
+        result = asyncio.run(llm._agenerate([prompt, "arr = "]))
+
+        # Assert
+        assert result.generations[0][0].text == "np.array(items)"
+        assert engine.prompts == [{"prompt_token_ids": [1, 7, 3]}, "arr = "]
+
+    def test_only_chosen_token_logprobs_are_kept_packed(self, mock_vllm):
+        # Arrange
+        llm = mock_vllm.vllm_modified.VLLM_M(model="fake-model")
+        output = get_fake_request_output("ab", logprobs=[-0.5, -1.5])
+
+        # Act
+        generation = llm._to_generation(output)
+
+        # Assert
+        assert generation.generation_info["logprobs"].tolist() == [-0.5, -1.5]
+        assert generation.generation_info["confidence"] == pytest.approx(
+            0.36788, abs=1e-5
+        )  # exp(-1)
+
+    def test_engine_metrics_split_queue_prefill_and_decode(self, mock_vllm):
+        # Arrange
+        output = get_fake_request_output("ab")
+        output.prompt_token_ids = [1, 2, 3]
+        output.metrics = SimpleNamespace(
+            arrival_time=10.0,
+            first_scheduled_time=10.25,
+            first_token_time=10.3,
+            last_token_time=10.5,
+            finished_time=10.5,
+        )
+
+        # Act
+        metrics = mock_vllm.vllm_modified.engine_metrics(output)
+
+        # Assert
+        assert metrics == pytest.approx(
+            {
+                "queue_ms": 250,
+                "prefill_ms": 50,
+                "decode_ms": 200,
+                "prompt_tokens": 3,
+                "cached_tokens": None,
+            }
+        )
+
+
+class TestMicroBatchScheduler:
+
+    @pytest.fixture
+    def engine_calls(self):
+        return []
+
+    @pytest.fixture
+    def scheduler(self, mock_vllm, engine_calls):
+        def generate(prompts, sampling_params):
+            engine_calls.append((list(prompts), sampling_params))
+            return [f"{prompt}!" for prompt in prompts]
+
+        return mock_vllm.batching.MicroBatchScheduler(
+            generate, max_wait_ms=50, max_batch_size=4
+        )
+
+    def test_concurrent_prompts_are_submitted_as_one_batch(
+        self, scheduler, engine_calls
+    ):
+        # Act
+        futures = [scheduler.submit(f"p{i}", "params", "key") for i in range(3)]
+        results = [future.result(timeout=5) for future in futures]
+
+        # Assert
+        assert results == ["p0!", "p1!", "p2!"]
+        assert len(engine_calls) == 1
+        assert engine_calls[0] == (["p0", "p1", "p2"], "params")
+        assert scheduler.stats()["largest_batch"] == 3
+
+    def test_batch_is_capped_at_max_batch_size(self, scheduler, engine_calls):
+        # Act
+        futures = [scheduler.submit(f"p{i}", "params", "key") for i in range(6)]
+        results = [future.result(timeout=5) for future in futures]
+
+        # Assert
+        assert results == [f"p{i}!" for i in range(6)]
+        assert [len(prompts) for prompts, _ in engine_calls] == [4, 2]
+
+    def test_prompts_with_different_sampling_params_are_not_mixed(
+        self, scheduler, engine_calls
+    ):
+        # Act
+        greedy = scheduler.submit("a", "greedy", "greedy")
+        sampled = scheduler.submit("b", "sampled", "sampled")
+
+        # Assert
+        assert greedy.result(timeout=5) == "a!"
+        assert sampled.result(timeout=5) == "b!"
+        assert sorted(engine_calls) == [(["a"], "greedy"), (["b"], "sampled")]
+
+    def test_cancelled_prompt_is_dropped_from_batch(self, scheduler, engine_calls):
+        # Act
+        cancelled = scheduler.submit("stale", "params", "key")
+        cancelled.cancel()
+        kept = scheduler.submit("fresh", "params", "key")
+
+        # Assert
+        assert kept.result(timeout=5) == "fresh!"
+        assert engine_calls == [(["fresh"], "params")]
+
+    def test_cancelled_async_caller_drops_its_queued_prompt(
+        self, scheduler, engine_calls
+    ):
+        # e.g. a superseded request awaiting VLLM_M._agenerate
+        async def cancel_while_queued():
+            stale = asyncio.ensure_future(
+                asyncio.wrap_future(scheduler.submit("stale", "params", "key"))
+            )
+            await asyncio.sleep(0)
+            stale.cancel()
+            return await asyncio.wrap_future(scheduler.submit("fresh", "params", "key"))
+
+        # Act
+        result = asyncio.run(cancel_while_queued())
+
+        # Assert
+        assert result == "fresh!"
+        assert engine_calls == [(["fresh"], "params")]
+
+    def test_vllm_m_routes_blocking_engine_through_scheduler(self, mock_vllm):
+        # Arrange
+        mock_vllm.LLM.return_value.generate.side_effect = (
+            lambda prompts, sampling_params: [
+                get_fake_request_output(prompt.upper()) for prompt in prompts
+            ]
+        )
+        llm = mock_vllm.vllm_modified.VLLM_M(model="fake-model", max_batch_wait_ms=20)
+
+        async def generate_concurrently():
+            return await asyncio.gather(
+                *[llm.ainvoke(prompt) for prompt in ["a", "b", "c"]]
+            )
+
+        # Act
+        generations = asyncio.run(generate_concurrently())
+
+        # Assert
+        assert [generation.text for generation in generations] == ["A", "B", "C"]
+        assert mock_vllm.LLM.return_value.generate.call_count == 1
+
+
+class TestCompletionCache:
+
+    @pytest.fixture
+    def greedy_llm(self, mock_vllm):
+        engine = FakeAsyncEngine("np.array(items)", step_time=0)
+        mock_vllm.AsyncLLMEngine.from_engine_args.return_value = engine
+        llm = mock_vllm.vllm_modified.VLLM_M(
+            model="fake-model", use_async_engine=True, temperature=0
+        )
+        return llm, engine
+
+    def test_least_recently_used_entry_is_evicted(self, mock_vllm):
+        # Arrange
+        from langchain_core.outputs import Generation
+
+        cache = mock_vllm.cache.CompletionCache(max_entries=2)
+        cache.put("a", Generation(text="a"))
+        cache.put("b", Generation(text="b"))
+
+        # Act
+        cache.get("a")  # 'a' is now more recent than 'b'
+        cache.put("c", Generation(text="c"))
+
+        # Assert
+        assert cache.get("b") is None
+        assert cache.get("a").text == "a"
+        assert cache.get("c").text == "c"
+        assert cache.stats() | {"hit_rate": None} == {
+            "size": 2,
+            "hits": 3,
+            "misses": 1,
+            "hit_rate": None,
+            "evictions": 1,
+            "expirations": 0,
+        }
+
+    def test_entries_expire_after_ttl(self, mock_vllm):
+        # Arrange
+        from langchain_core.outputs import Generation
+
+        cache = mock_vllm.cache.CompletionCache(ttl_seconds=0.01)
+        cache.put("a", Generation(text="a"))
+
+        # Act
+        time.sleep(0.02)
+
+        # Assert
+        assert cache.get("a") is None
+        assert cache.stats()["expirations"] == 1
+
+    def test_repeated_prompt_is_served_without_engine(self, mock_vllm, greedy_llm):
+        # Arrange
+        llm, engine = greedy_llm
+        model = mock_vllm.cache.CachedModel(
+            "fake-model", llm, mock_vllm.cache.CompletionCache()
+        )
+
+        # Act
+        first = asyncio.run(model.ainvoke("arr = "))
+        second = asyncio.run(model.ainvoke("arr = "))
+        other = model.invoke("lst = ")
+
+        # Assert
+        assert first.text == second.text == "np.array(items)"
+        assert not first.generation_info.get("cached")
+        assert second.generation_info["cached"] is True
+        assert second.generation_info["finish_reason"] == "stop"
+        assert not other.generation_info.get("cached")
+        assert len(engine.request_ids) == 2
+
+    def test_sampled_model_is_not_cached(self, mock_vllm):
+        # Arrange
+        engine = FakeAsyncEngine("x", step_time=0)
+        mock_vllm.AsyncLLMEngine.from_engine_args.return_value = engine
+        llm = mock_vllm.vllm_modified.VLLM_M(
+            model="fake-model", use_async_engine=True, temperature=0.8
+        )
+        cache = mock_vllm.cache.CompletionCache()
+        model = mock_vllm.cache.CachedModel("fake-model", llm, cache)
+
+        # Act
+        model.invoke("arr = ")
+        model.invoke("arr = ")
+
+        # Assert
+        assert len(engine.request_ids) == 2
+        assert cache.stats()["size"] == 0
+
+    def test_streamed_completion_is_cached_once_finished(self, mock_vllm, greedy_llm):
+        # Arrange
+        llm, engine = greedy_llm
+        model = mock_vllm.cache.CachedModel(
+            "fake-model", llm, mock_vllm.cache.CompletionCache()
+        )
+
+        async def collect():
+            return [chunk async for chunk in model.astream("arr = ")]
+
+        # Act
+        streamed = asyncio.run(collect())
+        replayed = asyncio.run(collect())
+
+        # Assert
+        assert len(streamed) == len("np.array(items)") + 1
+        assert len(replayed) == 1
+        assert replayed[0].text == "np.array(items)"
+        assert replayed[0].generation_info["cached"] is True
+        assert len(engine.request_ids) == 1
+
+
+class TestContextBudget:
+
+    @pytest.fixture
+    def tokenized(self):
+        return []
+
+    @pytest.fixture
+    def budget(self, mock_vllm, tokenized):
+        def count_tokens(text):  # one token per character keeps the arithmetic readable
+            tokenized.append(text)
+            return len(text)
+
+        return mock_vllm.budget.ContextBudget(
+            count_tokens, max_tokens=20, prefix_ratio=0.5
+        )
+
+    def test_keeps_whole_lines_nearest_the_cursor(self, budget):
+        # Arrange
+        inputs = {
+            "prefix": "far away\nnear\nx = ",
+            "suffix": "\nprint(x)\nfar away",
+            "session_id": "s",
+        }
+
+        # Act
+        trimmed = budget(inputs)
+
+        # Assert
+        assert trimmed["prefix"] == "near\nx = "
+        assert trimmed["suffix"] == "\nprint(x)\n"
+        assert trimmed["session_id"] == "s"
+        assert budget.stats()["trimmed_requests"] == 1
+
+    def test_unused_suffix_budget_goes_to_the_prefix(self, budget):
+        # Act
+        trimmed = budget(
+            {"prefix": "a longer line\nx = ", "suffix": "", "session_id": "s"}
+        )
+
+        # Assert
+        assert trimmed["prefix"] == "a longer line\nx = "
+
+    def test_growing_prefix_only_tokenizes_changed_lines(self, budget, tokenized):
+        # Arrange
+        budget({"prefix": "import np\nx = ", "suffix": "", "session_id": "s"})
+        tokenized.clear()
+
+        # Act
+        budget({"prefix": "import np\nx = np", "suffix": "", "session_id": "s"})
+
+        # Assert
+        assert tokenized == ["x = np"]
+        assert budget.stats()["reused_lines"] == 1
+
+    def test_cursor_line_over_budget_is_cut_at_the_cursor_side(self, budget):
+        # Act
+        trimmed = budget(
+            {"prefix": "y" * 30 + "x = ", "suffix": "", "session_id": None}
+        )
+
+        # Assert
+        assert trimmed["prefix"] == "y" * 16 + "x = "
+
+
+class TestRepoContext:
+
+    @pytest.fixture
+    def repo_context(self, mock_vllm):
+        # one token per character keeps the arithmetic readable
+        return mock_vllm.repo_context.RepoContext(
+            len,
+            max_tokens=120,
+            file_template="# {path}\n{content}",
+            file_header_template="# {path}\n",
+        )
+
+    def test_related_files_are_packed_most_relevant_last(self, repo_context):
+        # Arrange
+        files = [
+            {"path": "app/shapes.py", "content": "class Circle:\n    radius = 1\n"},
+            {"path": "docs/unrelated.py", "content": 'print("hello world")\n'},
+            {
+                "path": "app/geometry.py",
+                "content": "def area(circle):\n    return circle.radius\n",
+            },
+        ]
+        inputs = {
+            "prefix": "from geometry import area\nc = Circle()\nprint(",
+            "suffix": ")",
+            "file_path": "app/main.py",
+            "context_files": files,
+        }
+
+        # Act
+        assembled = repo_context(inputs)
+
+        # Assert
+        assert (
+            assembled["context"]
+            == "# app/shapes.py\n"
+            + files[0]["content"]
+            + "# app/geometry.py\n"
+            + files[2]["content"]
+        )
+        assert assembled["file_header"] == "# app/main.py\n"
+        assert assembled["prefix"] == inputs["prefix"]
+
+    def test_files_over_budget_are_cut_and_unchanged_files_are_not_tokenized_again(
+        self, mock_vllm
+    ):
+        # Arrange
+        tokenized = []
+
+        def count_tokens(text):
+            tokenized.append(text)
+            return len(text)
+
+        repo_context = mock_vllm.repo_context.RepoContext(
+            count_tokens, max_tokens=100, file_template="{content}"
+        )
+        content = "".join(
+            f"value_{i} = {i}\n" for i in range(20)
+        )  # 12 or 13 characters a line
+        inputs = {
+            "prefix": "print(value_0)",
+            "suffix": "",
+            "context_files": [{"path": "values.py", "content": content}],
+        }
+
+        # Act
+        context = repo_context(inputs)["context"]
+        tokenized.clear()
+        repo_context(inputs)
+
+        # Assert
+        assert (
+            content.startswith(context)
+            and context.endswith("\n")
+            and 88 <= len(context) <= 100
+        )
+        assert tokenized == [
+            context
+        ]  # only the cut is counted again, not the whole file
+        assert repo_context.stats()["reused_files"] == 1
+        assert repo_context.stats()["truncated_files"] == 2
+
+
+class TestPromptTokenizer:
+
+    class ChunkTokenizer:
+        """Cuts the text into chunks of 3 characters from its start, so an insertion changes every later token."""
+
+        def encode(self, text: str, add_special_tokens: bool = False) -> list:
+            return [hash(text[i : i + 3]) for i in range(0, len(text), 3)]
+
+        def __call__(
+            self,
+            text: str,
+            add_special_tokens: bool = False,
+            return_offsets_mapping: bool = False,
+        ):
+            spans = [(i, min(i + 3, len(text))) for i in range(0, len(text), 3)]
+            return {"input_ids": self.encode(text), "offset_mapping": spans}
+
+    def test_tokens_spliced_per_keystroke_are_those_of_the_whole_prompt(
+        self, mock_vllm
+    ):
+        # Arrange
+        import random
+        from completion.fast import format_prompt
+
+        tokenizer = mock_vllm.simulated.SimulatedTokenizer()
+        template = "<｜fim▁begin｜>{context}{file_header}{prefix}<｜fim▁hole｜>{suffix}<｜fim▁end｜>"
+        prompt_tokenizer = mock_vllm.prompt_tokens.PromptTokenizer(
+            template, lambda: tokenizer
+        )
+        budget = mock_vllm.budget.ContextBudget(
+            lambda text: len(tokenizer.encode(text)), max_tokens=300
+        )
+        code = (
+            "def mean(items):\n    total = 0\n    for item in items:\n        total += item\n"
+            * 20
+        )
+        cursor, rng = len(code) // 2, random.Random(0)
+        prompts = []
+
+        # Act
+        for keystroke in range(300):
+            r = rng.random()
+            if r < 0.7:  # typing
+                code, cursor = (
+                    code[:cursor] + rng.choice("ab_ ()\n") + code[cursor:],
+                    cursor + 1,
+                )
+            elif r < 0.9:  # backspace
+                code, cursor = code[: cursor - 1] + code[cursor:], cursor - 1
+            else:
+                cursor = rng.randrange(len(code))
+            inputs = budget(
+                {"prefix": code[:cursor], "suffix": code[cursor:], "session_id": "s"}
+            )
+            inputs["context"] = (
+                "# utils.py\ndef helper(): ...\n" if keystroke > 150 else ""
+            )
+            prompts.append((prompt_tokenizer(inputs), format_prompt(template, inputs)))
+
+        # Assert
+        assert all(
+            prompt == text and prompt.token_ids == tokenizer.encode(text)
+            for prompt, text in prompts
+        )
+        stats = prompt_tokenizer.stats()
+        assert stats["full_segments"] == 2  # only the first prompt's
+        assert stats["tokenized_chars"] < stats["prompt_chars"] / 3
+
+    def test_splice_whose_margins_are_tokenized_differently_falls_back_to_the_whole_segment(
+        self, mock_vllm
+    ):
+        # Arrange
+        tokenizer = self.ChunkTokenizer()
+        prompt_tokenizer = mock_vllm.prompt_tokens.PromptTokenizer(
+            "{prefix}", lambda: tokenizer, margin=4
+        )
+        code = "x = 1\n" * 50
+
+        # Act
+        prompt_tokenizer({"prefix": code, "suffix": "", "session_id": "s"})
+        prompt = prompt_tokenizer(
+            {"prefix": code[:100] + "y" + code[100:], "suffix": "", "session_id": "s"}
+        )
+
+        # Assert
+        assert prompt.token_ids == tokenizer.encode(code[:100] + "y" + code[100:])
+        assert prompt_tokenizer.stats()["resync_failures"] == 1
+
+    def test_template_whose_literals_merge_with_the_text_is_left_as_text(
+        self, mock_vllm
+    ):
+        # Arrange
+        tokenizer = mock_vllm.simulated.SimulatedTokenizer()
+        prompt_tokenizer = mock_vllm.prompt_tokens.PromptTokenizer(
+            "{prefix}hole{suffix}", lambda: tokenizer
+        )
+
+        # Act
+        prompt = prompt_tokenizer({"prefix": "arr = np.", "suffix": ""})
+
+        # Assert
+        assert prompt == "arr = np.hole"
+        assert not isinstance(prompt, mock_vllm.prompt_tokens.TokenizedPrompt)
+        assert prompt_tokenizer.stats()["incremental"] is False
+
+
+class TestDeadlineFanOut:
+
+    class FakeModel:
+        def __init__(self, text: str = "", delay: float = 0, error: Exception = None):
+            self.text = text
+            self.delay = delay
+            self.error = error
+            self.calls = 0
+            self.cancelled = False
+
+        async def ainvoke(self, input, config=None, **kwargs):
+            from langchain_core.outputs import Generation
+
+            self.calls += 1
+            try:
+                await asyncio.sleep(self.delay)
+            except asyncio.CancelledError:
+                self.cancelled = True
+                raise
+            if self.error is not None:
+                raise self.error
+            return Generation(text=self.text)
+
+    def test_late_model_is_cancelled_and_marked_timed_out(self, mock_vllm):
+        # Arrange
+        fast, slow = self.FakeModel("fast"), self.FakeModel("slow", delay=1)
+        fan_out = mock_vllm.fanout.DeadlineFanOut(
+            {"fast": fast, "slow": slow}, deadline_seconds=0.05
+        )
+
+        # Act
+        start = time.time()
+        generations = asyncio.run(fan_out.ainvoke({}))
+
+        # Assert
+        assert time.time() - start < 0.5
+        assert generations["fast"].text == "fast"
+        assert generations["slow"].generation_info == {"status": "timed_out"}
+        assert slow.cancelled
+
+    def test_deadline_depends_on_the_trigger(self, mock_vllm):
+        # Arrange
+        from models import TriggerType
+
+        fan_out = mock_vllm.fanout.DeadlineFanOut(
+            {"slow": self.FakeModel("slow", delay=0.1)},
+            deadline_seconds=0.02,
+            trigger_deadlines={"man": 1},
+        )
+
+        # Act
+        manual = asyncio.run(fan_out.ainvoke({"trigger": TriggerType.man}))
+        auto = asyncio.run(fan_out.ainvoke({"trigger": TriggerType.auto}))
+
+        # Assert
+        assert manual["slow"].text == "slow"
+        assert auto["slow"].generation_info == {"status": "timed_out"}
+
+    def test_invoke_works_from_within_a_running_event_loop(self, mock_vllm):
+        # Arrange
+        fan_out = mock_vllm.fanout.DeadlineFanOut(
+            {"fast": self.FakeModel("fast")}, deadline_seconds=1
+        )
+
+        async def invoke_from_async_code():
+            return fan_out.invoke({})
+
+        # Act
+        generations = asyncio.run(invoke_from_async_code())
+
+        # Assert
+        assert generations["fast"].text == "fast"
+
+    def test_failing_model_is_left_out(self, mock_vllm):
+        # Arrange
+        models = {
+            "ok": self.FakeModel("ok"),
+            "broken": self.FakeModel(error=RuntimeError("CUDA OOM")),
+        }
+        fan_out = mock_vllm.fanout.DeadlineFanOut(models, deadline_seconds=1)
+
+        # Act
+        generations = asyncio.run(fan_out.ainvoke({}))
+
+        # Assert
+        assert list(generations.keys()) == ["ok"]
+
+    def test_request_fails_only_if_every_model_fails(self, mock_vllm):
+        # Arrange
+        fan_out = mock_vllm.fanout.DeadlineFanOut(
+            {"broken": self.FakeModel(error=RuntimeError("CUDA OOM"))},
+            deadline_seconds=1,
+        )
+
+        # Act & Assert
+        with pytest.raises(RuntimeError):
+            asyncio.run(fan_out.ainvoke({}))
+
+    def test_only_the_routed_models_are_run(self, mock_vllm):
+        # Arrange
+        small, large = self.FakeModel("small"), self.FakeModel("large")
+        fan_out = mock_vllm.fanout.DeadlineFanOut(
+            {"small": small, "large": large}, deadline_seconds=1
+        )
+
+        # Act
+        routed = asyncio.run(fan_out.ainvoke({"models": ["small"]}))
+        unrouted = asyncio.run(fan_out.ainvoke({"models": []}))
+        everything = asyncio.run(fan_out.ainvoke({"models": None}))
+
+        # Assert
+        assert list(routed) == ["small"]
+        assert unrouted == {}
+        assert sorted(everything) == ["large", "small"]
+        assert (small.calls, large.calls) == (2, 1)
+
+    def test_breaker_skips_model_that_keeps_timing_out_until_cooldown(self, mock_vllm):
+        # Arrange
+        slow = self.FakeModel("slow", delay=1)
+        fan_out = mock_vllm.fanout.DeadlineFanOut(
+            {"fast": self.FakeModel("fast"), "slow": slow},
+            deadline_seconds=0.02,
+            failure_threshold=2,
+            cooldown_seconds=0.2,
+        )
+
+        # Act
+        for _ in range(3):
+            generations = asyncio.run(fan_out.ainvoke({}))
+        calls_while_open = slow.calls
+        time.sleep(0.25)
+        slow.delay = 0  # recovered
+        recovered = asyncio.run(fan_out.ainvoke({}))
+
+        # Assert
+        assert "slow" not in generations  # skipped entirely on the third request
+        assert calls_while_open == 2
+        assert fan_out.stats()["slow"]["trips"] == 1
+        assert recovered["slow"].text == "slow"
+        assert fan_out.stats()["slow"]["state"] == "closed"
+
+    def test_cancelled_half_open_trial_lets_the_next_request_try(self, mock_vllm):
+        # Arrange
+        slow = self.FakeModel("slow", delay=1)
+        fan_out = mock_vllm.fanout.DeadlineFanOut(
+            {"slow": slow},
+            deadline_seconds=0.02,
+            failure_threshold=1,
+            cooldown_seconds=0.05,
+        )
+        asyncio.run(fan_out.ainvoke({}))  # opens the breaker
+        time.sleep(0.1)
+
+        async def cancel_the_trial():
+            trial = asyncio.create_task(fan_out.ainvoke({}))
+            await asyncio.sleep(0.01)
+            trial.cancel()  # e.g. superseded by the next keystroke
+            with pytest.raises(asyncio.CancelledError):
+                await trial
+
+        # Act
+        asyncio.run(cancel_the_trial())
+        state_after_cancel = fan_out.stats()["slow"]["state"]
+        slow.delay = 0
+        generations = asyncio.run(fan_out.ainvoke({}))
+
+        # Assert
+        assert state_after_cancel == "open"
+        assert generations["slow"].text == "slow"
+        assert fan_out.stats()["slow"]["state"] == "closed"
+        assert fan_out.stats()["slow"]["rejected"] == 0
+
+
+class TestModelRegistry:
+
+    @pytest.fixture
+    def built_engines(self, mock_vllm):
+        built_engines = []
+
+        def build_fake(spec):
+            mock_vllm.AsyncLLMEngine.from_engine_args.return_value = FakeAsyncEngine(
+                "np.array(items)", step_time=0
+            )
+            built_engines.append(spec.model)
+            return mock_vllm.vllm_modified.VLLM_M(model=spec.model, **spec.engine)
+
+        with patch.dict(mock_vllm.registry.BACKENDS, {"fake": build_fake}):
+            yield built_engines
+
+    @pytest.fixture
+    def registry(self, mock_vllm, built_engines):
+        specs = [
+            mock_vllm.registry.ModelSpec(
+                name=name,
+                backend="fake",
+                model="fake-model",
+                template="{prefix}<hole>{suffix}",
+                engine={"use_async_engine": True},
+                sampling={"temperature": temperature},
+            )
+            for name, temperature in [("greedy", 0), ("sampled", 0.8)]
+        ]
+        return mock_vllm.registry.ModelRegistry(
+            specs, mock_vllm.cache.CompletionCache()
+        )
+
+    def test_default_specs_are_loaded_without_building_engines(self, mock_vllm):
+        # Act
+        registry = mock_vllm.registry.ModelRegistry.from_file(
+            mock_vllm.registry.DEFAULT_SPECS, mock_vllm.cache.CompletionCache()
+        )
+
+        # Assert
+        assert "deepseek-1.3b" in registry.models
+        assert registry.stats()["engines"] == 0
+        assert not registry.models["deepseek-1.3b"].ready
+
+    def test_specs_with_the_same_engine_share_it(self, registry, built_engines):
+        # Act
+        registry.warm_up()
+
+        # Assert
+        assert built_engines == ["fake-model"]
+        assert registry.stats()["engines"] == 1
+        assert all(model.ready for model in registry.models.values())
+
+    def test_model_is_built_in_the_background_on_first_use(
+        self, mock_vllm, registry, built_engines
+    ):
+        # Arrange
+        inputs = {"prefix": "arr = ", "suffix": "", "session_id": "s"}
+        model = registry.models["greedy"]
+
+        # Act
+        with pytest.raises(mock_vllm.registry.ModelNotReady):
+            asyncio.run(model.ainvoke(inputs))
+        for _ in range(100):
+            if model.ready:
+                break
+            time.sleep(0.01)
+        generation = asyncio.run(model.ainvoke(inputs))
+
+        # Assert
+        assert built_engines == ["fake-model"]
+        assert generation.text == "np.array(items)"
+
+    def test_fast_path_gives_the_same_completion_and_cache_key_as_the_chain(
+        self, registry
+    ):
+        # Arrange
+        inputs = {
+            "prefix": "arr = ",
+            "suffix": "",
+            "session_id": "s",
+            "language": "python",
+            "trigger": "auto",
+        }
+        registry.warm_up()
+        model = registry.models["greedy"]
+
+        async def complete():
+            return await model.ainvoke_fast(inputs), await model.ainvoke(inputs)
+
+        # Act
+        fast, chain = asyncio.run(complete())
+
+        # Assert
+        assert fast.text == chain.text == "np.array(items)"
+        assert not fast.generation_info.get("cached")
+        assert chain.generation_info["cached"]  # the same prompt, so the same key
+        assert model.stats()["stopping"]["modes"]["line"] == 2
+
+
+class TestSimulatedLLM:
+
+    def test_greedy_completion_has_the_vllm_contract(self, mock_vllm):
+        # Arrange
+        llm = mock_vllm.simulated.SimulatedLLM(
+            temperature=0, logprobs=1, decode_ms_per_token=1
+        )
+
+        # Act
+        first = llm.invoke("import numpy as np\narr = ")
+        second = asyncio.run(llm.ainvoke("import numpy as np\narr = "))
+
+        # Assert
+        assert first.text == second.text
+        assert first.generation_info["finish_reason"] in ("stop", "length")
+        assert len(first.generation_info["token_ids"]) == len(
+            first.generation_info["logprobs"]
+        )
+        assert first.generation_info["logprobs"].typecode == "f"
+        assert 0 < first.generation_info["confidence"] <= 1
+
+    def test_cassette_is_replayed(self, mock_vllm, tmp_path):
+        # Arrange
+        from langchain_core.outputs import Generation
+
+        cassette = tmp_path / "cassette.jsonl"
+        mock_vllm.simulated.save_to_cassette(
+            str(cassette),
+            "arr = ",
+            Generation(
+                text="np.array(items)", generation_info={"finish_reason": "stop"}
+            ),
+        )
+        llm = mock_vllm.simulated.SimulatedLLM(
+            cassette=str(cassette), decode_ms_per_token=1
+        )
+
+        # Act
+        generation = llm.invoke("arr = ")
+
+        # Assert
+        assert generation.text == "np.array(items)"
+        assert generation.generation_info["finish_reason"] == "stop"
+
+    def test_concurrent_prompts_are_decoded_as_one_batch(self, mock_vllm):
+        # Arrange
+        llm = mock_vllm.simulated.SimulatedLLM(
+            temperature=0, decode_ms_per_token=1, max_batch_wait_ms=20
+        )
+
+        async def generate_concurrently():
+            return await asyncio.gather(
+                *[llm.ainvoke(f"x{i} = y + z") for i in range(4)]
+            )
+
+        # Act
+        generations = asyncio.run(generate_concurrently())
+
+        # Assert
+        assert len(generations) == 4
+        assert llm.scheduler.stats()["largest_batch"] == 4
+
+
+class TestStopping:
+
+    def test_line_mode_while_typing_or_in_the_middle_of_a_line(self, mock_vllm):
+        # Arrange
+        stopping_params = mock_vllm.stopping.stopping_params
+
+        # Act
+        typing = stopping_params(
+            {
+                "prefix": "arr = ",
+                "suffix": "\nprint(arr)",
+                "language": "python",
+                "trigger": "auto",
+            },
+            None,
+        )
+        mid_line = stopping_params(
+            {"prefix": "f(", "suffix": ")\n", "language": "python", "trigger": "man"},
+            None,
+        )
+
+        # Assert
+        assert typing["stop"] == mid_line["stop"] == []
+        assert typing["max_tokens"] == mid_line["max_tokens"] == 64
+        (processor,) = typing["logits_processors"]
+        assert repr(processor) == "LineEndProcessor()"
+
+    def test_line_mode_stops_at_the_end_of_the_first_written_line(self, mock_vllm):
+        # Arrange
+        import numpy as np
+
+        tokenizer = mock_vllm.simulated.SimulatedTokenizer()
+        processor = mock_vllm.stopping.LineEndProcessor(tokenizer)
+        line_end = mock_vllm.stopping.line_end
+
+        # Act
+        logits = processor(tokenizer.encode("\n    return x\n"), np.zeros(8))
+
+        # Assert
+        assert not processor.should_stop(tokenizer.encode("\n    return x"))
+        assert logits[tokenizer.eos_token_id] == 0 and np.isinf(logits[1:]).all()
+        assert line_end("\n    return x\n    y") == 13
+        assert line_end("x)\n") == 2
+        assert line_end(" \n\n") is None
+
+    def test_block_mode_forces_eos_once_the_enclosing_block_closes(self, mock_vllm):
+        # Arrange
+        import numpy as np
+
+        tokenizer = mock_vllm.simulated.SimulatedTokenizer()
+        params = mock_vllm.stopping.stopping_params(
+            {
+                "prefix": "def f(x):\n    ",
+                "suffix": "\n    return x\n",
+                "language": "python",
+                "trigger": "man",
+            },
+            tokenizer,
+        )
+        (processor,) = params["logits_processors"]
+        inside = tokenizer.encode("y = x + 1\n    return y\n")
+        closed = tokenizer.encode("y = x + 1\n    return y\nprint")
+
+        # Act
+        logits = processor(closed, np.zeros(8))
+
+        # Assert
+        # the suffix line only stops at the start of a line, with its indentation
+        assert params["stop"] == ["\n    return x"] and params["max_tokens"] == 256
+        assert not processor.should_stop(inside)
+        assert logits[tokenizer.eos_token_id] == 0 and np.isinf(logits[1:]).all()
+        assert mock_vllm.stopping.block_end("a();\n}\n}", "java", 0) == 6
+        assert mock_vllm.stopping.block_end("y\n    z\nprint", "python", 4) == 8
+
+    def test_stopping_model_reports_decoded_and_returned_tokens(self, mock_vllm):
+        # Arrange
+        from langchain_core.prompts import PromptTemplate
+
+        llm = mock_vllm.simulated.SimulatedLLM(
+            temperature=0, completion_tokens=200, decode_ms_per_token=0
+        )
+        model = mock_vllm.stopping.StoppingModel(
+            PromptTemplate.from_template("{prefix}<hole>{suffix}"),
+            llm,
+            llm.get_tokenizer,
+            llm.get_num_tokens,
+        )
+        prefix = (
+            "def f(x):\n    y = x + 1\n    return y\n\nprint(f(2))\n" * 20
+            + "def g(x):\n    "
+        )
+        inputs = {
+            "prefix": prefix,
+            "suffix": "",
+            "language": "python",
+            "trigger": "man",
+        }
+
+        # Act
+        generation = model.invoke(inputs)
+        line = model.invoke({**inputs, "trigger": "auto"})
+
+        # Assert
+        assert mock_vllm.stopping.block_end(generation.text, "python", 4) is None
+        assert (
+            generation.generation_info["returned_tokens"]
+            <= generation.generation_info["decoded_tokens"]
+        )
+        assert "\n" not in line.text
+        assert model.stats()["modes"] == {"line": 1, "block": 1}
+        # a line completion may start on the next line
+        assert (
+            model.finish(
+                {**inputs, "prefix": "def g(x):", "trigger": "auto"},
+                "\n    return x\nprint",
+                None,
+            ).text
+            == "\n    return x"
+        )
+
+    def test_stream_holds_back_a_stop_string_until_it_is_complete(self, mock_vllm):
+        # Arrange
+        class StopStringEngine(FakeAsyncEngine):
+            async def generate(self, prompt, sampling_params, request_id):
+                # like vLLM, the partial outputs contain the start of the stop string until it is complete
+                for text in ["x", "x\npr", "x\nprin"]:
+                    yield get_fake_request_output(text, finished=False)
+                yield get_fake_request_output("x", finished=True)
+
+        mock_vllm.AsyncLLMEngine.from_engine_args.return_value = StopStringEngine("")
+        llm = mock_vllm.vllm_modified.VLLM_M(model="fake-model", use_async_engine=True)
+
+        async def collect():
+            return [
+                chunk.text async for chunk in llm.astream("arr = ", stop=["\nprint("])
+            ]
+
+        # Act
+        chunks = asyncio.run(collect())
+
+        # Assert
+        assert "".join(chunks) == "x"
+
+
+class TestPromptLookup:
+
+    def test_drafts_continue_the_first_earlier_occurrence_of_the_longest_ngram(
+        self, mock_vllm
+    ):
+        # Arrange
+        lookup = mock_vllm.speculative.PromptLookup(
+            [1, 2, 3, 4, 9, 2, 3, 5, 6, 2, 3], num_tokens=3
+        )
+
+        # Act
+        draft = lookup.propose()
+        lookup.extend([7])
+        no_draft = lookup.propose()
+
+        # Assert
+        assert draft == [4, 9, 2]
+        assert no_draft == []
+
+    def test_replay_counts_steps_and_accepted_drafts(self, mock_vllm):
+        # Arrange
+        prompt = [1, 2, 3, 4, 5, 6, 7]
+
+        # Act
+        copied = mock_vllm.speculative.replay(prompt, [3, 4, 5, 6, 7], num_tokens=4)
+        novel = mock_vllm.speculative.replay(prompt, [8, 9, 10], num_tokens=4)
+
+        # Assert
+        # step 1 has nothing to look up after 7 -> emits 3; step 2 drafts 4 5 6 7, all accepted (+ the bonus token)
+        assert copied["steps"] == 2 and copied["accepted_tokens"] == 4
+        assert novel == {
+            "steps": 3,
+            "proposed_tokens": 0,
+            "accepted_tokens": 0,
+            "acceptance_rate": 0.0,
+            "tokens_per_step": 1.0,
+        }
+
+    def test_simulated_engine_takes_fewer_steps_on_repetitive_code(self, mock_vllm):
+        # Arrange
+        llm = mock_vllm.simulated.SimulatedLLM(
+            temperature=0,
+            completion_tokens=100,
+            decode_ms_per_token=0,
+            prompt_lookup_tokens=5,
+        )
+        prompt = "items.append(x)\n" * 30 + "items."
+
+        # Act
+        generation = llm.invoke(prompt)
+
+        # Assert
+        speculation = generation.generation_info["speculation"]
+        assert speculation["steps"] < len(generation.generation_info["token_ids"])
+        assert llm.speculation.stats()["requests"] == 1
+        assert llm.speculation.stats()["tokens_per_step"] > 1
+
+
+class TestReplicaPool:
+
+    def test_adding_a_replica_only_moves_sessions_onto_it(self, mock_vllm):
+        # Arrange
+        three, four = mock_vllm.replicas.HashRing(3), mock_vllm.replicas.HashRing(4)
+        sessions = [f"session-{i}" for i in range(1000)]
+
+        # Act
+        moved = [four.lookup(s) for s in sessions if three.lookup(s) != four.lookup(s)]
+
+        # Assert
+        assert set(moved) == {3}
+        assert 150 < len(moved) < 350  # about a quarter
+
+    def test_keystrokes_of_a_session_stick_to_one_replica_and_hit_its_prefix_cache(
+        self, mock_vllm
+    ):
+        # Arrange
+        spec = mock_vllm.registry.ModelSpec(
+            name="pooled",
+            backend="simulated",
+            model="simulated",
+            template="{prefix}<hole>{suffix}",
+            engine={
+                "prefill_ms_per_token": 0,
+                "decode_ms_per_token": 0,
+                "max_batch_wait_ms": 0,
+                "enable_prefix_caching": True,
+            },
+            sampling={"temperature": 0},
+            replicas=3,
+        )
+        registry = mock_vllm.registry.ModelRegistry(
+            [spec], mock_vllm.cache.CompletionCache()
+        )
+        registry.warm_up()
+        model = registry.models["pooled"]
+        code = (
+            "def mean(items):\n    total = 0\n    for item in items:\n        total += item\n"
+            * 4
+        )
+
+        async def type_in(session: str):
+            return [
+                await model.ainvoke_fast(
+                    {
+                        "prefix": f"# {session}\n{code}    return tot"[: len(code) + i],
+                        "suffix": "",
+                        "session_id": session,
+                    }
+                )
+                for i in range(3)
+            ]
+
+        # Act
+        generations = {f"s{i}": asyncio.run(type_in(f"s{i}")) for i in range(6)}
+
+        # Assert
+        for session, keystrokes in generations.items():
+            assert len({g.generation_info["replica"] for g in keystrokes}) == 1
+        assert (
+            len(
+                {
+                    keystrokes[0].generation_info["replica"]
+                    for keystrokes in generations.values()
+                }
+            )
+            > 1
+        )
+        replicas = model.stats()["replicas"]["replicas"]
+        assert (
+            sum(r["requests"] for r in replicas)
+            == sum(r["affinity"] for r in replicas)
+            == 18
+        )
+        assert (
+            sum(r["prefix_cache_hits"] for r in replicas) >= 12
+        )  # every keystroke after the first
+
+    def test_saturated_replica_falls_back_to_the_least_loaded_one(self, mock_vllm):
+        # Arrange
+        replicas = [
+            mock_vllm.simulated.SimulatedLLM(
+                temperature=0, decode_ms_per_token=5, max_batch_wait_ms=0
+            )
+            for _ in range(3)
+        ]
+        pool = mock_vllm.replicas.ReplicaPool(replicas=replicas, max_in_flight=1)
+
+        async def complete(prompt: str):
+            mock_vllm.replicas.routing_key.set("session")
+            return await pool.ainvoke(prompt)
+
+        async def burst():
+            return await asyncio.gather(*[complete(f"x{i} = y + z") for i in range(3)])
+
+        # Act
+        generations = asyncio.run(burst())
+
+        # Assert
+        assert sorted(g.generation_info["replica"] for g in generations) == [0, 1, 2]
+        replicas = pool.stats()["replicas"]
+        assert sum(r["affinity"] for r in replicas) == 1
+        assert sum(r["fallbacks"] for r in replicas) == 2
+        assert all(r["in_flight"] == 0 for r in replicas)
+
+
+class TestRoutingTable:
+
+    def test_first_matching_rule_decides_and_unmatched_requests_go_to_every_model(
+        self, mock_vllm
+    ):
+        # Arrange
+        table = mock_vllm.routing.RoutingTable(
+            [
+                mock_vllm.routing.RoutingRule(languages=["csv"], models=[]),
+                mock_vllm.routing.RoutingRule(
+                    languages=["markdown"], plugin_versions=["0.3.*"], models=["small"]
+                ),
+                mock_vllm.routing.RoutingRule(
+                    project_languages=["python"], ides=["PyCharm"], models=["python"]
+                ),
+            ]
+        )
+
+        # Act
+        routes = [
+            table.route("csv"),
+            table.route("markdown", plugin_version="0.3.1"),
+            table.route("markdown", plugin_version="0.2.0"),
+            table.route("yaml", project_language="python", ide="PyCharm"),
+            table.route("yaml", project_language="python", ide="VSCode"),
+        ]
+
+        # Assert
+        assert routes == [[], ["small"], None, ["python"], None]
+        assert [rule["matches"] for rule in table.stats()["rules"]] == [1, 1, 1]
+        assert table.stats()["unmatched"] == 2
+
+    def test_default_routing_only_names_known_models(self, mock_vllm):
+        # Arrange
+        registry = mock_vllm.registry.ModelRegistry.from_file(
+            mock_vllm.registry.DEFAULT_SPECS, mock_vllm.cache.CompletionCache()
+        )
+
+        # Act
+        table = mock_vllm.routing.RoutingTable.from_file(
+            mock_vllm.routing.DEFAULT_ROUTING, registry.models
+        )
+
+        # Assert
+        assert table.route("csv") == []
+        assert table.route("python") is None
+        assert all(set(rule.models) <= set(registry.models) for rule in table.rules)
+
+
+class TestPostProcessor:
+
+    def test_longest_overlap_with_the_suffix_is_found_at_word_boundaries(
+        self, mock_vllm
+    ):
+        suffix_overlap = mock_vllm.postprocess.suffix_overlap
+
+        assert suffix_overlap("np.array(items))", ")\n\nprint(arr.dtype)") == 1
+        assert (
+            suffix_overlap("x = f(a)\nreturn x", "\nreturn x\n") == 9
+        )  # the next statement
+        assert (
+            suffix_overlap("a.a.a.", "a.a.b") == 4
+        )  # needs the failure function, not a greedy match
+        assert (
+            suffix_overlap("item", "s = []") == 0
+        )  # a longer identifier, not a repeated `s`
+        assert suffix_overlap("items", "") == 0
+
+    def test_overlap_is_trimmed_and_empty_completions_are_dropped(self, mock_vllm):
+        # Arrange
+        from langchain_core.outputs import Generation
+
+        post_processor = mock_vllm.postprocess.PostProcessor()
+        inputs = {"prefix": "arr = ", "suffix": ")\nprint(arr)"}
+        generations = {
+            "overlapping": Generation(text="np.array(items)"),
+            "repeating": Generation(text=")"),
+            "blank": Generation(text="  \n"),
+            "late": Generation(text="", generation_info={"status": "timed_out"}),
+        }
+
+        # Act
+        processed = post_processor(inputs, generations)
+
+        # Assert
+        assert processed["overlapping"].text == "np.array(items"
+        assert processed["overlapping"].generation_info["trimmed_overlap"] == 1
+        assert set(processed) == {"overlapping", "late"}
+        assert post_processor.stats() == {
+            "completions": 3,
+            "trimmed_completions": 2,
+            "trimmed_chars": 2,
+            "dropped_empty": 2,
+        }
+
+    def test_stream_holds_back_only_a_possible_overlap(self, mock_vllm):
+        # Arrange
+        from langchain_core.outputs import GenerationChunk
+
+        post_processor = mock_vllm.postprocess.PostProcessor()
+        inputs = {"prefix": "x = ", "suffix": ")\nreturn x"}
+        pieces = [
+            ("a", "f(y"),
+            ("a", ")\nret"),
+            ("b", " "),
+            ("a", "urn x"),
+            ("b", "\n"),
+        ]
+
+        async def chunks():
+            for i, (model, text) in enumerate(pieces):
+                last = all(other != model for other, _ in pieces[i + 1 :])
+                yield model, GenerationChunk(
+                    text=text, generation_info={} if last else None
+                )
+
+        async def collect():
+            return [
+                (model, chunk.text)
+                async for model, chunk in post_processor.astream(inputs, chunks())
+            ]
+
+        # Act
+        streamed = asyncio.run(collect())
+
+        # Assert
+        assert streamed == [
+            ("a", "f(y"),
+            ("a", ""),
+        ]  # ')\nreturn x' was held back, then trimmed; b was blank
+        assert post_processor.stats()["dropped_empty"] == 1
+
+    def test_stream_sends_nothing_of_a_completion_that_is_only_whitespace_once_trimmed(
+        self, mock_vllm
+    ):
+        # Arrange
+        from langchain_core.outputs import GenerationChunk
+
+        post_processor = mock_vllm.postprocess.PostProcessor()
+        inputs = {"prefix": "f(x", "suffix": ")\nreturn x"}
+        pieces = ["  ", ")", "\n"]  # only the overlap is more than whitespace
+
+        async def chunks():
+            for i, text in enumerate(pieces):
+                yield "m", GenerationChunk(
+                    text=text, generation_info={} if i == len(pieces) - 1 else None
+                )
+
+        async def collect():
+            return [
+                (model, chunk.text)
+                async for model, chunk in post_processor.astream(inputs, chunks())
+            ]
+
+        # Act
+        streamed = asyncio.run(collect())
+
+        # Assert
+        assert streamed == []
+        assert post_processor.stats()["dropped_empty"] == 1
+
+
+class TestCandidates:
+
+    def test_candidates_are_sampled_in_one_engine_call(self, mock_vllm):
+        # Arrange
+        spec = mock_vllm.registry.ModelSpec(
+            name="sampled",
+            backend="simulated",
+            model="simulated",
+            template="{prefix}<hole>{suffix}",
+            engine={
+                "prefill_ms_per_token": 0,
+                "decode_ms_per_token": 0,
+                "max_batch_wait_ms": 0,
+            },
+            sampling={"temperature": 0, "logprobs": 1},
+            candidates={"temperature": 0.8},
+        )
+        registry = mock_vllm.registry.ModelRegistry(
+            [spec], mock_vllm.cache.CompletionCache()
+        )
+        registry.warm_up()
+        model = registry.models["sampled"]
+        inputs = {
+            "prefix": "def mean(items):\n    total = sum(items)\n    ",
+            "suffix": "",
+            "candidates": 3,
+        }
+
+        # Act
+        with patch.object(
+            mock_vllm.simulated.SimulatedLLM,
+            "_complete",
+            autospec=True,
+            side_effect=mock_vllm.simulated.SimulatedLLM._complete,
+        ) as complete:
+            generation = asyncio.run(model.ainvoke_fast(inputs))
+
+        # Assert
+        assert complete.call_count == 1
+        params = complete.call_args.args[2]
+        assert params["n"] == 3 and params["temperature"] == 0.8
+        candidates = generation.generation_info["candidates"]
+        assert len(candidates) == 3
+        assert all(c["score"] is None or c["score"] <= 0 for c in candidates)
+
+    def test_candidates_are_trimmed_deduplicated_and_ranked(self, mock_vllm):
+        # Arrange
+        from langchain_core.outputs import Generation
+
+        post_processor = mock_vllm.postprocess.PostProcessor()
+        inputs = {"prefix": "arr = ", "suffix": ")\nprint(arr)"}
+        candidates = [
+            {"text": "np.array(items)", "score": -0.4},
+            {
+                "text": "np.array(items",
+                "score": -0.1,
+            },  # the same once the overlap is trimmed
+            {"text": "list(items)", "score": -0.2},
+            {"text": " ", "score": 0.0},
+            {"text": "tuple(items", "score": None},
+        ]
+        # the engine's first sequence is sampled, so it need not be the best one
+        generations = {
+            "m": Generation(
+                text="list(items)", generation_info={"candidates": candidates}
+            )
+        }
+
+        # Act
+        processed = post_processor(inputs, generations)
+
+        # Assert
+        assert processed["m"].generation_info["candidates"] == [
+            {"text": "np.array(items", "score": -0.1},
+            {"text": "list(items", "score": -0.2},
+            {"text": "tuple(items", "score": None},
+        ]
+        assert (
+            processed["m"].text == "np.array(items"
+        )  # the completion is the top-ranked candidate
+
+    def test_stream_of_several_candidates_sends_the_top_ranked_one(self, mock_vllm):
+        # Arrange
+        from langchain_core.outputs import GenerationChunk
+
+        post_processor = mock_vllm.postprocess.PostProcessor()
+        inputs = {"prefix": "arr = ", "suffix": "", "candidates": 2}
+        candidates = [
+            {"text": "list(items)", "score": -0.5},
+            {"text": "np.array(items)", "score": -0.1},
+        ]
+
+        async def chunks():
+            yield "m", GenerationChunk(text="list(")
+            yield "m", GenerationChunk(
+                text="items)", generation_info={"candidates": candidates}
+            )
+
+        async def collect():
+            return [
+                (model, chunk.text)
+                async for model, chunk in post_processor.astream(inputs, chunks())
+            ]
+
+        # Act
+        streamed = asyncio.run(collect())
+
+        # Assert
+        assert streamed == [("m", "np.array(items)")]
+
+
+class TestChainStreaming:
+
+    class FakeStreamingModel:
+        def __init__(self, pieces: list[str], delay: float):
+            self.pieces = pieces
+            self.delay = delay
+
+        async def astream(self, inputs):
+            from langchain_core.outputs import GenerationChunk
+
+            for i, piece in enumerate(self.pieces):
+                await asyncio.sleep(self.delay)
+                # the last chunk carries the metadata
+                yield GenerationChunk(
+                    text=piece,
+                    generation_info={} if i == len(self.pieces) - 1 else None,
+                )
+
+    def test_astream_interleaves_models_as_they_decode(self, mock_vllm):
+        # Arrange
+        import completion
+
+        fake_models = {
+            "fast": self.FakeStreamingModel(["a", "b", "c"], delay=0.02),
+            "slow": self.FakeStreamingModel(["x"], delay=0.05),
+        }
+        gen_req = MagicMock(prefix="arr = ", suffix="", candidates=1)
+
+        async def collect():
+            return [
+                (model, chunk.text)
+                async for model, chunk in completion.astream(gen_req)
+            ]
+
+        # Act
+        with patch.dict(completion.models, fake_models, clear=True):
+            chunks = asyncio.run(collect())
+
+        # Assert
+        assert chunks == [("fast", "a"), ("fast", "b"), ("slow", "x"), ("fast", "c")]
+
+    def test_astream_ends_the_models_that_miss_the_deadline_as_timed_out(
+        self, mock_vllm
+    ):
+        # Arrange
+        import completion
+
+        fake_models = {
+            "fast": self.FakeStreamingModel(["a", "b"], delay=0.01),
+            "late": self.FakeStreamingModel(["x", "y"], delay=0.15),
+        }
+        gen_req = MagicMock(prefix="arr = ", suffix="", candidates=1, trigger="idle")
+
+        async def collect():
+            return [
+                (model, chunk.text, chunk.generation_info)
+                async for model, chunk in completion.astream(gen_req)
+            ]
+
+        # Act
+        with (
+            patch.dict(completion.models, fake_models, clear=True),
+            patch.dict(completion.fan_out.trigger_deadlines, {"idle": 0.2}),
+        ):
+            chunks = asyncio.run(collect())
+
+        # Assert
+        assert chunks[-1] == ("late", "", {"status": "timed_out"})
+        assert [(model, text) for model, text, _ in chunks[:-1]] == [
+            ("fast", "a"),
+            ("fast", "b"),
+            ("late", "x"),
+        ]
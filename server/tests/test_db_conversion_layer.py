@@ -2,6 +2,7 @@ import datetime
 from uuid import uuid4
 
 import pytest
+from array import array
 from unittest.mock import patch, MagicMock
 
 from database.app_to_db import (get_query_from_request, get_context_from_request,
@@ -40,7 +41,15 @@ def get_dummy_active_request_and_session() -> Tuple[ActiveRequest, SessionModel]
                 "model_1": ModelCompletionDetails.model_validate({
                     "completion": "Slim",
                     "shown_at": [(request_time + datetime.timedelta(seconds=t)) for t in range(1, 61, 10)],
-                    "accepted": True
+                    "accepted": True,
+                    "logprobs": array('f', [-0.5, -0.25]).tobytes(),
+                    "confidence": 0.7,
+                    "generation_time": 120,
+                    "queue_time": 20,
+                    "prefill_time": 30,
+                    "decode_time": 60,
+                    "prompt_tokens": 400,
+                    "generated_tokens": 2
                 }),
                 "model_2": ModelCompletionDetails.model_validate({
                     "completion": "Slime",
@@ -171,8 +180,14 @@ class TestAppToDb:
             assert generations[i].completion == active_request.completions[f"model_{i + 1}"].completion
             assert generations[i].shown_at == [str(x) for x in active_request.completions[f"model_{i + 1}"].shown_at]
             assert generations[i].was_accepted == active_request.completions[f"model_{i + 1}"].accepted
-            # assert generations[i].confidence == 1.0
-            # assert generations[i].logprobs == [0.2, 0.3, 0.4, 0.1]
+        assert generations[0].confidence == 0.7
+        assert generations[0].logprobs == [-0.5, -0.25]
+        assert generations[1].confidence is None  # e.g. typed through, no logprobs to go by
+        assert generations[1].logprobs == []
+        assert (generations[0].generation_time, generations[0].queue_time, generations[0].prefill_time,
+                generations[0].decode_time) == (120, 20, 30, 60)
+        assert (generations[0].prompt_tokens, generations[0].generated_tokens) == (400, 2)
+        assert generations[1].generation_time == 0 and generations[1].queue_time is None
 
     # the add_active_request_to_db function is not tested as the individual components are alredy tested
     # and the creation of the tables by the objects are tested in test_database.py
@@ -0,0 +1,85 @@
+from unittest.mock import patch
+
+import pytest
+from fastapi import APIRouter, FastAPI, Request
+from fastapi.testclient import TestClient
+
+from models import GenerateRequest, GenerateResponse, ModelTiming
+from models.Encoding import JSON, MSGPACK, EncodedRoute, decode, encode, negotiate
+
+
+def get_response() -> GenerateResponse:
+    return GenerateResponse(
+        time=0.12,
+        completions={"model_1": "np.array(items)", "model_2": "list(items)"},
+        timing={"model_1": ModelTiming(wall_ms=120.0, prompt_tokens=400)},
+    )
+
+
+class TestEncoding:
+
+    def test_clients_get_msgpack_only_if_they_prefer_it_and_it_is_installed(self):
+        with patch("models.Encoding.MSGPACK_AVAILABLE", True):
+            assert negotiate("application/msgpack") == MSGPACK
+            assert negotiate("application/x-msgpack, application/json;q=0.5") == MSGPACK
+            assert negotiate("application/json, application/msgpack;q=0.9") == JSON
+            assert negotiate("application/msgpack;q=0") == JSON
+            assert negotiate("*/*") == JSON
+            assert negotiate(None) == JSON
+        with patch("models.Encoding.MSGPACK_AVAILABLE", False):
+            assert negotiate("application/msgpack") == JSON
+
+    def test_models_are_encoded_straight_to_json_bytes_and_decoded_back(self):
+        # Arrange
+        response = get_response()
+        example = GenerateRequest.model_config["json_schema_extra"]["examples"][0]
+
+        # Act
+        encoded = encode(response)
+        decoded = decode(encode(example), GenerateRequest)
+
+        # Assert
+        assert encoded == response.model_dump_json().encode()
+        assert GenerateResponse.model_validate_json(encoded) == response
+        assert decoded == GenerateRequest(**example)
+        assert (
+            encode({"a": [1, 2]}) == b'{"a":[1,2]}'
+        )  # anything that is not a model goes through orjson
+
+    def test_models_survive_a_msgpack_round_trip(self):
+        msgpack = pytest.importorskip("msgpack")
+        response = get_response()
+
+        encoded = encode(response, MSGPACK)
+
+        assert GenerateResponse.model_validate(msgpack.unpackb(encoded)) == response
+        assert decode(
+            msgpack.packb({"session_id": "x", "error": 1}), dict, MSGPACK
+        ) == {"session_id": "x", "error": 1}
+
+    def test_routes_return_their_models_encoded_and_keep_their_response_model(self):
+        # Arrange
+        router = APIRouter(route_class=EncodedRoute)
+
+        @router.get("/response")
+        async def endpoint(request: Request) -> GenerateResponse:
+            return get_response()
+
+        app = FastAPI()
+        app.include_router(router)
+        client = TestClient(app)
+
+        # Act
+        with patch("models.Encoding.MSGPACK_AVAILABLE", False):
+            response = client.get(
+                "/response", headers={"Accept": "application/msgpack"}
+            )
+
+        # Assert
+        assert response.headers["content-type"] == JSON
+        assert response.headers["vary"] == "Accept"
+        assert response.content == get_response().model_dump_json().encode()
+        schema = app.openapi()["paths"]["/response"]["get"]["responses"]["200"][
+            "content"
+        ][JSON]["schema"]
+        assert schema == {"$ref": "#/components/schemas/GenerateResponse"}
@@ -0,0 +1,85 @@
+from logging import Logger
+from unittest.mock import MagicMock
+
+import numpy as np
+import pytest
+
+from models import GenerateRequest
+from models.Gate import TelemetryGate, telemetry_features, train_gate
+
+
+def get_request(trigger: str, typing_speed: int) -> GenerateRequest:
+    gen_req = GenerateRequest.model_config["json_schema_extra"]["examples"][0]
+    return GenerateRequest.model_validate(
+        {
+            **gen_req,
+            "trigger": trigger,
+            "telemetry": {**gen_req["telemetry"], "typing_speed": typing_speed},
+        }
+    )
+
+
+@pytest.fixture
+def rows():
+    """Fast typists never accept a completion, slow ones always do."""
+    rng = np.random.default_rng(0)
+    return [
+        (
+            int(rng.integers(100, 5000)),
+            speed,
+            int(rng.integers(100, 10000)),
+            float(rng.random()),
+            speed < 200,
+        )
+        for speed in rng.integers(50, 400, size=500).tolist()
+    ]
+
+
+class TestTelemetryGate:
+
+    def test_learns_from_telemetry_and_acceptance(self, rows):
+        # Act
+        gate = train_gate(rows, thresholds={"auto": 0.5})
+
+        # Assert
+        assert gate.predict(telemetry_features(1000, 80, 2000, 0.5)) > 0.9
+        assert gate.predict(telemetry_features(1000, 350, 2000, 0.5)) < 0.1
+        assert (
+            0 < gate.predict(telemetry_features(None, None, None, None)) < 1
+        )  # missing telemetry is fine
+
+    def test_only_triggers_with_a_threshold_are_skipped(self, rows):
+        # Arrange
+        gate = TelemetryGate.fit(
+            np.array([telemetry_features(*row[:4]) for row in rows]),
+            np.array([row[4] for row in rows]),
+            thresholds={"auto": 0.5},
+            shadow=False,
+        )
+        logger = MagicMock(spec=Logger)
+
+        # Act
+        auto_fast = gate.should_skip(get_request("auto", 350), logger)
+        auto_slow = gate.should_skip(get_request("auto", 80), logger)
+        manual_fast = gate.should_skip(get_request("man", 350), logger)
+
+        # Assert
+        assert (auto_fast, auto_slow, manual_fast) == (True, False, False)
+        assert gate.stats()["evaluated"] == 2
+        assert gate.stats()["below_threshold"] == 1
+
+    def test_shadow_mode_only_logs_and_counts(self, rows, tmp_path):
+        # Arrange
+        train_gate(rows, thresholds={}).save(str(tmp_path / "gate.npz"))
+        gate = TelemetryGate.load(
+            str(tmp_path / "gate.npz"), thresholds={"auto": 0.5}, shadow=True
+        )
+        logger = MagicMock(spec=Logger)
+
+        # Act
+        skipped = gate.should_skip(get_request("auto", 350), logger)
+
+        # Assert
+        assert skipped is False
+        assert gate.stats()["below_threshold"] == 1
+        assert "would be skipped" in logger.log.call_args.args[1]
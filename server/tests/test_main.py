@@ -1,4 +1,7 @@
+import asyncio
 import datetime
+import hashlib
+import json
 from unittest.mock import MagicMock, patch, AsyncMock
 
 import os
@@ -10,11 +13,13 @@ from dotenv import load_dotenv
 from fastapi import FastAPI
 
 from fastapi.testclient import TestClient
+from langchain_core.outputs import Generation, GenerationChunk
 from starlette.requests import Request
 
 from models import (
-    GenerateRequest, SurveyRequest, SurveyResponse,
-    GenerateResponse, Session, SessionRequest, ErrorResponse, VerifyRequest, VerifyResponse
+    GenerateRequest, ContextFile, SurveyRequest, SurveyResponse,
+    GenerateResponse, Session, SessionRequest, ErrorResponse, VerifyRequest, VerifyResponse, TriggerType,
+    AdmissionQueue,
 )
 
 from fastapi.responses import FileResponse
@@ -35,6 +40,8 @@ class TestCoCoAPI:
         global mock_chain
         mock_chain = MagicMock(return_value='mocked chain behavior')
         mock_completion.chain = mock_chain
+        mock_completion.fast_chain = mock_chain
+        mock_completion.route.return_value = None  # every model
 
         with patch.dict('sys.modules', {'completion': mock_completion}):  # mock the completion module
             from main import app, config as _config
@@ -296,13 +303,14 @@ class TestCoCoAPI:
         with (patch('main.get_session_by_token_if_exists') as mocked_get_session_by_token_if_exists,
               patch('main.request_in_limit') as mocked_request_in_limit):
             mocked_session = MagicMock()
+            mocked_session.get_typeahead_completions.return_value = None  # nothing to type through
             mocked_get_session_by_token_if_exists.return_value = mocked_session
             mocked_request_in_limit.return_value = True
 
             # define the mocked completion function
             global mock_chain
-            mock_response = MagicMock(return_value={'model_1': 'np.array(items)'})
-            mock_chain.invoke = mock_response
+            mock_response = AsyncMock(return_value={'model_1': Generation(text='np.array(items)')})
+            mock_chain.ainvoke = mock_response
 
             response = client.post('api/v3/complete', json=gen_req)
 
@@ -310,18 +318,115 @@ class TestCoCoAPI:
         for key in response.json()["completions"]:
             assert len(response.json()["completions"][key]) > 0
 
+    def test_complete_endpoint_marks_cached_completions(self, client):
+        gen_req = GenerateRequest.model_config['json_schema_extra']['examples'][0]
+        with (patch('main.get_session_by_token_if_exists') as mocked_get_session_by_token_if_exists,
+              patch('main.request_in_limit') as mocked_request_in_limit):
+            mocked_get_session_by_token_if_exists.return_value = MagicMock()
+            mocked_get_session_by_token_if_exists.return_value.get_typeahead_completions.return_value = None
+            mocked_request_in_limit.return_value = True
+
+            global mock_chain
+            mock_chain.ainvoke = AsyncMock(return_value={
+                'model_1': Generation(text='np.array(items)', generation_info={'cached': True}),
+                'model_2': Generation(text='np.array(items2)', generation_info={'finish_reason': 'stop'}),
+            })
+
+            response = client.post('api/v3/complete', json=gen_req)
+
+        assert response.status_code == 200
+        assert response.json()['completions'] == {'model_1': 'np.array(items)', 'model_2': 'np.array(items2)'}
+        assert response.json()['timing']['model_1']['cached'] is True
+        assert response.json()['timing']['model_2']['cached'] is False
+
+    def test_complete_endpoint_returns_ranked_candidates_when_asked(self, client):
+        gen_req = GenerateRequest.model_config['json_schema_extra']['examples'][0]
+        candidates = [{'text': 'np.array(items)', 'score': -0.1}, {'text': 'list(items)', 'score': -0.3}]
+        with (patch('main.get_session_by_token_if_exists') as mocked_get_session_by_token_if_exists,
+              patch('main.request_in_limit') as mocked_request_in_limit):
+            mocked_get_session_by_token_if_exists.return_value = MagicMock()
+            mocked_get_session_by_token_if_exists.return_value.get_typeahead_completions.return_value = None
+            mocked_request_in_limit.return_value = True
+
+            global mock_chain
+            mock_chain.ainvoke = AsyncMock(return_value={
+                'model_1': Generation(text='np.array(items)', generation_info={'candidates': candidates}),
+                'model_2': Generation(text='np.array(items2)'),
+            })
+
+            response = client.post(
+                'api/v3/complete', json={**gen_req, 'request_id': str(uuid4()), 'candidates': 2}
+            )
+
+        assert response.json()['completions'] == {'model_1': 'np.array(items)', 'model_2': 'np.array(items2)'}
+        assert response.json()['candidates'] == {'model_1': candidates}
+        assert mock_chain.ainvoke.call_args.args[0].candidates == 2
+
+    def test_complete_endpoint_returns_timing_breakdown_when_asked(self, client):
+        gen_req = GenerateRequest.model_config['json_schema_extra']['examples'][0]
+        generation_info = {
+            'wall_ms': 120.0, 'decoded_tokens': 5,
+            'metrics': {'queue_ms': 20.0, 'prefill_ms': 30.0, 'decode_ms': 60.0, 'prompt_tokens': 400},
+        }
+        with (patch('main.get_session_by_token_if_exists') as mocked_get_session_by_token_if_exists,
+              patch('main.request_in_limit') as mocked_request_in_limit):
+            mocked_session = MagicMock()
+            mocked_session.get_typeahead_completions.return_value = None
+            mocked_get_session_by_token_if_exists.return_value = mocked_session
+            mocked_request_in_limit.return_value = True
+
+            global mock_chain
+            mock_chain.ainvoke = AsyncMock(return_value={
+                'model_1': Generation(text='np.array(items)', generation_info=generation_info),
+            })
+
+            without_breakdown = client.post('api/v3/complete', json=gen_req)
+            with_breakdown = client.post(
+                'api/v3/complete', json={**gen_req, 'request_id': str(uuid4()), 'timing_breakdown': True}
+            )  # a new request, a retry would get the first response back
+
+        assert without_breakdown.json()['timing']['model_1']['queue_ms'] is None
+        timing = with_breakdown.json()['timing']['model_1']
+        assert (timing['wall_ms'], timing['queue_ms'], timing['prefill_ms'], timing['decode_ms']) == (120, 20, 30, 60)
+        # stored either way
+        details = mocked_session.add_active_request.call_args.args[4]['model_1']
+        assert (details['generation_time'], details['queue_time'], details['generated_tokens']) == (120, 20, 5)
+
+    def test_complete_endpoint_reports_timed_out_models(self, client):
+        gen_req = GenerateRequest.model_config['json_schema_extra']['examples'][0]
+        with (patch('main.get_session_by_token_if_exists') as mocked_get_session_by_token_if_exists,
+              patch('main.request_in_limit') as mocked_request_in_limit):
+            mocked_session = MagicMock()
+            mocked_session.get_typeahead_completions.return_value = None  # nothing to type through
+            mocked_get_session_by_token_if_exists.return_value = mocked_session
+            mocked_request_in_limit.return_value = True
+
+            global mock_chain
+            mock_chain.ainvoke = AsyncMock(return_value={
+                'model_1': Generation(text='np.array(items)'),
+                'model_2': Generation(text='', generation_info={'status': 'timed_out'}),
+            })
+
+            response = client.post('api/v3/complete', json=gen_req)
+
+        assert response.status_code == 200
+        assert response.json()['completions'] == {'model_1': 'np.array(items)'}
+        assert response.json()['timed_out'] == ['model_2']
+        assert list(mocked_session.add_active_request.call_args.args[2].keys()) == ['model_1']
+
     def test_complete_endpoint_when_generation_throws(self, client):
         gen_req = GenerateRequest.model_config['json_schema_extra']['examples'][0]
         with (patch('main.get_session_by_token_if_exists') as mocked_get_session_by_token_if_exists,
               patch('main.request_in_limit') as mocked_request_in_limit):
             mocked_session = MagicMock()
+            mocked_session.get_typeahead_completions.return_value = None  # nothing to type through
             mocked_get_session_by_token_if_exists.return_value = mocked_session
             mocked_request_in_limit.return_value = True
 
             # define the mocked completion function
             global mock_chain
-            mock_response = MagicMock(return_value={'model_1': 'np.array(items)'})
-            mock_chain.invoke = mock_response
+            mock_response = AsyncMock(return_value={'model_1': Generation(text='np.array(items)')})
+            mock_chain.ainvoke = mock_response
             mock_response.side_effect = Exception('mocked exception')
 
             response = client.post('api/v3/complete', json=gen_req)
@@ -329,6 +434,316 @@ class TestCoCoAPI:
         assert response.status_code == 200
         assert response.json()['error'] == 'Error generating completions.'
 
+    def test_newer_request_supersedes_in_flight_generation(self, client):
+        from main import app, autocomplete_v3
+
+        # Arrange
+        example = GenerateRequest.model_config['json_schema_extra']['examples'][0]
+        first_req = GenerateRequest(**{**example, 'request_id': 'first'})
+        # the user typed on, an identical prompt would share the first generation instead
+        second_req = GenerateRequest(**{**example, 'request_id': 'second', 'prefix': example['prefix'] + 'n'})
+        session = Session(user_id=str(uuid4()))
+        request = MagicMock()
+        request.client.host = '127.0.0.1'
+
+        async def mocked_generation(gen_req, models=None):
+            await asyncio.sleep(0.5 if gen_req.request_id == 'first' else 0)
+            return {'model_1': Generation(text=gen_req.request_id)}
+
+        async def send_two_requests():
+            first = asyncio.create_task(autocomplete_v3(first_req, request))
+            await asyncio.sleep(0.05)
+            second = await autocomplete_v3(second_req, request)
+            return await first, second
+
+        global mock_chain
+        mock_chain.ainvoke = AsyncMock(side_effect=mocked_generation)
+        with (patch('main.get_session_by_token_if_exists', return_value=session),
+              patch('main.request_in_limit', return_value=True)):
+            # Act
+            first_response, second_response = asyncio.run(send_two_requests())
+
+        # Assert
+        assert first_response == ErrorResponse(error='Request superseded by a newer request -> no completions generated.')
+        assert second_response.completions == {'model_1': 'second'}
+        assert app.cancellation_stats['superseded'] == 1
+        assert list(session.get_user_active_requests().keys()) == ['second']
+
+    def test_duplicate_requests_share_one_generation_and_retries_are_replayed(self, client):
+        from main import app, autocomplete_v3
+
+        # Arrange
+        example = GenerateRequest.model_config['json_schema_extra']['examples'][0]
+        first_req = GenerateRequest(**{**example, 'request_id': 'first'})
+        duplicate_req = GenerateRequest(**{**example, 'request_id': 'duplicate'})
+        session = Session(user_id=str(uuid4()))
+        request = MagicMock()
+        request.client.host = '127.0.0.1'
+
+        async def mocked_generation(gen_req, models=None):
+            await asyncio.sleep(0.1)
+            return {'model_1': Generation(text='np.array(items)')}
+
+        async def send_duplicates_then_retry():
+            first = asyncio.create_task(autocomplete_v3(first_req, request))
+            await asyncio.sleep(0.02)
+            duplicate = await autocomplete_v3(duplicate_req, request)
+            first = await first
+            return first, duplicate, await autocomplete_v3(duplicate_req, request)
+
+        global mock_chain
+        mock_chain.ainvoke = AsyncMock(side_effect=mocked_generation)
+        with (patch('main.get_session_by_token_if_exists', return_value=session),
+              patch('main.request_in_limit', return_value=True)):
+            # Act
+            first_response, duplicate_response, retried_response = asyncio.run(send_duplicates_then_retry())
+
+        # Assert
+        # the duplicate still supersedes the first request, but takes over its generation rather than starting one
+        assert first_response == ErrorResponse(error='Request superseded by a newer request -> no completions generated.')
+        assert duplicate_response.completions == {'model_1': 'np.array(items)'}
+        assert retried_response == duplicate_response
+        assert mock_chain.ainvoke.call_count == 1
+        assert app.single_flight.stats()['joined'] == 1
+        assert app.single_flight.stats()['replayed'] == 1
+        assert list(session.get_user_active_requests().keys()) == ['duplicate']
+
+    def test_prompt_key_tells_context_files_apart_by_content(self, client):
+        from main import get_prompt_key
+
+        # Arrange
+        example = GenerateRequest.model_config['json_schema_extra']['examples'][0]
+        by_content = [
+            GenerateRequest(**{**example, 'context_files': [{'path': 'utils.py', 'content': content}]})
+            for content in ('def f(): pass', 'def g(): pass')
+        ]
+        digest = hashlib.sha256('def f(): pass'.encode()).hexdigest()
+        by_hash = GenerateRequest(**{**example, 'context_files': [{'path': 'utils.py', 'hash': digest}]})
+
+        # Act
+        keys = [get_prompt_key(gen_req) for gen_req in [*by_content, by_hash]]
+
+        # Assert
+        assert keys[0] != keys[1]
+        assert keys[0] == keys[2]
+
+    def test_retry_of_an_in_flight_request_waits_for_it_and_ids_are_scoped_to_the_session(self, client):
+        from main import app, autocomplete_v3
+
+        # Arrange
+        example = GenerateRequest.model_config['json_schema_extra']['examples'][0]
+        first_req = GenerateRequest(**{**example, 'request_id': 'first'})
+        other_session_req = GenerateRequest(**{**example, 'request_id': 'first', 'session_id': str(uuid4())})
+        sessions = {first_req.session_id: Session(user_id=str(uuid4())),
+                    other_session_req.session_id: Session(user_id=str(uuid4()))}
+        request = MagicMock()
+        request.client.host = '127.0.0.1'
+
+        async def mocked_generation(gen_req, models=None):
+            await asyncio.sleep(0.1)
+            return {'model_1': Generation(text=gen_req.session_id)}
+
+        async def send_request_and_retries():
+            first = asyncio.create_task(autocomplete_v3(first_req, request))
+            await asyncio.sleep(0.02)
+            retry = await autocomplete_v3(first_req, request)
+            return await first, retry, await autocomplete_v3(other_session_req, request)
+
+        global mock_chain
+        mock_chain.ainvoke = AsyncMock(side_effect=mocked_generation)
+        superseded = app.cancellation_stats['superseded']
+        with (patch('main.get_session_by_token_if_exists', side_effect=lambda _, token: sessions[token]),
+              patch('main.request_in_limit', return_value=True)):
+            # Act
+            first_response, retried_response, other_session_response = asyncio.run(send_request_and_retries())
+
+        # Assert
+        # the retry neither supersedes the original request nor starts a generation of its own
+        assert first_response.completions == {'model_1': first_req.session_id}
+        assert retried_response.completions == first_response.completions
+        assert app.cancellation_stats['superseded'] == superseded
+        # the same request id in another session is neither replayed nor joined
+        assert other_session_response.completions == {'model_1': other_session_req.session_id}
+        assert mock_chain.ainvoke.call_count == 2
+
+    def test_clients_cannot_send_the_typeahead_trigger(self, client):
+        gen_req = GenerateRequest.model_config['json_schema_extra']['examples'][0]
+
+        response = client.post('api/v3/complete', json={**gen_req, 'trigger': 'typeahead'})
+
+        assert response.status_code == 422
+        assert 'set by the server' in response.json()['detail'][0]['msg']
+
+    def test_typing_through_the_last_completion_skips_the_models(self, client):
+        from main import autocomplete_v3
+
+        # Arrange
+        example = GenerateRequest.model_config['json_schema_extra']['examples'][0]
+        first_req = GenerateRequest(**{**example, 'request_id': 'first'})
+        typed_req = GenerateRequest(**{**example, 'request_id': 'typed', 'prefix': example['prefix'] + 'np.arr'})
+        session = Session(user_id=str(uuid4()))
+        request = MagicMock()
+        request.client.host = '127.0.0.1'
+
+        global mock_chain
+        mock_chain.ainvoke = AsyncMock(return_value={'model_1': Generation(text='np.array(items)')})
+        with (patch('main.get_session_by_token_if_exists', return_value=session),
+              patch('main.request_in_limit', return_value=True)):
+            # Act
+            asyncio.run(autocomplete_v3(first_req, request))
+            response = asyncio.run(autocomplete_v3(typed_req, request))
+            retried = asyncio.run(autocomplete_v3(typed_req, request))
+
+        # Assert
+        assert response.completions == {'model_1': 'ay(items)'}
+        assert response.timing['model_1'].typeahead is True
+        assert retried == response  # replayed, not typed through (or generated) again
+        assert mock_chain.ainvoke.call_count == 1
+        assert session.get_active_request('typed').request.trigger == TriggerType.typeahead
+
+    def test_gated_request_skips_the_models(self, client):
+        gen_req = GenerateRequest.model_config['json_schema_extra']['examples'][0]
+        with (patch('main.get_session_by_token_if_exists') as mocked_get_session_by_token_if_exists,
+              patch('main.request_in_limit') as mocked_request_in_limit,
+              patch('main.app.gate') as mocked_gate):
+            mocked_session = MagicMock()
+            mocked_session.get_typeahead_completions.return_value = None
+            mocked_get_session_by_token_if_exists.return_value = mocked_session
+            mocked_request_in_limit.return_value = True
+            mocked_gate.should_skip.return_value = True
+
+            global mock_chain
+            mock_chain.ainvoke = AsyncMock(return_value={'model_1': Generation(text='np.array(items)')})
+
+            response = client.post('api/v3/complete', json=gen_req)
+
+        assert response.json()['gated'] is True
+        assert response.json()['completions'] == {}
+        mock_chain.ainvoke.assert_not_called()
+        mocked_session.add_active_request.assert_not_called()
+
+    def test_language_routed_to_no_model_skips_the_models(self, client):
+        gen_req = GenerateRequest.model_config['json_schema_extra']['examples'][0]
+        with (patch('main.get_session_by_token_if_exists') as mocked_get_session_by_token_if_exists,
+              patch('main.request_in_limit') as mocked_request_in_limit,
+              patch('main.app.chain_route') as mocked_route):
+            mocked_session = MagicMock()
+            mocked_session.get_typeahead_completions.return_value = None
+            mocked_session.get_project_ide.return_value = None
+            mocked_get_session_by_token_if_exists.return_value = mocked_session
+            mocked_request_in_limit.return_value = True
+            mocked_route.return_value = []
+
+            global mock_chain
+            mock_chain.ainvoke = AsyncMock(return_value={'model_1': Generation(text='np.array(items)')})
+
+            response = client.post('api/v3/complete', json={**gen_req, 'language': 'csv'})
+
+        assert response.json()['completions'] == {}
+        assert mocked_route.call_args.args[0] == 'csv'
+        mock_chain.ainvoke.assert_not_called()
+        mocked_session.add_active_request.assert_not_called()
+
+    def test_context_files_are_resolved_from_the_session_and_missing_ones_reported(self, client):
+        gen_req = GenerateRequest.model_config['json_schema_extra']['examples'][0]
+        context_files = [{'path': 'utils.py', 'hash': 'a' * 64}, {'path': 'main.py', 'hash': 'b' * 64}]
+        resolved = [ContextFile(path='utils.py', content='def helper(): ...\n', hash='a' * 64)]
+        with (patch('main.get_session_by_token_if_exists') as mocked_get_session_by_token_if_exists,
+              patch('main.request_in_limit') as mocked_request_in_limit):
+            mocked_session = MagicMock()
+            mocked_session.get_typeahead_completions.return_value = None
+            mocked_session.resolve_context_files.return_value = (resolved, ['main.py'])
+            mocked_get_session_by_token_if_exists.return_value = mocked_session
+            mocked_request_in_limit.return_value = True
+
+            global mock_chain
+            mock_chain.ainvoke = AsyncMock(return_value={'model_1': Generation(text='np.array(items)')})
+
+            response = client.post('api/v3/complete', json={**gen_req, 'context_files': context_files})
+
+        assert response.json()['missing_context_files'] == ['main.py']
+        assert mock_chain.ainvoke.call_args.args[0].context_files == resolved
+
+    def test_request_shed_by_admission_control_gets_an_overloaded_error(self, client):
+        gen_req = GenerateRequest.model_config['json_schema_extra']['examples'][0]
+        with (patch('main.get_session_by_token_if_exists') as mocked_get_session_by_token_if_exists,
+              patch('main.request_in_limit') as mocked_request_in_limit,
+              patch('main.app.admission', AdmissionQueue(0, max_queued={}, max_age={}))):
+            mocked_session = MagicMock()
+            mocked_session.get_typeahead_completions.return_value = None
+            mocked_get_session_by_token_if_exists.return_value = mocked_session
+            mocked_request_in_limit.return_value = True
+
+            global mock_chain
+            mock_chain.ainvoke = AsyncMock(return_value={'model_1': Generation(text='np.array(items)')})
+
+            response = client.post('api/v3/complete', json=gen_req)
+
+        assert response.json()['overloaded'] is True
+        assert 'overloaded' in response.json()['error']
+        mock_chain.ainvoke.assert_not_called()
+        mocked_session.add_active_request.assert_not_called()
+
+    def test_complete_stream_endpoint_sends_chunks_then_response(self, client):
+        gen_req = GenerateRequest.model_config['json_schema_extra']['examples'][0]
+
+        async def mocked_stream(_, models=None):
+            for text in ['np.', 'array', '(items)']:
+                yield 'model_1', GenerationChunk(text=text)
+
+        with (patch('main.get_session_by_token_if_exists') as mocked_get_session_by_token_if_exists,
+              patch('main.request_in_limit') as mocked_request_in_limit,
+              patch('main.app.chain_stream', new=mocked_stream)):
+            mocked_session = MagicMock()
+            mocked_session.get_typeahead_completions.return_value = None  # nothing to type through
+            mocked_get_session_by_token_if_exists.return_value = mocked_session
+            mocked_request_in_limit.return_value = True
+
+            response = client.post('api/v3/complete/stream', json=gen_req)
+
+        events = [event.split('\n') for event in response.text.strip().split('\n\n')]
+
+        assert response.status_code == 200
+        assert response.headers['content-type'].startswith('text/event-stream')
+        assert [event[0] for event in events] == ['event: chunk'] * 3 + ['event: done']
+        assert json.loads(events[0][1].removeprefix('data: ')) == {'model': 'model_1', 'text': 'np.'}
+        assert json.loads(events[-1][1].removeprefix('data: '))['completions'] == {'model_1': 'np.array(items)'}
+        mocked_session.add_active_request.assert_called_once()
+
+    def test_complete_stream_endpoint_reports_the_models_that_timed_out(self, client):
+        gen_req = GenerateRequest.model_config['json_schema_extra']['examples'][0]
+
+        async def mocked_stream(_, models=None):
+            yield 'model_2', GenerationChunk(text='list(')
+            yield 'model_1', GenerationChunk(text='np.array(items)', generation_info={})
+            yield 'model_2', GenerationChunk(text='', generation_info={'status': 'timed_out'})
+
+        with (patch('main.get_session_by_token_if_exists') as mocked_get_session_by_token_if_exists,
+              patch('main.request_in_limit') as mocked_request_in_limit,
+              patch('main.app.chain_stream', new=mocked_stream)):
+            mocked_session = MagicMock()
+            mocked_session.get_typeahead_completions.return_value = None  # nothing to type through
+            mocked_get_session_by_token_if_exists.return_value = mocked_session
+            mocked_request_in_limit.return_value = True
+
+            response = client.post('api/v3/complete/stream', json=gen_req)
+
+        events = [event.split('\n') for event in response.text.strip().split('\n\n')]
+        done = json.loads(events[-1][1].removeprefix('data: '))
+
+        assert events[-1][0] == 'event: done'
+        assert done['completions'] == {'model_1': 'np.array(items)'}
+        assert done['timed_out'] == ['model_2']
+        assert 'model_2' not in done['timing']
+
+    def test_complete_stream_endpoint_with_invalid_session(self, client):
+        gen_req = GenerateRequest.model_config['json_schema_extra']['examples'][0]
+
+        response = client.post('api/v3/complete/stream', json=gen_req)
+
+        assert response.status_code == 200
+        assert response.text.startswith('event: error')
+
     def test_verification_of_active_request(self, client):
         with patch('main.get_session_by_token_if_exists') as mocked_get_session_by_token_if_exists:
             # Arrange
@@ -410,6 +825,31 @@ class TestCoCoAPI:
                 assert response['time'] == 0.2
 
 
+    def test_websocket_generate_endpoint_streams_when_requested(self, client):
+        # Arrange
+        gen_req = {**GenerateRequest.model_config['json_schema_extra']['examples'][0], 'stream': True}
+
+        async def mocked_stream(_, models=None):
+            for text in ['np.array', '(items)']:
+                yield 'model_1', GenerationChunk(text=text)
+
+        with (patch('main.get_session_by_token_if_exists') as mocked_get_session_by_token_if_exists,
+              patch('main.request_in_limit') as mocked_request_in_limit,
+              patch('main.app.chain_stream', new=mocked_stream)):
+            mocked_get_session_by_token_if_exists.return_value = MagicMock()
+            mocked_get_session_by_token_if_exists.return_value.get_typeahead_completions.return_value = None
+            mocked_request_in_limit.return_value = True
+
+            with client.websocket_connect('/api/v3/ws/complete') as websocket:
+                # Act
+                websocket.send_json(gen_req)
+                frames = [websocket.receive_json() for _ in range(3)]
+
+        # Assert
+        assert frames[0] == {'model': 'model_1', 'text': 'np.array'}
+        assert frames[1] == {'model': 'model_1', 'text': '(items)'}
+        assert frames[2]['completions'] == {'model_1': 'np.array(items)'}
+
     def test_verifying_requests_through_websocket(self, client):
         # Arrange
         with (patch('main.get_session_by_token_if_exists') as mocked_get_session_by_token_if_exists,
@@ -1,3 +1,4 @@
+from array import array
 import datetime
 import threading
 import time
@@ -10,7 +11,7 @@ from unittest.mock import patch, MagicMock
 
 from fastapi import FastAPI
 
-from models import IDEType, LanguageType, GenerateRequest, TriggerType
+from models import IDEType, LanguageType, GenerateRequest, TriggerType, ContextFile
 from models.Requests import Telemetry, VerifyRequest
 
 from models.Sessions import Session as SessionModel
@@ -133,6 +134,23 @@ class TestSessions:
         assert stored_active_request.time_taken == 100
         assert stored_active_request.ground_truth == []
 
+    def test_adding_active_request_with_generation_details(self, base_session):
+        # Arrange
+        request_id, request, completions, time_taken, active_request, verify_request\
+            = get_dummy_active_request_and_session(self.session)
+        model_name = next(iter(completions))
+        details = {model_name: {"logprobs": array("f", [-0.5, -0.25]).tobytes(), "confidence": 0.7}}
+
+        # Act
+        self.session.add_active_request(request_id, request, completions, time_taken, details)
+
+        # Assert
+        stored_active_request = self.session.get_active_request(request_id)
+        assert array("f", stored_active_request.completions[model_name].logprobs).tolist() == [-0.5, -0.25]
+        assert stored_active_request.completions[model_name].confidence == 0.7
+        other_models = [model for model in completions if model != model_name]
+        assert all(stored_active_request.completions[model].confidence is None for model in other_models)
+
     def test_adding_active_request_then_verifying_it(self, base_session):
         # Arrange
         request_id, request, completions, time_taken, active_request, verify_request\
@@ -153,6 +171,110 @@ class TestSessions:
         assert stored_active_request.ground_truth == verify_request.ground_truth
 
 
+    def test_newer_request_supersedes_in_flight_request(self, base_session):
+        # Arrange
+        first_handle = MagicMock()
+        second_handle = MagicMock()
+
+        # Act
+        superseded_first = self.session.supersede_in_flight_request("request_1", first_handle)
+        superseded_second = self.session.supersede_in_flight_request("request_2", second_handle)
+
+        # Assert
+        assert not superseded_first
+        assert superseded_second
+        first_handle.cancel.assert_called_once()
+        second_handle.cancel.assert_not_called()
+
+    def test_retry_of_the_in_flight_request_does_not_supersede_it(self, base_session):
+        # Arrange
+        first_handle = MagicMock()
+        retry_handle = MagicMock()
+        self.session.supersede_in_flight_request("request_1", first_handle)
+
+        # Act
+        superseded = self.session.supersede_in_flight_request("request_1", retry_handle)
+        cancelled_by_retry = first_handle.cancel.called
+        self.session.supersede_in_flight_request("request_2", MagicMock())
+
+        # Assert
+        assert not superseded
+        assert not cancelled_by_retry
+        first_handle.cancel.assert_called_once()
+        retry_handle.cancel.assert_called_once()
+
+    def test_clearing_a_finished_request_keeps_the_newer_in_flight_request(self, base_session):
+        # Arrange
+        handle = MagicMock()
+        self.session.supersede_in_flight_request("request_2", handle)
+
+        # Act
+        self.session.clear_in_flight_request("request_1")  # an older request finishing late
+        cancelled = self.session.cancel_in_flight_request()
+
+        # Assert
+        assert cancelled
+        handle.cancel.assert_called_once()
+        assert not self.session.cancel_in_flight_request()
+
+    def test_typing_through_the_last_completions_returns_their_rest(self, base_session):
+        # Arrange
+        request_id, request, completions, time_taken, active_request, verify_request\
+            = get_dummy_active_request_and_session(self.session)
+        self.session.add_active_request(request_id, request, completions, time_taken)
+        typed_through = request.model_copy(update={"prefix": request.prefix + "Sl"})
+
+        # Act
+        remaining = self.session.get_typeahead_completions(typed_through)
+
+        # Assert
+        assert remaining == {"model_1": "im", "model_2": "ime"}
+
+    def test_typeahead_does_not_apply_when_the_user_deviates(self, base_session):
+        # Arrange
+        request_id, request, completions, time_taken, active_request, verify_request\
+            = get_dummy_active_request_and_session(self.session)
+        self.session.add_active_request(request_id, request, completions, time_taken)
+
+        # Act & Assert
+        assert self.session.get_typeahead_completions(
+            request.model_copy(update={"prefix": request.prefix + "Sh"})) is None  # typed something else
+        assert self.session.get_typeahead_completions(
+            request.model_copy(update={"prefix": request.prefix + "Slim"})) is None  # model_1 fully typed
+        assert self.session.get_typeahead_completions(
+            request.model_copy(update={"prefix": request.prefix + "Sl", "suffix": ""})) is None  # suffix changed
+        assert self.session.get_typeahead_completions(request) is None  # nothing typed
+
+    def test_context_files_are_resolved_by_hash_once_uploaded(self, base_session):
+        # Arrange
+        content = "def area(r):\n    return 3.14 * r * r\n"
+        uploaded, _ = self.session.resolve_context_files([ContextFile(path="geometry.py", content=content)])
+        digest = uploaded[0].hash
+
+        # Act
+        resolved, missing = self.session.resolve_context_files(
+            [ContextFile(path="geometry.py", hash=digest), ContextFile(path="changed.py", hash="0" * 64)]
+        )
+
+        # Assert
+        assert resolved == [ContextFile(path="geometry.py", content=content, hash=digest)]
+        assert missing == ["changed.py"]
+
+    def test_stored_request_keeps_only_the_hashes_of_its_context_files(self, base_session):
+        # Arrange
+        request_id, request, completions, time_taken, active_request, verify_request\
+            = get_dummy_active_request_and_session(self.session)
+        files, _ = self.session.resolve_context_files([ContextFile(path="geometry.py", content="x = 1\n")])
+
+        # Act
+        self.session.add_active_request(
+            request_id, request.model_copy(update={"context_files": files}), completions, time_taken
+        )
+
+        # Assert
+        stored = self.session.get_active_request(request_id).request.context_files
+        assert stored == [ContextFile(path="geometry.py", hash=files[0].hash)]
+
     # the functionality for dumping the session to the database is tested in the test_sessions_manager.py file
     # the actual call to the function however is not tested here as that would more so constitute an integration test
 
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from models.SingleFlight import SingleFlight
+
+
+class TestSingleFlight:
+
+    def test_callers_with_a_shared_key_wait_for_the_same_work(self):
+        # Arrange
+        single_flight = SingleFlight()
+        started = []
+
+        async def work(name: str) -> str:
+            started.append(name)
+            await asyncio.sleep(0.01)
+            return name
+
+        async def run():
+            return await asyncio.gather(
+                single_flight.run(["request:1", "prompt:a"], lambda: work("first")),
+                single_flight.run(
+                    ["request:2", "prompt:a"], lambda: work("same prompt")
+                ),
+                single_flight.run(["request:1", "prompt:b"], lambda: work("retry")),
+                single_flight.run(["request:3", "prompt:c"], lambda: work("other")),
+            )
+
+        # Act
+        results = asyncio.run(run())
+
+        # Assert
+        assert results == ["first", "first", "first", "other"]
+        assert started == ["first", "other"]
+        assert single_flight.stats() == {
+            "started": 2,
+            "joined": 2,
+            "replayed": 0,
+            "in_flight": 0,
+            "remembered": 0,
+        }
+
+    def test_work_is_only_cancelled_once_nobody_waits_for_it(self):
+        # Arrange
+        single_flight = SingleFlight()
+        finished = []
+
+        async def work() -> str:
+            await asyncio.sleep(0.05)
+            finished.append(True)
+            return "done"
+
+        async def run():
+            first = asyncio.create_task(single_flight.run(["key"], work))
+            second = asyncio.create_task(single_flight.run(["key"], work))
+            await asyncio.sleep(0.01)
+            first.cancel()  # e.g. superseded, the second caller still waits
+            result = await second
+            third = asyncio.create_task(single_flight.run(["key"], work))
+            await asyncio.sleep(0.01)
+            third.cancel()  # the last caller is gone
+            with pytest.raises(asyncio.CancelledError):
+                await third
+            await asyncio.sleep(0.1)
+            return result
+
+        # Act
+        result = asyncio.run(run())
+
+        # Assert
+        assert result == "done"
+        assert finished == [True]  # the third work was cancelled
+        assert single_flight.stats()["in_flight"] == 0
+
+    def test_remembered_results_are_replayed_until_they_expire(self):
+        # Arrange
+        single_flight = SingleFlight(max_remembered=1, ttl=60)
+        expired = SingleFlight(ttl=-1)
+
+        # Act
+        single_flight.remember("request:1", "first")
+        single_flight.remember("request:2", "second")
+        expired.remember("request:1", "first")
+
+        # Assert
+        assert single_flight.recall("request:1") is None  # evicted
+        assert single_flight.recall("request:2") == "second"
+        assert expired.recall("request:1") is None
+        assert single_flight.stats()["replayed"] == 1
+        assert expired.stats()["remembered"] == 0